@@ -5,56 +5,119 @@ move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
 
-import logging
 import endpoints
+from datetime import date, datetime, timedelta
 from protorpc import remote, messages, message_types
-from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 
-from models import DECKOFCARDS
-from models import User, Game, Score
+from engine import DIFFICULTIES, IllegalMove
+from models import User, Game, Score, UserStats, prefetch_user_names
+from models import DuplicateUserError, ScoreRollup, ArchivedGame
+from models import GAME_ACTIVE, ROLLUP_DAILY_DAYS
 from models import StringMessage, NewGameForm, GameForm, PlayCardForm
 from models import ScoreForms, ScoreForm, GameForms
-from models import UserRankingForm, UserRankingForms
+from models import UserRankingForms
 from models import GameHistoryForm, UserForm
-from google.appengine.ext import ndb
 
 from settings import WEB_CLIENT_ID
-from utils import get_by_urlsafe
+from utils import get_cursor, get_page_size, get_page_token
+from utils import get_offset
+from unit_of_work import run_game_mutation
+from game_cache import GameCache
+from metrics import instrumented
+from user_cache import USER_CACHE
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GAME_REQUEST = endpoints.ResourceContainer(
-        urlsafe_game_key=messages.StringField(1),)
+        urlsafe_game_key=messages.StringField(1),
+        compact=messages.BooleanField(2),
+        since_move=messages.IntegerField(3, variant=messages.Variant.INT32))
 PLAY_CARD_REQUEST = endpoints.ResourceContainer(
     PlayCardForm,
-    urlsafe_game_key=messages.StringField(1),)
+    urlsafe_game_key=messages.StringField(1),
+    compact=messages.BooleanField(2),
+    since_move=messages.IntegerField(3, variant=messages.Variant.INT32))
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
-GET_USER_GAMES_REQUEST = (
-    endpoints.ResourceContainer(user_name=messages.StringField(1)))
+PAGE_REQUEST = endpoints.ResourceContainer(
+    limit=messages.IntegerField(1, variant=messages.Variant.INT32),
+    page_token=messages.StringField(2))
+USER_SCORES_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    email=messages.StringField(2),
+    limit=messages.IntegerField(3, variant=messages.Variant.INT32),
+    page_token=messages.StringField(4))
+GET_USER_GAMES_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    limit=messages.IntegerField(2, variant=messages.Variant.INT32),
+    page_token=messages.StringField(3))
+WAIT_FOR_TURN_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    version=messages.IntegerField(2, variant=messages.Variant.INT32),
+    compact=messages.BooleanField(3),
+    since_move=messages.IntegerField(4, variant=messages.Variant.INT32))
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
+    days=messages.IntegerField(1, variant=messages.Variant.INT32),
+    start_date=messages.StringField(2),
+    end_date=messages.StringField(3),
+    limit=messages.IntegerField(4, variant=messages.Variant.INT32))
+GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    limit=messages.IntegerField(2, variant=messages.Variant.INT32),
+    page_token=messages.StringField(3))
+
+# days ranked by get_leaderboard when no window is requested
+DEFAULT_LEADERBOARD_DAYS = 7
+# most days get_leaderboard ranks in one window
+MAX_LEADERBOARD_DAYS = 3 * 366
+
+# seconds wait_for_turn holds a request for the game to change
+WAIT_FOR_TURN_SECONDS = 20
 
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 
 
-def ranking_to_form(self):
-    """converts user ranking to form"""
-    uf = UserRankingForm()
-    uf.user_name = self[0]
-    uf.wins = self[1]
-    uf.losses = self[2]
-    uf.games = self[3]
-    uf.winning_percentage = self[4]
-    return uf
-
-
 @endpoints.api(name='crazyeights', version='v1',
                allowed_client_ids=[WEB_CLIENT_ID, API_EXPLORER_CLIENT_ID],
                scopes=[EMAIL_SCOPE])
 class CrazyEightsApi(remote.Service):
     """api to play crazyeights game"""
 
+    def _copyGameToForm(self, game, request, message):
+        """copies game to GameForm, compact or delta if requested"""
+        if request.compact:
+            return game.to_compact_form(message, request.since_move)
+        return game.to_form(message)
+
+    def _getGameForm(self, cache, request):
+        """Return GameForm of the requested game from the game cache, with
+        the turn message if the game has no message"""
+        if request.compact:
+            game = cache.get_game(request.urlsafe_game_key)
+            if not game:
+                raise endpoints.NotFoundException('Game not found!')
+            form = game.to_compact_form(since_move=request.since_move)
+            user_one_name = game.player_name(True)
+            user_two_name = game.player_name(False)
+        else:
+            form = cache.get_form(request.urlsafe_game_key)
+            if not form:
+                raise endpoints.NotFoundException('Game not found!')
+            user_one_name = form.user_one_name
+            user_two_name = form.user_two_name
+        if form.message:
+            return form
+        if form.game_over:
+            form.message = ('Game is over!')
+        elif form.user_one_turn:
+            form.message = ('Time for ' + user_one_name +
+                            ' to make a move!')
+        else:
+            form.message = ('Time for ' + user_two_name +
+                            ' to make a move!')
+        return form
+
     def _copyUserToForm(self, current_user):
         """copies user to UserForm"""
         uf = UserForm()
@@ -71,16 +134,20 @@ class CrazyEightsApi(remote.Service):
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
 
-        # get User from datastore
+        # get User from the user cache, read from datastore on a miss
         user_email = user.email()
-        current_user = User.query(User.email == user_email).get()
-        # create new User if not there
+        current_user = USER_CACHE.get_by_email(user_email)
+        # create new User if not there, named by the email if the nickname
+        # is taken
         if not current_user:
-            current_user = User(
-                name=user.nickname(),
-                email=user.email(),
-            )
-            current_user.put()
+            try:
+                current_user = User.create(user.nickname(), user_email)
+            except DuplicateUserError:
+                try:
+                    current_user = User.create(user_email, user_email)
+                except DuplicateUserError as error:
+                    raise endpoints.ConflictException(str(error))
+            USER_CACHE.invalidate()
 
         return current_user    # return User
 
@@ -90,9 +157,17 @@ class CrazyEightsApi(remote.Service):
         current_user = self._getInfoFromUser()
 
         # if saveProfile(), process user-modifyable fields
-        if save_request:
-            current_user.name = save_request.user_name
-            current_user.put()
+        if save_request and not save_request.user_name:
+            raise endpoints.BadRequestException('User name not valid!')
+        if save_request and current_user.name != save_request.user_name:
+            try:
+                current_user.rename(save_request.user_name)
+            except DuplicateUserError as error:
+                raise endpoints.ConflictException(str(error))
+            USER_CACHE.invalidate()
+            # copy new name onto the user's games and scores
+            taskqueue.add(url='/tasks/propagate_user_name',
+                          params={'user_key': current_user.key.urlsafe()})
 
         # return UserMiniForm
         return self._copyUserToForm(current_user)
@@ -102,27 +177,27 @@ class CrazyEightsApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username and e-mail"""
-        if User.query(User.email == request.email).get():
-            raise endpoints.ConflictException(
-                    'A User with that e-mail already exists!')
-        if User.query(User.name == request.user_name).get():
-            raise endpoints.ConflictException(
-                    'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        try:
+            User.create(request.user_name, request.email)
+        except DuplicateUserError as error:
+            raise endpoints.ConflictException(str(error))
+        USER_CACHE.invalidate()
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
     @endpoints.method(message_types.VoidMessage, UserForm,
                       path='profile', http_method='GET', name='getProfile')
+    @instrumented
     def getProfile(self, request):
         """Return user profile."""
         return self._doUser()
 
     @endpoints.method(USER_REQUEST, UserForm,
                       path='profile', http_method='POST', name='saveProfile')
+    @instrumented
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doUser(request)
@@ -132,22 +207,27 @@ class CrazyEightsApi(remote.Service):
                       path='games',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
         """Creates new game"""
-        user_one = User.query(User.name == request.user_one_name).get()
+        if request.difficulty and request.difficulty not in DIFFICULTIES:
+            raise endpoints.BadRequestException('Difficulty not valid!')
+        user_one = USER_CACHE.key_for_name(request.user_one_name)
         if not user_one:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist for user one!')
-        user_two = User.query(User.name == request.user_two_name).get()
+        user_two = USER_CACHE.key_for_name(request.user_two_name)
         if not user_two:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist for user two!')
         try:
-            game = Game.new_game(user_one.key, user_two.key)
+            game = Game.new_game(user_one, user_two,
+                                 request.user_one_name, request.user_two_name,
+                                 request.difficulty)
         except ValueError:
             raise endpoints.InternalServerErrorException(
                     'Game was not created!')
-
+        GameCache().put(game)
         return game.to_form("New game created!")
 
     @endpoints.method(request_message=GAME_REQUEST,
@@ -155,188 +235,213 @@ class CrazyEightsApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
-        """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            if game.game_over:
-                game_message = ('Game is over!')
-            elif game.user_one_turn:
-                game_message = ('Time for ' + game.user_one.get().name +
-                                ' to make a move!')
-            else:
-                game_message = ('Time for ' + game.user_two.get().name +
-                                ' to make a move!')
-            return game.to_form(game_message)
-        else:
+        """Return the current game state, served from the game cache.
+        With compact the cards are sent as card numbers, and with
+        since_move only the moves made since then and what they changed"""
+        return self._getGameForm(GameCache(), request)
+
+    @endpoints.method(request_message=WAIT_FOR_TURN_REQUEST,
+                      response_message=GameForm,
+                      path='game/wait/{urlsafe_game_key}',
+                      name='wait_for_turn',
+                      http_method='GET')
+    @instrumented(long_poll=True)
+    def wait_for_turn(self, request):
+        """Return the game state once the game version differs from the
+        version passed, or after WAIT_FOR_TURN_SECONDS if it has not
+        changed.  Only the cached version is checked while waiting"""
+        cache = GameCache()
+        if cache.wait_for_change(request.urlsafe_game_key, request.version,
+                                 WAIT_FOR_TURN_SECONDS) is None:
             raise endpoints.NotFoundException('Game not found!')
+        return self._getGameForm(cache, request)
 
     @endpoints.method(request_message=PLAY_CARD_REQUEST,
                       response_message=GameForm,
                       path='game/play/{urlsafe_game_key}',
                       name='play_card',
                       http_method='PUT')
+    @instrumented
     def play_card(self, request):
         """Plays a card. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        valid_card = False
-        if game.game_over is True:
-            return game.to_form('Game already over!')
-        # Check if card played is in player's hand
-        if game.card_in_hand(request.card_number, request.card_suit) == False:
-            return game.to_form('That card is not in your hand!')
-
-        # determine number of top card in discard pile
-        top_card_number = DECKOFCARDS[int(game.discard_pile.split(',')[0])][1]
-        # check if played card crazy eight
-        if request.card_number == '8':
-            logging.info("crazy eight")
-            if request.crazy_suit:
-                game.current_suit = request.crazy_suit
-            else:
-                game.current_suit = request.card_suit
-            valid_card = True
-        # check if top card crazy eight
-        elif top_card_number == '8':
-            if game.current_suit == request.card_suit:
-                valid_card = True
-        elif (top_card_number == request.card_number or
-              game.current_suit == request.card_suit):
-            game.current_suit = request.card_suit
-            valid_card = True
-        else:
-            valid_card = False
-
-        if valid_card is True:
+        def play(game, unit):
+            user_one_turn = game.user_one_turn
+            crazy_suit = request.crazy_suit and request.crazy_suit.lower()
+            try:
+                game.play_card(request.card_number, request.card_suit,
+                               crazy_suit)
+            except IllegalMove as error:
+                return self._copyGameToForm(game, request, str(error))
+            unit.save()
             # End game if last card played
-            if game.user_one_turn is True:
-                if len(game.player_one_hand.split(',')) == 1:
-                    game.discard_card(game.user_one_turn,
-                                      request.card_number, request.card_suit)
-                    game.end_game(True)
-                    return game.to_form(('Game over! ' +
-                                         game.user_one.get().name + ' wins!'))
-            else:
-                if len(game.player_two_hand.split(',')) == 1:
-                    game.discard_card(game.user_one_turn,
-                                      request.card_number, request.card_suit)
-                    game.end_game(False)
-                    return game.to_form(('Game over! ' +
-                                         game.user_two.get().name + ' wins!'))
-            game.discard_card(game.user_one_turn,
-                              request.card_number, request.card_suit)
-            if game.user_two.get().name == 'Computer':
-                game.computer_play_card(game.computer_take_turn)
-
-            return game.to_form('Card played!')
+            if game.game_over:
+                return self._copyGameToForm(
+                    game, request,
+                    'Game over! ' + game.player_name(user_one_turn) +
+                    ' wins!')
+            if game.player_name(False) == 'Computer':
+                game.computer_take_turn()
+            return self._copyGameToForm(game, request, 'Card played!')
 
-        else:
-            return game.to_form('Card not valid!')
+        return run_game_mutation(request.urlsafe_game_key, play)
 
     @endpoints.method(request_message=GAME_REQUEST,
                       response_message=GameForm,
                       path='game/draw/{urlsafe_game_key}',
                       name='draw_card',
                       http_method='PUT')
+    @instrumented
     def draw_card(self, request):
         """Allows the player to draw a card"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game.game_over:
-            return game.to_form('Game already over!')
-        game.draw_card(game.user_one_turn)
-        return game.to_form('Card drawn!')
-
-    @endpoints.method(message_types.VoidMessage,
+        def draw(game, unit):
+            try:
+                drawn_card = game.draw_card()
+            except IllegalMove as error:
+                return self._copyGameToForm(game, request, str(error))
+            if drawn_card is None:
+                return self._copyGameToForm(game, request,
+                                            'No cards left to draw!')
+            unit.save()
+            return self._copyGameToForm(game, request, 'Card drawn!')
+
+        return run_game_mutation(request.urlsafe_game_key, draw)
+
+    @endpoints.method(request_message=PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
-
-    @endpoints.method(request_message=USER_REQUEST,
+        """Return all scores, one page at a time"""
+        scores, next_cursor, more = Score.query().fetch_page(
+            get_page_size(request.limit),
+            start_cursor=get_cursor(request.page_token))
+        prefetch_user_names(scores)
+        return ScoreForms(items=[score.to_form() for score in scores],
+                          next_page_token=get_page_token(next_cursor, more))
+
+    @endpoints.method(request_message=USER_SCORES_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
+        """Returns all of an individual User's scores, newest first, one
+        page at a time"""
         user = self._getInfoFromUser()
         if not user:
             raise endpoints.NotFoundException(
                     'User is not signed in!')
 
-        scores = Score.query(ndb.OR(Score.winning_user == user.key,
-                                    Score.losing_user == user.key))
-        return ScoreForms(items=[score.to_form() for score in scores])
+        scores, next_cursor, more = (
+            Score.query(Score.participants == user.key)
+            .order(-Score.date)
+            .fetch_page(get_page_size(request.limit),
+                        start_cursor=get_cursor(request.page_token)))
+        prefetch_user_names(scores)
+        return ScoreForms(items=[score.to_form() for score in scores],
+                          next_page_token=get_page_token(next_cursor, more))
 
     @endpoints.method(request_message=GET_USER_GAMES_REQUEST,
                       response_message=GameForms,
                       path='profile/user_games',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
     def get_user_games(self, request):
-        """Returns all of a user's active games"""
+        """Returns all of a user's active games, newest first, one page at
+        a time"""
         user = self._getInfoFromUser()
         if not user:
             raise endpoints.NotFoundException(
                     'User is not signed in!')
-        user_games = Game.query(ndb.AND(ndb.OR(Game.user_one == user.key,
-                                               Game.user_two == user.key),
-                                        Game.game_over == False))
-        return GameForms(items=[game.to_form("") for game in user_games])
-
-    @endpoints.method(message_types.VoidMessage,
+        user_games, next_cursor, more = (
+            Game.query(Game.participants == user.key,
+                       Game.status == GAME_ACTIVE)
+            .order(-Game.date)
+            .fetch_page(get_page_size(request.limit),
+                        start_cursor=get_cursor(request.page_token)))
+        prefetch_user_names(user_games)
+        return GameForms(items=[game.to_form("") for game in user_games],
+                         next_page_token=get_page_token(next_cursor, more))
+
+    @endpoints.method(request_message=PAGE_REQUEST,
                       response_message=UserRankingForms,
                       path='rankings',
                       name='get_all_rankings',
                       http_method='GET'
                       )
+    @instrumented
     def get_all_rankings(self, request):
         """returns rankings by winning percentage ranked descending"""
-        scores = Score.query()
-        users = User.query()
-
-        user_keys = []
-        for score in scores:
-            if score.winning_user not in user_keys:
-                user_keys.append(score.winning_user)
-            if score.losing_user not in user_keys:
-                user_keys.append(score.losing_user)
-
-        user_results = []
-        for user in user_keys:
-            wins = 0
-            losses = 0
-            current_user_name = ''
-            for ind_user in users:
-                if user == ind_user.key:
-                    current_user_name = ind_user.name
-            for score in scores:
-                if score.winning_user == user:
-                    wins = wins + 1
-                if score.losing_user == user:
-                    losses = losses + 1
-            games = wins + losses
-            winning_percentage = float(wins)/float(games)
-            user_result = (current_user_name, wins, losses, games,
-                           winning_percentage)
-            user_results.append(user_result)
-            user_results.sort(key=lambda x: x[4], reverse=True)
-        return UserRankingForms(items=([ranking_to_form(result)
-                                       for result in user_results]))
+        rankings, next_cursor, more = (
+            UserStats.query()
+            .order(-UserStats.winning_percentage)
+            .fetch_page(get_page_size(request.limit),
+                        start_cursor=get_cursor(request.page_token)))
+        return UserRankingForms(
+            items=[stats.to_form() for stats in rankings],
+            next_page_token=get_page_token(next_cursor, more))
+
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=UserRankingForms,
+                      path='leaderboard',
+                      name='get_leaderboard',
+                      http_method='GET')
+    @instrumented
+    def get_leaderboard(self, request):
+        """returns rankings by winning percentage of the games finished in
+        the last days, or from start_date to end_date (YYYY-MM-DD, end
+        defaults to today), read from the daily and monthly score
+        rollups.  Windows are at most MAX_LEADERBOARD_DAYS long, and must
+        start and end on month boundaries where only monthly rollups
+        remain"""
+        today = date.today()
+        try:
+            last_day = (datetime.strptime(request.end_date, '%Y-%m-%d')
+                        .date() if request.end_date else today)
+            if request.start_date:
+                first_day = datetime.strptime(request.start_date,
+                                              '%Y-%m-%d').date()
+            else:
+                days = request.days or DEFAULT_LEADERBOARD_DAYS
+                if days < 1:
+                    raise ValueError(days)
+                first_day = last_day - timedelta(days - 1)
+        except (ValueError, OverflowError):
+            raise endpoints.BadRequestException('Dates not valid!')
+        if first_day > last_day:
+            raise endpoints.BadRequestException('Dates not valid!')
+        if (last_day - first_day).days >= MAX_LEADERBOARD_DAYS:
+            raise endpoints.BadRequestException(
+                'Windows longer than {} days are not valid!'.format(
+                    MAX_LEADERBOARD_DAYS))
+        try:
+            window = ScoreRollup.window(first_day, last_day)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                'Windows older than {} days must cover whole months!'.format(
+                    ROLLUP_DAILY_DAYS))
+        return window.to_forms(get_page_size(request.limit))
 
-    @endpoints.method(request_message=GAME_REQUEST,
+    @endpoints.method(request_message=GAME_HISTORY_REQUEST,
                       response_message=GameHistoryForm,
                       path='game/history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
-        """Return the current game history."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Return the current game history, one page of moves at a time.
+        Archived games are read from the archive."""
+        game = (GameCache().get_game(request.urlsafe_game_key) or
+                ArchivedGame.get_for_game(request.urlsafe_game_key))
         if game:
-            return game.to_history_form()
+            return game.to_history_form(get_offset(request.page_token),
+                                        get_page_size(request.limit))
         else:
             raise endpoints.NotFoundException('Game not found!')
 
@@ -345,12 +450,20 @@ class CrazyEightsApi(remote.Service):
                       path='game/cancel/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='PUT')
+    @instrumented
     def cancel_game(self, request):
         """Cancel the current game."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game.game_over is True:
-            return game.to_form('Game already over and cannot be cancelled!')
-        game.cancel_game()
-        return game.to_form('Game is cancelled!  Scores are not recorded.')
+        def cancel(game, unit):
+            if game.game_over is True:
+                return self._copyGameToForm(
+                    game, request,
+                    'Game already over and cannot be cancelled!')
+            game.cancel_game()
+            unit.save()
+            return self._copyGameToForm(
+                game, request,
+                'Game is cancelled!  Scores are not recorded.')
+
+        return run_game_mutation(request.urlsafe_game_key, cancel)
 
 api = endpoints.api_server([CrazyEightsApi])
@@ -0,0 +1,181 @@
+"""benchmarks/simulate.py - Plays computer against computer games with the
+rules engine across a pool of processes and reports games/sec, moves/sec and
+per-move latency percentiles.  A move is one computer turn, including the
+cards drawn before the play.  User one plays the greedy heuristic and user
+two the computer player of --difficulty, whose win rate is reported.
+Run from the repository root:
+
+    python benchmarks/simulate.py --games 20000 --processes 4
+    python benchmarks/simulate.py --games 10000 --difficulty hard
+    python benchmarks/simulate.py --save-baseline baseline.json
+    python benchmarks/simulate.py --baseline baseline.json
+
+With --baseline the run exits with status 1 if moves/sec falls more than
+--tolerance below the saved baseline, so it can gate changes to the rules
+path.  Baselines depend on the machine and interpreter, so save one before
+the change and compare after it on the same machine."""
+
+__copyright__ = """
+    Copyright 2016 Christine Stoner
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+from collections import Counter
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from engine import CrazyEights, DIFFICULTIES, computer_player
+
+# games played by each task sent to the process pool
+GAMES_PER_TASK = 250
+# turns after which a game that no player can finish is abandoned
+MAX_TURNS = 1000
+# width in seconds of the buckets of the latency histogram
+LATENCY_BUCKET = 1e-7
+# latency percentiles reported
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def play_games(task):
+    """play a number of games from a seed, returning (games, moves,
+       abandoned games, elapsed seconds, latency histogram, user two wins)
+    """
+    seed, games, difficulty = task
+    rng = random.Random(seed)
+    timer = default_timer
+    latencies = Counter()
+    moves = 0
+    abandoned = 0
+    user_two_wins = 0
+    started = timer()
+    for _ in range(games):
+        game = CrazyEights.deal(rng)
+        player = computer_player(difficulty)
+        turns = 0
+        while not game.game_over:
+            if turns == MAX_TURNS:
+                abandoned += 1
+                break
+            move_started = timer()
+            if game.user_one_turn:
+                game.take_computer_turn()
+            else:
+                game.take_computer_turn(player)
+            latencies[int((timer() - move_started) / LATENCY_BUCKET)] += 1
+            turns += 1
+        moves += turns
+        user_two_wins += game.winner is False
+    return (games, moves, abandoned, timer() - started, latencies,
+            user_two_wins)
+
+
+def percentile(latencies, moves, percent):
+    """return latency in microseconds below which percent of moves ran"""
+    threshold = moves * percent / 100.0
+    seen = 0
+    for bucket in sorted(latencies):
+        seen += latencies[bucket]
+        if seen >= threshold:
+            return bucket * LATENCY_BUCKET * 1e6
+    return 0.0
+
+
+def run(games, processes, seed, difficulty):
+    """play games across a pool of processes and return report dict"""
+    tasks = []
+    remaining = games
+    while remaining > 0:
+        count = min(GAMES_PER_TASK, remaining)
+        tasks.append((seed + len(tasks), count, difficulty))
+        remaining -= count
+    pool = multiprocessing.Pool(processes)
+    try:
+        started = default_timer()
+        results = pool.map(play_games, tasks)
+        elapsed = default_timer() - started
+    finally:
+        pool.close()
+        pool.join()
+    moves = sum(result[1] for result in results)
+    latencies = Counter()
+    for result in results:
+        latencies.update(result[4])
+    report = {'games': games,
+              'moves': moves,
+              'abandoned': sum(result[2] for result in results),
+              'processes': processes,
+              'seconds': elapsed,
+              'games_per_sec': games / elapsed,
+              'moves_per_sec': moves / elapsed,
+              'difficulty': difficulty,
+              'user_two_win_rate': (sum(result[5] for result in results) /
+                                    float(games)),
+              'python': platform.python_version()}
+    for percent in PERCENTILES:
+        report['p%s_us' % percent] = percentile(latencies, moves, percent)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', type=int, default=20000)
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--difficulty', choices=sorted(DIFFICULTIES),
+                        default='easy', help='computer level of user two')
+    parser.add_argument('--baseline',
+                        help='fail if slower than report saved in file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fraction below baseline moves/sec')
+    parser.add_argument('--save-baseline',
+                        help='save report to file as the new baseline')
+    args = parser.parse_args(argv)
+
+    report = run(args.games, args.processes, args.seed, args.difficulty)
+    print('%(games)d games, %(moves)d moves, %(abandoned)d abandoned in '
+          '%(seconds).2fs on %(processes)d processes' % report)
+    print('%(games_per_sec).0f games/sec, %(moves_per_sec).0f moves/sec'
+          % report)
+    print('move latency ' + ', '.join(
+        'p%s %.1fus' % (percent, report['p%s_us' % percent])
+        for percent in PERCENTILES))
+    print('user two (%(difficulty)s) wins %(user_two_win_rate).1f%%'
+          % dict(report, user_two_win_rate=report['user_two_win_rate'] * 100))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        floor = baseline['moves_per_sec'] * (1 - args.tolerance)
+        if report['moves_per_sec'] < floor:
+            print('FAIL: %.0f moves/sec is below baseline %.0f - %d%%'
+                  % (report['moves_per_sec'], baseline['moves_per_sec'],
+                     args.tolerance * 100))
+            return 1
+        print('OK: within %d%% of baseline %.0f moves/sec'
+              % (args.tolerance * 100, baseline['moves_per_sec']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,11 @@
+"""engine - Datastore-free rules engine of the game.  cards.py holds the
+card codec and card structures, rules.py the CrazyEights rules engine and
+greedy computer strategy, players.py the pluggable computer players,
+replay.py the move log record format and the replay engine, and state.py
+the versioned binary format of stored card state.  Nothing in
+this package imports App Engine, so the rules can be played and timed in any
+Python 2.7 or 3 interpreter."""
+
+from .rules import CrazyEights, IllegalMove, choose_play
+from .players import DIFFICULTIES, computer_player
+from .replay import ReplayError, replay_moves
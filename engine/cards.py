@@ -0,0 +1,409 @@
+"""engine/cards.py - This file contains the card codec and the in-memory
+card structures used by the rules engine.  Card numbers(0-51) map to
+(suit, value) pairs and display strings through precomputed tables, and the
+legal plays for every (top card, current suit) pair are held as bitmasks.
+Hands are held as 52-bit masks and piles as deques so that membership
+checks, discards and draws run in constant time, and the stored comma
+separated card strings are parsed only once per request.  The order of the
+undrawn cards of a seeded game is not stored: each deal and reshuffle
+orders the deck with a SplitMix64 generator seeded from the game seed and
+the reshuffle count, and the undrawn cards are the cards of that order not
+held in a hand or the discard pile."""
+
+__copyright__ = """
+    Copyright 2016 Christine Stoner
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import random
+from collections import deque
+
+# Holds values for standard deck of cards
+CARD_NUMBER_VALUES = ['A', '2', '3', '4', '5',
+                      '6', '7', '8', '9', '10', 'J', 'Q', 'K']
+# Hold suits for standard deck of cards
+CARD_SUITS = ['hearts', 'diamonds', 'clubs', 'spades']
+# variable to hold list of tuples for standard deck of cards
+DECKOFCARDS = []
+
+# populate DECKOFCARDS with tuples of (suit, card number)
+for suit in CARD_SUITS:
+    for value in CARD_NUMBER_VALUES:
+        card = (suit, value)
+        DECKOFCARDS.append(card)
+
+# number of cards in a standard deck
+DECK_SIZE = len(DECKOFCARDS)
+# number of cards dealt to each player
+HAND_SIZE = 7
+# card number values that can be played at any time
+CRAZY_VALUE = '8'
+
+# map of (suit, card number) tuples to card numbers(0-51)
+CARD_IDS = dict((card, card_id) for card_id, card in enumerate(DECKOFCARDS))
+# pre-rendered '(suit,value)' strings used in game forms, by card number
+CARD_TEXT = ['(%s,%s)' % card for card in DECKOFCARDS]
+# bitmask of every card of each suit and of each card number value
+SUIT_MASKS = dict((suit, 0) for suit in CARD_SUITS)
+VALUE_MASKS = dict((value, 0) for value in CARD_NUMBER_VALUES)
+for index, (suit, value) in enumerate(DECKOFCARDS):
+    SUIT_MASKS[suit] |= 1 << index
+    VALUE_MASKS[value] |= 1 << index
+CRAZY_MASK = VALUE_MASKS[CRAZY_VALUE]
+# bitmask of every card of the deck
+DECK_MASK = (1 << DECK_SIZE) - 1
+# bits of a deck seed, which fits a signed 64-bit integer
+DECK_SEED_BITS = 63
+# SplitMix64 state increment and the mask keeping values to 64 bits
+SPLITMIX_GAMMA = 0x9e3779b97f4a7c15
+UINT64_MASK = (1 << 64) - 1
+# number of deck orders kept by deck_order before they are dropped
+DECK_ORDER_CACHE_SIZE = 1024
+# deck orders by (seed, reshuffles), shared by the threads of the process
+_DECK_ORDERS = {}
+
+
+def _legal_play_mask(top_card_id, current_suit):
+    """return bitmask of cards that may be played on top card when the
+       current suit is current_suit
+    """
+    top_value = DECKOFCARDS[top_card_id][1]
+    legal_mask = CRAZY_MASK | SUIT_MASKS[current_suit]
+    # a card matching the number of the top card may be played unless the
+    # top card is a crazy eight, which only the chosen suit may follow
+    if top_value != CRAZY_VALUE:
+        legal_mask |= VALUE_MASKS[top_value]
+    return legal_mask
+
+
+# bitmask of legal plays indexed by top card number and current suit
+LEGAL_PLAYS = dict(((top_card_id, current_suit),
+                    _legal_play_mask(top_card_id, current_suit))
+                   for top_card_id in range(DECK_SIZE)
+                   for current_suit in CARD_SUITS)
+
+
+def mix64(value):
+    """return the SplitMix64 finalizer of a 64-bit value"""
+    value = (value ^ value >> 30) * 0xbf58476d1ce4e5b9 & UINT64_MASK
+    value = (value ^ value >> 27) * 0x94d049bb133111eb & UINT64_MASK
+    return value ^ value >> 31
+
+
+class SplitMix64(object):
+    """Small, fast deterministic random number generator whose sequence
+    depends only on its seed, on every Python version
+    Attributes:
+        state: 64-bit state, advanced by SPLITMIX_GAMMA for each value
+    """
+    __slots__ = ('state',)
+
+    def __init__(self, seed):
+        self.state = seed & UINT64_MASK
+
+    def next(self):
+        """return the next 64-bit value"""
+        self.state = (self.state + SPLITMIX_GAMMA) & UINT64_MASK
+        return mix64(self.state)
+
+    def below(self, limit):
+        """return an integer from 0 up to, not including, limit"""
+        return self.next() * limit >> 64
+
+    def shuffle(self, items):
+        """shuffle list items in place"""
+        for index in range(len(items) - 1, 0, -1):
+            other = self.below(index + 1)
+            items[index], items[other] = items[other], items[index]
+
+
+def deck_order(seed, reshuffles=0):
+    """return tuple of every card number in the order of the deck of game
+       seed after reshuffles reshuffles; the deal uses order 0.  Recent
+       orders are kept, so a game read by every request of its players is
+       shuffled once
+    """
+    order = _DECK_ORDERS.get((seed, reshuffles))
+    if order is None:
+        deck = list(range(DECK_SIZE))
+        SplitMix64(mix64(seed ^ mix64(reshuffles))).shuffle(deck)
+        order = tuple(deck)
+        if len(_DECK_ORDERS) >= DECK_ORDER_CACHE_SIZE:
+            _DECK_ORDERS.clear()
+        _DECK_ORDERS[(seed, reshuffles)] = order
+    return order
+
+
+def card_id(card_suit, card_number):
+    """return card number(0-51) of card suit and value, or None if the
+       pair is not a card
+    """
+    return CARD_IDS.get((card_suit, card_number))
+
+
+def legal_plays(top_card_id, current_suit):
+    """return bitmask of cards that may be played on top card and current
+       suit; only eights may be played if current suit is not a suit
+    """
+    return LEGAL_PLAYS.get((top_card_id, current_suit), CRAZY_MASK)
+
+
+def is_legal_play(top_card_id, current_suit, play_card_id):
+    """determine if card may be played on top card and current suit"""
+    return bool(legal_plays(top_card_id, current_suit) >> play_card_id & 1)
+
+
+def count_cards(mask):
+    """return number of cards in bitmask"""
+    return bin(mask).count('1')
+
+
+def highest_card(mask):
+    """return highest card number held in a non-empty bitmask"""
+    return mask.bit_length() - 1
+
+
+def iter_cards(mask):
+    """yield card numbers held in bitmask in ascending order"""
+    card_id = 0
+    while mask:
+        if mask & 1:
+            yield card_id
+        mask >>= 1
+        card_id += 1
+
+
+def suits_by_count(mask):
+    """return suits ordered from most to least cards held in bitmask,
+       ties broken by CARD_SUITS order
+    """
+    return sorted(CARD_SUITS,
+                  key=lambda suit: -count_cards(mask & SUIT_MASKS[suit]))
+
+
+def parse_cards(card_string):
+    """convert string of comma separated card numbers(0-51) into a list
+       of integer card numbers
+    """
+    if not card_string:
+        return []
+    return [int(card_id) for card_id in card_string.split(',')]
+
+
+def join_cards(card_ids):
+    """convert iterable of integer card numbers into comma separated
+       string of card numbers(0-51)
+    """
+    return ','.join([str(card_id) for card_id in card_ids])
+
+
+def cards_to_text(card_ids):
+    """convert iterable of integer card numbers into card values from
+       DECKOFCARDS joined in string to return in game form
+    """
+    return '*'.join([CARD_TEXT[card_id] for card_id in card_ids])
+
+
+class CardSet(object):
+    """Unordered set of cards held as a 52-bit mask, used for player hands
+    Attributes:
+        mask: integer with bit n set when card number n is held
+    """
+    __slots__ = ('mask',)
+
+    def __init__(self, card_ids=()):
+        self.mask = 0
+        for card_id in card_ids:
+            self.mask |= 1 << card_id
+
+    @classmethod
+    def from_string(cls, card_string):
+        """create CardSet from string of comma separated card numbers"""
+        return cls(parse_cards(card_string))
+
+    @classmethod
+    def from_mask(cls, mask):
+        """create CardSet holding the cards of bitmask"""
+        card_set = cls()
+        card_set.mask = mask
+        return card_set
+
+    def to_string(self):
+        """return comma separated string of card numbers in the set"""
+        return join_cards(self)
+
+    def add(self, card_id):
+        """add card number to the set"""
+        self.mask |= 1 << card_id
+
+    def remove(self, card_id):
+        """remove card number from the set, raising ValueError if the
+           card is not held
+        """
+        bit = 1 << card_id
+        if not self.mask & bit:
+            raise ValueError('Card not in hand')
+        self.mask &= ~bit
+
+    def __contains__(self, card_id):
+        return bool(self.mask >> card_id & 1)
+
+    def __len__(self):
+        return count_cards(self.mask)
+
+    def __nonzero__(self):
+        return self.mask != 0
+
+    __bool__ = __nonzero__
+
+    def __iter__(self):
+        return iter_cards(self.mask)
+
+
+class CardPile(object):
+    """Ordered pile of cards with the top card first, used for the discard
+    pile and the undrawn cards
+    Attributes:
+        cards: deque of card numbers, top card at the left
+    """
+    __slots__ = ('cards',)
+
+    def __init__(self, card_ids=()):
+        self.cards = deque(card_ids)
+
+    @classmethod
+    def from_string(cls, card_string):
+        """create CardPile from string of comma separated card numbers,
+           top card first
+        """
+        return cls(parse_cards(card_string))
+
+    def to_string(self):
+        """return comma separated string of card numbers, top card first"""
+        return join_cards(self.cards)
+
+    def top(self):
+        """return top card number without removing it"""
+        return self.cards[0]
+
+    def push(self, card_id):
+        """place card number on top of the pile"""
+        self.cards.appendleft(card_id)
+
+    def pop(self):
+        """remove and return top card number"""
+        return self.cards.popleft()
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __iter__(self):
+        return iter(self.cards)
+
+
+class GameCards(object):
+    """In-memory card state of a Game, parsed once from its stored strings
+    Attributes:
+        hands: list of CardSet for player one and player two
+        discard_pile: CardPile of discarded cards
+        undrawn_cards: CardPile of cards remaining to be drawn
+        seed: deck seed ordering the deal and reshuffles, or None if the
+              undrawn cards are stored and reshuffled with a random
+              number generator
+        reshuffles: number of times the discard pile was reshuffled
+    """
+    __slots__ = ('hands', 'discard_pile', 'undrawn_cards', 'seed',
+                 'reshuffles')
+
+    def __init__(self, hands, discard_pile, undrawn_cards, seed=None,
+                 reshuffles=0):
+        self.hands = hands
+        self.discard_pile = discard_pile
+        self.undrawn_cards = undrawn_cards
+        self.seed = seed
+        self.reshuffles = reshuffles
+
+    @classmethod
+    def from_strings(cls, player_one_hand, player_two_hand, discard_pile,
+                     undrawn_cards):
+        """create GameCards from the stored comma separated card strings"""
+        return cls([CardSet.from_string(player_one_hand),
+                    CardSet.from_string(player_two_hand)],
+                   CardPile.from_string(discard_pile),
+                   CardPile.from_string(undrawn_cards))
+
+    @classmethod
+    def from_seed(cls, player_one_hand, player_two_hand, discard_pile, seed,
+                  reshuffles):
+        """create GameCards from the stored hand and discard pile strings
+           of a seeded game, deriving its undrawn cards from the deck order
+           of its last reshuffle
+        """
+        return cls.seeded([CardSet.from_string(player_one_hand),
+                           CardSet.from_string(player_two_hand)],
+                          CardPile.from_string(discard_pile), seed,
+                          reshuffles)
+
+    @classmethod
+    def seeded(cls, hands, discard_pile, seed, reshuffles):
+        """create GameCards of a seeded game from its hands and discard
+           pile, deriving its undrawn cards from the deck order of its last
+           reshuffle
+        """
+        held = hands[0].mask | hands[1].mask | CardSet(discard_pile).mask
+        undrawn_cards = CardPile(card_id for card_id
+                                 in deck_order(seed, reshuffles)
+                                 if not held >> card_id & 1)
+        return cls(hands, discard_pile, undrawn_cards, seed, reshuffles)
+
+    @classmethod
+    def deal(cls, deck, seed=None):
+        """create GameCards by dealing a shuffled deck of card numbers:
+           seven cards to each player, one discarded and the rest undrawn.
+           seed is the deck seed the deck was ordered with, if any
+        """
+        return cls([CardSet(deck[0:HAND_SIZE]),
+                    CardSet(deck[HAND_SIZE:2 * HAND_SIZE])],
+                   CardPile([deck[2 * HAND_SIZE]]),
+                   CardPile(deck[2 * HAND_SIZE + 1:]), seed)
+
+    def hand(self, user_one_turn):
+        """return the hand of player one or player two"""
+        if user_one_turn:
+            return self.hands[0]
+        return self.hands[1]
+
+    def to_strings(self):
+        """return stored string representation of hands and piles as
+           (player_one_hand, player_two_hand, discard_pile, undrawn_cards)
+        """
+        return (self.hands[0].to_string(), self.hands[1].to_string(),
+                self.discard_pile.to_string(),
+                self.undrawn_cards.to_string())
+
+    def reshuffle(self, rng=random):
+        """shuffle discarded cards, except the top card, into undrawn cards
+           in the next deck order of the seed, or using random number
+           generator rng if the cards are not seeded
+        """
+        last_discard_card = self.discard_pile.pop()
+        if self.seed is None:
+            reshuffled = list(self.discard_pile)
+            rng.shuffle(reshuffled)
+        else:
+            self.reshuffles += 1
+            discarded = CardSet(self.discard_pile).mask
+            reshuffled = [card_id for card_id
+                          in deck_order(self.seed, self.reshuffles)
+                          if discarded >> card_id & 1]
+        self.undrawn_cards = CardPile(reshuffled)
+        self.discard_pile = CardPile([last_discard_card])
@@ -0,0 +1,153 @@
+"""engine/replay.py - This file contains the compact move record codec used
+by the append-only game move log and the replay engine that rebuilds the
+state of a game at any move from its log.  Each record is a 16-bit integer:
+
+    bits 0-5   card number(0-51)
+    bits 6-7   index in CARD_SUITS of the current suit after the move
+    bit 8      player, 0 for user one and 1 for user two
+    bits 9-11  action code
+
+A game's log starts with one DEAL record for each card of the shuffled deck,
+in deck order.  Each RESHUFFLE record holds the card left on the discard
+pile and is followed by one DECK record for each reshuffled undrawn card,
+top card first, so a replay reproduces every draw exactly."""
+
+__copyright__ = """
+    Copyright 2016 Christine Stoner
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import struct
+
+from .cards import CARD_SUITS, DECKOFCARDS, DECK_SIZE, HAND_SIZE
+from .cards import CardPile, GameCards
+
+# action codes of move records
+DEAL = 0
+PLAY = 1
+DRAW = 2
+RESHUFFLE = 3
+DECK = 4
+PASS = 5
+# names of the actions of move records, by action code
+RECORD_NAMES = ['deal', 'play', 'draw', 'reshuffle', 'deck', 'pass']
+# action names shown in game history, by action code; None if not shown
+ACTION_NAMES = list(None if action in (DEAL, DECK) else name
+                    for action, name in enumerate(RECORD_NAMES))
+
+
+class ReplayError(Exception):
+    """Raised when a move log does not describe a legal sequence of moves"""
+
+
+def encode_move(action, user_one_turn, card_number=0, suit=None):
+    """return 16-bit record of move by user one or user two"""
+    suit_index = CARD_SUITS.index(suit) if suit in CARD_SUITS else 0
+    player = 0 if user_one_turn else 1
+    return action << 9 | player << 8 | suit_index << 6 | card_number
+
+
+def decode_move(record):
+    """return (action, user_one_turn, card number, suit) of a record"""
+    return (record >> 9, not record >> 8 & 1, record & 0x3f,
+            CARD_SUITS[record >> 6 & 3])
+
+
+def pack_moves(records):
+    """return records packed into little-endian 16-bit string"""
+    return struct.pack('<%dH' % len(records), *records)
+
+
+def unpack_moves(packed):
+    """return list of records from little-endian 16-bit string"""
+    return list(struct.unpack('<%dH' % (len(packed) // 2), packed))
+
+
+def describe_move(record, user_one_name, user_two_name):
+    """return game history string 'user,action,card suit,card number' of a
+       record, or None for records not shown in game history
+    """
+    action, user_one_turn, card_number, suit = decode_move(record)
+    if action >= len(ACTION_NAMES) or ACTION_NAMES[action] is None:
+        return None
+    user_name = user_one_name if user_one_turn else user_two_name
+    if action == PASS:
+        return ','.join([user_name, ACTION_NAMES[action], '', ''])
+    card_suit, card_value = DECKOFCARDS[card_number]
+    return ','.join([user_name, ACTION_NAMES[action], card_suit, card_value])
+
+
+class ReplayState(object):
+    """Game state rebuilt from a move log
+    Attributes:
+        cards: GameCards holding hands and piles
+        current_suit: lower case current suit of game
+        user_one_turn: boolean indicating if user one turn
+        moves: number of records replayed
+    """
+
+    def __init__(self):
+        self.cards = None
+        self.current_suit = None
+        self.user_one_turn = True
+        self.moves = 0
+
+    def game_over(self):
+        """determine if a player has discarded all their cards"""
+        return (self.cards is not None and
+                not (self.cards.hands[0] and self.cards.hands[1]))
+
+
+def replay_moves(records, upto=None):
+    """rebuild game state after the first upto records of a move log, or
+       after every record if upto is None.  Raises ReplayError if a record
+       is not a legal continuation of the game
+    """
+    if upto is None:
+        upto = len(records)
+    state = ReplayState()
+    deck = []
+    for index, record in enumerate(records[:upto]):
+        action, user_one_turn, card_number, suit = decode_move(record)
+        if action == DEAL:
+            deck.append(card_number)
+            if len(deck) == DECK_SIZE:
+                state.cards = GameCards.deal(deck)
+                state.current_suit = DECKOFCARDS[deck[2 * HAND_SIZE]][0]
+        elif state.cards is None:
+            raise ReplayError('Move %d made before the deal' % index)
+        elif action == PLAY:
+            try:
+                state.cards.hand(user_one_turn).remove(card_number)
+            except ValueError:
+                raise ReplayError('Move %d plays a card not in hand' % index)
+            state.cards.discard_pile.push(card_number)
+            state.current_suit = suit
+            state.user_one_turn = not user_one_turn
+        elif action == DRAW:
+            if (not state.cards.undrawn_cards or
+                    state.cards.undrawn_cards.pop() != card_number):
+                raise ReplayError('Move %d draws a card not on top' % index)
+            state.cards.hand(user_one_turn).add(card_number)
+        elif action == RESHUFFLE:
+            if state.cards.discard_pile.top() != card_number:
+                raise ReplayError('Move %d reshuffles the top card' % index)
+            state.cards.discard_pile = CardPile([card_number])
+            state.cards.undrawn_cards = CardPile()
+        elif action == DECK:
+            state.cards.undrawn_cards.cards.append(card_number)
+        elif action == PASS:
+            state.user_one_turn = not user_one_turn
+        else:
+            raise ReplayError('Move %d has unknown action' % index)
+        state.moves = index + 1
+    return state
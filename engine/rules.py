@@ -0,0 +1,191 @@
+"""engine/rules.py - This file contains CrazyEights, the rules engine of a
+game of crazy eights.  It owns dealing, legal plays, drawing and
+reshuffling, the computer strategy and win detection, and records every move
+in the move log record format of replay.py.  It holds no datastore state, so
+games can be played and timed without App Engine; the Game model and the
+endpoints adapt it to the datastore."""
+
+__copyright__ = """
+    Copyright 2016 Christine Stoner
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import random
+
+from .cards import CARD_SUITS, CRAZY_MASK, CRAZY_VALUE, DECKOFCARDS
+from .cards import DECK_SEED_BITS, HAND_SIZE, SUIT_MASKS
+from .cards import GameCards, deck_order, highest_card, is_legal_play
+from .cards import legal_plays
+from .cards import suits_by_count
+from .replay import DEAL, PLAY, DRAW, RESHUFFLE, DECK, PASS, encode_move
+
+
+class IllegalMove(Exception):
+    """Raised when a move breaks the rules, holding the message shown to
+       the player
+    """
+
+
+def choose_play(hand_mask, top_card, current_suit):
+    """computer strategy selecting the card to play from a hand: the
+       highest playable card of the most common suit held, excluding
+       eights, or else the highest playable eight choosing the most common
+       suit.  Returns (card number, suit) or None if no card can be played
+    """
+    playable = hand_mask & legal_plays(top_card, current_suit)
+    if not playable:
+        return None
+    suits = suits_by_count(hand_mask)
+    for suit in suits:
+        suit_cards = playable & SUIT_MASKS[suit] & ~CRAZY_MASK
+        if suit_cards:
+            return highest_card(suit_cards), suit
+    return highest_card(playable & CRAZY_MASK), suits[0]
+
+
+class CrazyEights(object):
+    """State and rules of one game of crazy eights
+    Attributes:
+        cards: GameCards holding hands and piles
+        current_suit: lower case current suit of game
+        user_one_turn: boolean indicating if user one turn
+        game_over: boolean indicating if a player has won
+        winner: True if user one won, False if user two won, None if no
+                player has won
+        moves: move log records of the moves made since the engine was
+               created or the records were last taken
+        rng: random number generator drawing the deck seed of a deal and
+             shuffling unseeded cards
+    """
+    __slots__ = ('cards', 'current_suit', 'user_one_turn', 'game_over',
+                 'winner', 'moves', 'rng')
+
+    def __init__(self, cards, current_suit, user_one_turn=True,
+                 game_over=False, rng=random):
+        self.cards = cards
+        self.current_suit = current_suit
+        self.user_one_turn = user_one_turn
+        self.game_over = game_over
+        self.winner = None
+        self.moves = []
+        self.rng = rng
+
+    @classmethod
+    def deal(cls, rng=random, seed=None):
+        """create a game from the deck ordered by deck seed, drawn from rng
+           if not given, recording the deck as the deal
+        """
+        if seed is None:
+            seed = rng.getrandbits(DECK_SEED_BITS)
+        deck = deck_order(seed)
+        game = cls(GameCards.deal(deck, seed),
+                   DECKOFCARDS[deck[2 * HAND_SIZE]][0], rng=rng)
+        for card_number in deck:
+            game.record(DEAL, True, card_number)
+        return game
+
+    def record(self, action, user_one_turn, card_number=0):
+        """append move log record of a move to moves"""
+        self.moves.append(encode_move(action, user_one_turn, card_number,
+                                      self.current_suit))
+
+    def hand(self):
+        """return hand of the player whose turn it is"""
+        return self.cards.hand(self.user_one_turn)
+
+    def top_card(self):
+        """return card number on top of the discard pile"""
+        return self.cards.discard_pile.top()
+
+    def playable(self):
+        """return bitmask of cards the player whose turn it is can play"""
+        return self.hand().mask & legal_plays(self.top_card(),
+                                              self.current_suit)
+
+    def play(self, card_number, crazy_suit=None):
+        """discard card number from the hand of the player whose turn it is
+           and change turn, ending the game if it was the last card.
+           crazy_suit is the suit chosen when an eight is played.  Raises
+           IllegalMove if the card cannot be played
+        """
+        if self.game_over:
+            raise IllegalMove('Game already over!')
+        hand = self.hand()
+        if card_number is None or card_number not in hand:
+            raise IllegalMove('That card is not in your hand!')
+        if not is_legal_play(self.top_card(), self.current_suit,
+                             card_number):
+            raise IllegalMove('Card not valid!')
+        suit, value = DECKOFCARDS[card_number]
+        if value == CRAZY_VALUE and crazy_suit:
+            if crazy_suit not in CARD_SUITS:
+                raise IllegalMove('Suit not valid!')
+            suit = crazy_suit
+        hand.remove(card_number)
+        self.cards.discard_pile.push(card_number)
+        self.current_suit = suit
+        self.record(PLAY, self.user_one_turn, card_number)
+        if not hand:
+            self.game_over = True
+            self.winner = self.user_one_turn
+        self.user_one_turn = not self.user_one_turn
+
+    def draw(self):
+        """add top undrawn card to the hand of the player whose turn it is,
+           reshuffling the discard pile if no undrawn cards remain.  Returns
+           the drawn card number, or None if every card is held by the
+           players.  Raises IllegalMove if the game is over
+        """
+        if self.game_over:
+            raise IllegalMove('Game already over!')
+        cards = self.cards
+        if not cards.undrawn_cards:
+            return None
+        drawn_card = cards.undrawn_cards.pop()
+        self.hand().add(drawn_card)
+        self.record(DRAW, self.user_one_turn, drawn_card)
+        # reshuffle cards if last card drawn, leaving top card discarded,
+        # and record the new order of the undrawn cards for replay
+        if not cards.undrawn_cards:
+            cards.reshuffle(self.rng)
+            self.record(RESHUFFLE, self.user_one_turn, self.top_card())
+            for card_number in cards.undrawn_cards:
+                self.record(DECK, self.user_one_turn, card_number)
+        return drawn_card
+
+    def pass_turn(self):
+        """change turn without playing, when no card can be played or
+           drawn
+        """
+        self.record(PASS, self.user_one_turn)
+        self.user_one_turn = not self.user_one_turn
+
+    def take_computer_turn(self, player=None):
+        """play the turn of the player whose turn it is, drawing until the
+           computer player, or the choose_play heuristic if player is None,
+           selects a card to play and passing if no card can be drawn.
+           Returns the card number played, or None if the turn was passed
+        """
+        while True:
+            if player is None:
+                choice = choose_play(self.hand().mask, self.top_card(),
+                                     self.current_suit)
+            else:
+                choice = player.choose_play(self)
+            if choice is not None:
+                break
+            if self.draw() is None:
+                self.pass_turn()
+                return None
+        card_number, suit = choice
+        self.play(card_number, suit)
+        return card_number
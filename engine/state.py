@@ -0,0 +1,95 @@
+"""engine/state.py - This file contains the versioned binary codec of the
+card state of a game, stored by the Game model as one blob so that a
+request decodes its hands and piles once, from a few dozen bytes, instead of
+parsing comma separated strings.  Every blob starts with its format version
+and is decoded by the decoder of that version, so older blobs stay readable
+after the format changes.  Version 1, little-endian:
+
+    B        format version, 1
+    B        flags, bit 0 set if the deck is seeded
+    Q Q      bitmasks of the hands of player one and player two
+    Q I      deck seed and reshuffle count, only if the deck is seeded
+    B        number of discarded cards, followed by one byte per card,
+             top card first
+             one byte per undrawn card, top card first, only if the deck
+             is not seeded"""
+
+__copyright__ = """
+    Copyright 2016 Christine Stoner
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import struct
+
+from .cards import CardPile, CardSet, GameCards
+
+# format version written by encode_cards
+STATE_VERSION = 1
+# flag set when the undrawn cards are derived from a deck seed
+SEEDED = 1
+# version, flags and hand masks
+_HEADER = struct.Struct('<BBQQ')
+# deck seed and reshuffle count of seeded decks
+_SEED = struct.Struct('<QI')
+
+
+class StateError(Exception):
+    """Raised when a blob is not a card state this version can decode"""
+
+
+def encode_cards(cards):
+    """return GameCards encoded as a blob of the current format version"""
+    seeded = cards.seed is not None
+    parts = [_HEADER.pack(STATE_VERSION, SEEDED if seeded else 0,
+                          cards.hands[0].mask, cards.hands[1].mask)]
+    if seeded:
+        parts.append(_SEED.pack(cards.seed, cards.reshuffles))
+    parts.append(bytes(bytearray([len(cards.discard_pile)] +
+                                 list(cards.discard_pile))))
+    if not seeded:
+        parts.append(bytes(bytearray(cards.undrawn_cards)))
+    return b''.join(parts)
+
+
+def _decode_v1(blob):
+    """return GameCards of a version 1 blob"""
+    _, flags, hand_one, hand_two = _HEADER.unpack_from(blob)
+    offset = _HEADER.size
+    hands = [CardSet.from_mask(hand_one), CardSet.from_mask(hand_two)]
+    if flags & SEEDED:
+        seed, reshuffles = _SEED.unpack_from(blob, offset)
+        offset += _SEED.size
+    piles = bytearray(blob[offset:])
+    discard_pile = CardPile(piles[1:piles[0] + 1])
+    if flags & SEEDED:
+        return GameCards.seeded(hands, discard_pile, seed, reshuffles)
+    return GameCards(hands, discard_pile, CardPile(piles[piles[0] + 1:]))
+
+
+# decoder of each format version
+DECODERS = {1: _decode_v1}
+
+
+def decode_cards(blob):
+    """return GameCards of a blob of any known format version.  Raises
+       StateError if the version is unknown or the blob is truncated
+    """
+    if not blob:
+        raise StateError('Empty card state')
+    version = bytearray(blob[:1])[0]
+    decoder = DECODERS.get(version)
+    if decoder is None:
+        raise StateError('Unknown card state version %d' % version)
+    try:
+        return decoder(blob)
+    except (struct.error, IndexError):
+        raise StateError('Truncated card state of version %d' % version)
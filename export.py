@@ -0,0 +1,331 @@
+"""export.py - Bulk export of Scores, Games, archived games and move logs
+for offline analysis.  A kind is walked in key order in cursor batches;
+each batch is formatted as newline delimited JSON or CSV and written as one
+ExportChunk in the same transaction that checkpoints the cursor of its
+ExportShard, so an export holds one batch in memory, survives task retries
+and resumes from the last checkpoint.  With more than one shard the
+keyspace is split at sampled __scatter__ keys and the shards are exported
+by parallel task chains; shards and chunks are root entities, so the
+chains do not contend on one entity group.  Started and read by admins
+through the handlers in main.py, and deleted by a daily cron of main.py
+once they are two weeks old."""
+
+import csv
+import json
+import logging
+from collections import OrderedDict
+from datetime import date
+from io import BytesIO
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from engine.cards import DECKOFCARDS
+from engine.replay import PASS, RECORD_NAMES, decode_move
+from models import Game, MoveLog, Score, ExportRun, ExportShard, ExportChunk
+from models import ArchivedGame
+
+# number of entities read by each export batch task
+EXPORT_BATCH_SIZE = 500
+# most shards an export can be split into
+MAX_EXPORT_SHARDS = 64
+# __scatter__ keys sampled per shard when splitting the keyspace
+SCATTER_OVERSAMPLE = 32
+# output formats and their content types
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def _value(value):
+    """returns JSON value of an entity property value"""
+    if isinstance(value, ndb.Key):
+        return value.urlsafe()
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def score_rows(score):
+    """yields the export row of a Score"""
+    yield OrderedDict([
+        ('key', score.key),
+        ('date', score.date),
+        ('winning_user', score.winning_user),
+        ('winning_user_name', score.winning_user_name),
+        ('losing_user', score.losing_user),
+        ('losing_user_name', score.losing_user_name)])
+
+
+def game_rows(game):
+    """yields the export row of a Game, without its cards"""
+    yield OrderedDict([
+        ('key', game.key),
+        ('date', game.date),
+        ('user_one', game.user_one),
+        ('user_one_name', game.user_one_name),
+        ('user_two', game.user_two),
+        ('user_two_name', game.user_two_name),
+        ('user_one_turn', game.user_one_turn),
+        ('game_over', game.game_over),
+        ('cancelled', game.cancelled),
+        ('current_suit', game.current_suit),
+        ('difficulty', game.difficulty),
+        ('move_count', game.move_count or len(game.move)),
+        ('version', game.version)])
+
+
+def archived_game_rows(archived):
+    """yields the export row of an ArchivedGame"""
+    yield OrderedDict([
+        ('key', archived.game),
+        ('date', archived.date),
+        ('user_one', archived.user_one),
+        ('user_one_name', archived.user_one_name),
+        ('user_two', archived.user_two),
+        ('user_two_name', archived.user_two_name),
+        ('winner', archived.winner),
+        ('cancelled', archived.cancelled),
+        ('move_count', archived.move_count or len(archived.move)),
+        ('archived', archived.archived)])
+
+
+def move_rows(log):
+    """yields an export row for each record of a MoveLog.  suit is the
+       current suit after the move, the suit named by a played eight; a
+       pass has no card
+    """
+    game_key = log.key.parent()
+    for index, record in enumerate(log.records(), log.first):
+        action, user_one_turn, card_number, suit = decode_move(record)
+        if action == PASS:
+            card_number = card_suit = card_value = None
+        else:
+            card_suit, card_value = DECKOFCARDS[card_number]
+        yield OrderedDict([
+            ('game', game_key),
+            ('index', index),
+            ('action', RECORD_NAMES[action]),
+            ('user_one', user_one_turn),
+            ('card', card_number),
+            ('card_suit', card_suit),
+            ('card_value', card_value),
+            ('suit', suit)])
+
+
+# exported kinds: (model, export row fields, row generator)
+EXPORT_KINDS = {
+    'scores': (Score, ('key', 'date', 'winning_user', 'winning_user_name',
+                       'losing_user', 'losing_user_name'), score_rows),
+    'games': (Game, ('key', 'date', 'user_one', 'user_one_name',
+                     'user_two', 'user_two_name', 'user_one_turn',
+                     'game_over', 'cancelled', 'current_suit', 'difficulty',
+                     'move_count', 'version'), game_rows),
+    'archived_games': (ArchivedGame, ('key', 'date', 'user_one',
+                                      'user_one_name', 'user_two',
+                                      'user_two_name', 'winner', 'cancelled',
+                                      'move_count', 'archived'),
+                       archived_game_rows),
+    'moves': (MoveLog, ('game', 'index', 'action', 'user_one', 'card',
+                        'card_suit', 'card_value', 'suit'), move_rows)}
+
+
+def iter_batches(query, batch_size, cursor=None):
+    """yields (entities, next_cursor, more) for each batch of query from
+       cursor, holding one batch in memory at a time
+    """
+    while True:
+        entities, next_cursor, more = query.fetch_page(
+            batch_size, start_cursor=cursor)
+        yield entities, next_cursor, more
+        if not (more and next_cursor):
+            return
+        cursor = next_cursor
+
+
+def format_rows(rows, export_format, header=None):
+    """returns rows as newline delimited JSON or CSV bytes, starting with
+       the CSV header row of fields header if given
+    """
+    output = BytesIO()
+    if export_format == 'csv':
+        writer = csv.writer(output)
+        if header:
+            writer.writerow(header)
+        for row in rows:
+            writer.writerow([_csv_value(value) for value in row.values()])
+    else:
+        for row in rows:
+            output.write(json.dumps(
+                OrderedDict((field, _value(value))
+                            for field, value in row.items()),
+                separators=(',', ':')))
+            output.write('\n')
+    return output.getvalue()
+
+
+def _csv_value(value):
+    """returns CSV cell of an entity property value"""
+    value = _value(value)
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def split_keys(model, shards):
+    """returns up to shards - 1 keys splitting the keys of model into
+       ranges of about the same size, from a sample of __scatter__ keys.
+       Fewer keys are returned if the kind is too small to sample
+    """
+    if shards < 2:
+        return []
+    sample = model.query().order(ndb.GenericProperty('__scatter__')).fetch(
+        shards * SCATTER_OVERSAMPLE, keys_only=True)
+    sample.sort()
+    if len(sample) < shards:
+        return []
+    step = len(sample) / float(shards)
+    return sorted(set(sample[int(step * shard)]
+                      for shard in range(1, shards)))
+
+
+def start_export(kind, export_format, shards=1, cursor=None):
+    """Create an ExportRun of kind and queue the first batch of each of
+       its shards.  cursor resumes a single shard export from a cursor of
+       an earlier one.  Returns the run
+    """
+    model = EXPORT_KINDS[kind][0]
+    bounds = [None] + split_keys(model, min(shards, MAX_EXPORT_SHARDS)) + \
+        [None]
+    run = ExportRun(kind=kind, format=export_format, shards=len(bounds) - 1,
+                    date=date.today())
+    run.put()
+    export_shards = [ExportShard(key=shard_key, run_id=run.key.id(),
+                                 number=number + 1,
+                                 lower=bounds[number],
+                                 upper=bounds[number + 1],
+                                 cursor=cursor if run.shards == 1 else None)
+                     for number, shard_key in enumerate(run.shard_keys())]
+    ndb.put_multi(export_shards)
+    for shard in export_shards:
+        queue_export_batch(shard)
+    logging.info('Export %s of %s started with %d shards', run.key.id(),
+                 kind, run.shards)
+    return run
+
+
+def resume_export(run):
+    """queue the next batch of each unfinished shard of run, restarting an
+       export whose task chain was dropped
+    """
+    for shard in ndb.get_multi(run.shard_keys()):
+        if shard and not shard.done:
+            queue_export_batch(shard)
+
+
+def queue_export_batch(shard):
+    """Queue the task exporting the next batch of shard.  Tasks are named
+       after the shard and batch so a batch is never queued twice"""
+    try:
+        taskqueue.add(url='/tasks/export_batch',
+                      name='export-{}-{}-{}'.format(shard.run_id,
+                                                    shard.number,
+                                                    shard.batches),
+                      params={'run_id': shard.run_id,
+                              'shard': shard.number,
+                              'batch': shard.batches})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info('Export batch %d of shard %d of run %s already queued',
+                     shard.batches, shard.number, shard.run_id)
+
+
+def export_batch(run, shard_key, batch):
+    """Export batch of a shard of run as an ExportChunk and checkpoint the
+       shard, then queue its next batch, or the task recording the shard
+       done if it was the last.  A retried task of a batch that was
+       already written queues the next batch again
+    """
+    shard = shard_key.get()
+    if shard.done or batch > shard.batches:
+        return
+    if batch < shard.batches:
+        if batch == shard.batches - 1:
+            queue_export_batch(shard)
+        return
+    model, fields, rows = EXPORT_KINDS[run.kind]
+    query = model.query()
+    if shard.lower:
+        query = query.filter(model.key >= shard.lower)
+    if shard.upper:
+        query = query.filter(model.key < shard.upper)
+    query = query.order(model.key)
+    cursor = Cursor(urlsafe=shard.cursor) if shard.cursor else None
+    entities, next_cursor, more = next(iter_batches(query, EXPORT_BATCH_SIZE,
+                                                    cursor))
+    batch_rows = [row for entity in entities for row in rows(entity)]
+    header = fields if shard.number == 1 and batch == 0 else None
+    chunk = ExportChunk(key=ExportChunk.key_for(shard.key, batch),
+                        data=format_rows(batch_rows, run.format, header))
+    shard.cursor = next_cursor.urlsafe() if next_cursor else None
+    shard.batches += 1
+    shard.rows += len(batch_rows)
+    shard.done = not (more and next_cursor)
+
+    @ndb.transactional(xg=True)
+    def checkpoint():
+        stored = shard.key.get()
+        if stored.batches != batch:
+            return False
+        ndb.put_multi([chunk, shard])
+        if shard.done:
+            taskqueue.add(url='/tasks/export_shard_done',
+                          params={'run_id': shard.run_id},
+                          transactional=True)
+        return True
+    if checkpoint() and not shard.done:
+        queue_export_batch(shard)
+
+
+def record_shards_done(run):
+    """Count the finished shards of run and save the count on the run,
+       marking it done once every shard is.  Run by the task each shard
+       queues when it finishes, so checkpoints never write the run; the
+       count only grows, so the tasks of shards finishing together may run
+       in any order
+    """
+    finished = sum(1 for shard in ndb.get_multi(run.shard_keys())
+                   if shard and shard.done)
+
+    @ndb.transactional
+    def update():
+        stored = run.key.get()
+        if finished > stored.shards_done:
+            stored.shards_done = finished
+            stored.done = finished == stored.shards
+            stored.put()
+    update()
+
+
+def delete_export(run):
+    """Delete the ExportChunks and ExportShards of run, then the run.
+       The run goes last so a retried task finds the shards again
+    """
+    shards = [shard for shard in ndb.get_multi(run.shard_keys()) if shard]
+    for shard in shards:
+        ndb.delete_multi([ExportChunk.key_for(shard.key, batch)
+                          for batch in range(shard.batches)])
+    ndb.delete_multi([shard.key for shard in shards])
+    run.key.delete()
+    logging.info('Export %s of %s deleted', run.key.id(), run.kind)
+
+
+def iter_export(run, shard_number, start=0):
+    """yields (batch number, data) of the ExportChunks of a shard of run
+       from batch start, reading one chunk at a time
+    """
+    shard = ExportShard.key_for(run.key.id(), shard_number).get()
+    if shard is None:
+        return
+    for batch in range(start, shard.batches):
+        chunk = ExportChunk.key_for(shard.key, batch).get()
+        yield batch, chunk.data
@@ -0,0 +1,231 @@
+"""game_cache.py - Read-through, write-through memcache cache of game state.
+Each Game is cached under its urlsafe key as its version, the serialized
+entity and its rendered GameForm, so polling a game is served without a
+datastore get or user lookups.  Mutations write the new state with
+compare-and-set after they commit, never replacing a newer version, and
+reads fall back to the datastore when the entry is missing or evicted.
+The version of each cached game is also kept under its own small key, so
+requests waiting for a game to change poll a few bytes of memcache rather
+than the entity.  The memcache client is injectable; LocalMemcache is an
+in-process stand-in with the same interface for local runs and tests."""
+
+import logging
+import threading
+import time
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+from protorpc import protojson
+
+from models import Game, GameForm
+from utils import get_by_urlsafe
+
+# prefix of the memcache keys of cached games
+GAME_CACHE_PREFIX = 'game:'
+# prefix of the memcache keys of the versions of cached games
+GAME_VERSION_PREFIX = 'game_version:'
+# seconds a cached game is kept after it was last written
+GAME_CACHE_SECONDS = 60 * 60
+# number of times a compare-and-set is retried before the entry is dropped
+CAS_ATTEMPTS = 3
+# seconds between version checks of a request waiting for a game to change
+WAIT_POLL_SECONDS = 0.5
+
+
+class LocalMemcache(object):
+    """In-process stand-in for memcache.Client holding entries in a dict.
+    Supports the calls GameCache and UserCache make; expiry times are
+    ignored"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._cas_ids = {}
+        self._next_cas_id = 0
+
+    def _store(self, key, value):
+        self._next_cas_id += 1
+        self._entries[key] = (value, self._next_cas_id)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry else None
+
+    def gets(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            self._cas_ids[key] = entry[1]
+            return entry[0]
+
+    def add(self, key, value, time=0):
+        with self._lock:
+            if key in self._entries:
+                return False
+            self._store(key, value)
+            return True
+
+    def set(self, key, value, time=0):
+        with self._lock:
+            self._store(key, value)
+            return True
+
+    def cas(self, key, value, time=0):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or self._cas_ids.pop(key, None) != entry[1]:
+                return False
+            self._store(key, value)
+            return True
+
+    def incr(self, key, delta=1, initial_value=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if initial_value is None:
+                    return None
+                value = initial_value + delta
+            else:
+                value = entry[0] + delta
+            self._store(key, value)
+            return value
+
+    def delete_multi(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+            return True
+
+
+class GameCache(object):
+    """Cache of the state of games, keyed by urlsafe Game key
+    Attributes:
+        client: memcache.Client, or a stand-in such as LocalMemcache.  A
+                client remembers the compare-and-set ids of its gets, so
+                each request uses its own GameCache
+    """
+
+    def __init__(self, client=None):
+        self.client = client or memcache.Client()
+
+    @staticmethod
+    def cache_key(urlsafe):
+        """returns memcache key of the game the urlsafe key points to"""
+        return GAME_CACHE_PREFIX + urlsafe
+
+    @staticmethod
+    def version_key(urlsafe):
+        """returns memcache key of the version of the game the urlsafe key
+           points to
+        """
+        return GAME_VERSION_PREFIX + urlsafe
+
+    @staticmethod
+    def _entry(game):
+        """returns cache entry of game: (version, serialized game,
+           serialized GameForm)
+        """
+        return (game.version,
+                ndb.model_to_protobuf(game).Encode(),
+                protojson.encode_message(game.to_form()))
+
+    def _load(self, urlsafe):
+        """returns cache entry of the game the urlsafe key points to,
+           reading the game from the datastore and adding it to the cache
+           on a miss.  Returns None if the game does not exist
+        """
+        entry = self.client.get(self.cache_key(urlsafe))
+        if entry is not None:
+            return entry
+        game = get_by_urlsafe(urlsafe, Game)
+        if not game:
+            return None
+        entry = self._entry(game)
+        self.client.add(self.cache_key(urlsafe), entry,
+                        time=GAME_CACHE_SECONDS)
+        self.client.add(self.version_key(urlsafe), entry[0],
+                        time=GAME_CACHE_SECONDS)
+        return entry
+
+    def get_game(self, urlsafe):
+        """returns the Game the urlsafe key points to, or None"""
+        entry = self._load(urlsafe)
+        if entry is None:
+            return None
+        return ndb.model_from_protobuf(entity_pb.EntityProto(entry[1]))
+
+    def get_form(self, urlsafe):
+        """returns GameForm of the game the urlsafe key points to, or None.
+           Its message is the game message from computer play, if any
+        """
+        entry = self._load(urlsafe)
+        if entry is None:
+            return None
+        return protojson.decode_message(GameForm, entry[2])
+
+    def version(self, urlsafe):
+        """returns version of the game the urlsafe key points to, reading
+           only its version key unless the game is not cached.  Returns None
+           if the game does not exist
+        """
+        version = self.client.get(self.version_key(urlsafe))
+        if version is not None:
+            return version
+        entry = self._load(urlsafe)
+        return entry[0] if entry else None
+
+    def wait_for_change(self, urlsafe, version, timeout):
+        """waits up to timeout seconds for the version of the game the
+           urlsafe key points to to differ from version, checking its
+           version key every WAIT_POLL_SECONDS.  Returns the last version
+           seen, or None if the game does not exist
+        """
+        deadline = time.time() + timeout
+        while True:
+            current = self.version(urlsafe)
+            if current is None or current != version:
+                return current
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return current
+            time.sleep(min(WAIT_POLL_SECONDS, remaining))
+
+    def put(self, game):
+        """writes the state and version of a committed game to the cache,
+           unless the cache holds the same or a newer version.  Drops the
+           entry if concurrent writers keep changing it
+        """
+        cache_key = self.cache_key(game.key.urlsafe())
+        entry = self._entry(game)
+        for _ in range(CAS_ATTEMPTS):
+            cached = self.client.gets(cache_key)
+            if cached is None:
+                if self.client.add(cache_key, entry,
+                                   time=GAME_CACHE_SECONDS):
+                    break
+            elif cached[0] >= game.version:
+                return
+            elif self.client.cas(cache_key, entry, time=GAME_CACHE_SECONDS):
+                break
+        else:
+            logging.info('Dropping cached game %s after %d conflicts',
+                         game.key.urlsafe(), CAS_ATTEMPTS)
+            self.invalidate(game.key)
+            return
+        # a racing writer may set an older version after this one; waiting
+        # requests wake on any difference and read the entry, which is not
+        # replaced by older versions
+        self.client.set(self.version_key(game.key.urlsafe()), game.version,
+                        time=GAME_CACHE_SECONDS)
+
+    def invalidate(self, *game_keys):
+        """drops the cached state of games written outside mutations, so
+           their next read comes from the datastore
+        """
+        keys = []
+        for game_key in game_keys:
+            keys.append(self.cache_key(game_key.urlsafe()))
+            keys.append(self.version_key(game_key.urlsafe()))
+        self.client.delete_multi(keys)
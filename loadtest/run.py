@@ -0,0 +1,340 @@
+r"""loadtest/run.py - Load test of CrazyEightsApi against the local datastore,
+memcache, task queue and mail service stubs of the App Engine SDK testbed.
+A scenario file sets the number of simulated players and the threads they
+run on; each player creates a user, plays games against "Computer" or a
+second user whose turns it also plays, polling get_game each turn and
+drawing or playing with the greedy strategy of the rules engine, and then
+reads the rankings.  Latency and datastore and memcache RPCs per request
+are taken from the metrics.instrumented decorator of each endpoint.  Run
+from the repository root with the path of the App Engine SDK:
+
+    python loadtest/run.py loadtest/scenarios/smoke.json --sdk ~/appengine
+    python loadtest/run.py loadtest/scenarios/mixed.json \
+        --save-baseline baseline.json
+    python loadtest/run.py loadtest/scenarios/mixed.json \
+        --baseline baseline.json
+
+With --baseline the run exits with status 1 if requests/sec falls, or the
+p95 latency or datastore RPCs of an endpoint rise, more than --tolerance
+past the saved baseline, or if the error rate rises.  Baselines depend on
+the machine and SDK, so save one before a change and compare after it on
+the same machine."""
+
+__copyright__ = """
+    Copyright 2016 Christine Stoner
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# scenario settings used when a scenario file leaves them out
+DEFAULT_SCENARIO = {'name': 'default',
+                    'players': 20,
+                    'threads': 8,
+                    'games_per_player': 2,
+                    'computer_share': 0.5,
+                    'difficulty': 'easy',
+                    'max_turns': 300,
+                    'consistency': 1.0,
+                    'seed': 0}
+# seconds covered by the endpoint histograms, longer than any run
+RUN_WINDOW_SECONDS = 24 * 60 * 60
+# endpoint metrics compared with the baseline
+DATASTORE_METRICS = ('datastore_gets', 'datastore_puts', 'datastore_deletes',
+                     'datastore_queries')
+# datastore RPCs per request an endpoint may rise by regardless of tolerance
+DATASTORE_SLACK = 0.1
+# error rate a run may rise by over the baseline
+ERROR_RATE_SLACK = 0.01
+
+
+def load_sdk(sdk_path):
+    """put the App Engine SDK and its bundled libraries on the path"""
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+def start_services(consistency):
+    """activate testbed service stubs, returning the testbed"""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed as testbed_module
+    testbed = testbed_module.Testbed()
+    testbed.activate()
+    testbed.setup_env(app_id='crazyeights-loadtest', overwrite=True)
+    testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.
+        PseudoRandomHRConsistencyPolicy(probability=consistency))
+    testbed.init_memcache_stub()
+    testbed.init_taskqueue_stub(root_path=ROOT)
+    testbed.init_mail_stub()
+    testbed.init_app_identity_stub()
+    testbed.init_user_stub()
+    testbed.init_urlfetch_stub()
+    return testbed
+
+
+class Client(object):
+    """Calls endpoint methods of a CrazyEightsApi directly, counting the
+    errors and conflicts each endpoint raises
+    Attributes:
+        errors: Counter of endpoint to calls raising an error other than
+                a conflict
+        conflicts: Counter of endpoint to calls raising ConflictException
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.errors = Counter()
+        self.conflicts = Counter()
+
+    def call(self, endpoint, container, **fields):
+        """returns response of endpoint to a request of container holding
+           fields, or None if it raised
+        """
+        import endpoints
+        from google.appengine.ext import ndb
+        request = container.combined_message_class(**fields)
+        try:
+            return getattr(self.api, endpoint)(request)
+        except endpoints.ConflictException:
+            self.conflicts[endpoint] += 1
+        except Exception:
+            logging.debug('%s failed', endpoint, exc_info=True)
+            self.errors[endpoint] += 1
+        finally:
+            # each call is its own request; drop the in-context cache
+            ndb.get_context().clear_cache()
+        return None
+
+
+def play_player(task):
+    """simulate one player, returning (Client, games finished, games
+       abandoned)
+    """
+    from api import CrazyEightsApi, GAME_REQUEST, NEW_GAME_REQUEST
+    from api import PAGE_REQUEST, PLAY_CARD_REQUEST, USER_REQUEST
+    from engine import choose_play
+    from engine.cards import CRAZY_VALUE, DECKOFCARDS
+    number, scenario, run_id = task
+    rng = random.Random(scenario['seed'] * 1000003 + number)
+    client = Client(CrazyEightsApi())
+    name = 'player-%s-%d' % (run_id, number)
+    partner = name + '-b'
+    for user_name in (name, partner):
+        client.call('create_user', USER_REQUEST, user_name=user_name,
+                    email=user_name + '@example.com')
+    finished = abandoned = 0
+    for _ in range(scenario['games_per_player']):
+        opponent = ('Computer' if rng.random() < scenario['computer_share']
+                    else partner)
+        form = client.call('new_game', NEW_GAME_REQUEST,
+                           user_one_name=name, user_two_name=opponent,
+                           difficulty=scenario['difficulty'])
+        if form is None:
+            continue
+        game_key = form.urlsafe_key
+        for _ in range(scenario['max_turns']):
+            form = client.call('get_game', GAME_REQUEST,
+                               urlsafe_game_key=game_key, compact=True)
+            if form is None or form.game_over:
+                break
+            hand = (form.player_one_cards if form.user_one_turn
+                    else form.player_two_cards)
+            choice = choose_play(sum(1 << card for card in hand),
+                                 form.top_card, form.current_suit)
+            if choice is None:
+                form = client.call('draw_card', GAME_REQUEST,
+                                   urlsafe_game_key=game_key, compact=True)
+                if form and form.message == 'No cards left to draw!':
+                    break
+            else:
+                card_suit, card_number = DECKOFCARDS[choice[0]]
+                client.call('play_card', PLAY_CARD_REQUEST,
+                            urlsafe_game_key=game_key,
+                            card_number=card_number, card_suit=card_suit,
+                            crazy_suit=(choice[1]
+                                        if card_number == CRAZY_VALUE
+                                        else None),
+                            compact=True)
+        if form is not None and form.game_over:
+            finished += 1
+        else:
+            abandoned += 1
+    client.call('get_all_rankings', PAGE_REQUEST, limit=10)
+    return client, finished, abandoned
+
+
+def run(scenario):
+    """run scenario against fresh service stubs and return report dict"""
+    testbed = start_services(scenario['consistency'])
+    try:
+        import metrics
+        from api import CrazyEightsApi, USER_REQUEST
+        metrics.install_rpc_hooks()
+        metrics.ENDPOINT_METRICS = metrics.EndpointMetrics(
+            RUN_WINDOW_SECONDS)
+        Client(CrazyEightsApi()).call('create_user', USER_REQUEST,
+                                      user_name='Computer',
+                                      email='computer@example.com')
+        run_id = int(time.time())
+        tasks = [(number, scenario, run_id)
+                 for number in range(scenario['players'])]
+        pool = ThreadPool(scenario['threads'])
+        try:
+            started = time.time()
+            results = pool.map(play_player, tasks)
+            elapsed = time.time() - started
+        finally:
+            pool.close()
+            pool.join()
+        queued = len(testbed.get_stub(
+            'taskqueue').get_filtered_tasks())
+        summary = metrics.ENDPOINT_METRICS.summary()
+    finally:
+        testbed.deactivate()
+
+    errors = Counter()
+    conflicts = Counter()
+    for client, _, _ in results:
+        errors.update(client.errors)
+        conflicts.update(client.conflicts)
+    endpoints_report = {}
+    for endpoint, endpoint_metrics in summary.items():
+        if not all(metric in endpoint_metrics for metric in metrics.METRICS):
+            # long polls are not endpoint latency
+            continue
+        latency = endpoint_metrics['latency_ms']
+        endpoints_report[endpoint] = dict(
+            [('calls', latency['count']),
+             ('errors', errors[endpoint]),
+             ('conflicts', conflicts[endpoint])] +
+            [('%s_ms' % percent, latency.get(percent, 0.0))
+             for percent in ('p50', 'p95', 'p99')] +
+            [(metric, endpoint_metrics[metric].get('mean', 0.0))
+             for metric in DATASTORE_METRICS +
+             ('memcache_hits', 'memcache_misses')])
+    requests = sum(report['calls'] for report in endpoints_report.values())
+    return {'scenario': scenario['name'],
+            'players': scenario['players'],
+            'threads': scenario['threads'],
+            'seconds': elapsed,
+            'requests': requests,
+            'requests_per_sec': requests / elapsed,
+            'games': sum(result[1] for result in results),
+            'abandoned': sum(result[2] for result in results),
+            'tasks_queued': queued,
+            'error_rate': sum(errors.values()) / float(requests or 1),
+            'conflict_rate': sum(conflicts.values()) / float(requests or 1),
+            'endpoints': endpoints_report}
+
+
+def regressions(report, baseline, tolerance):
+    """returns list of messages describing how report regressed from
+       baseline
+    """
+    failures = []
+    floor = baseline['requests_per_sec'] * (1 - tolerance)
+    if report['requests_per_sec'] < floor:
+        failures.append('%.0f requests/sec is below baseline %.0f'
+                        % (report['requests_per_sec'],
+                           baseline['requests_per_sec']))
+    if report['error_rate'] > baseline['error_rate'] + ERROR_RATE_SLACK:
+        failures.append('error rate %.3f is above baseline %.3f'
+                        % (report['error_rate'], baseline['error_rate']))
+    for endpoint, expected in sorted(baseline['endpoints'].items()):
+        actual = report['endpoints'].get(endpoint)
+        if not actual:
+            continue
+        if actual['p95_ms'] > expected['p95_ms'] * (1 + tolerance):
+            failures.append('%s p95 %.1fms is above baseline %.1fms'
+                            % (endpoint, actual['p95_ms'],
+                               expected['p95_ms']))
+        for metric in DATASTORE_METRICS:
+            if metric not in expected:
+                # baseline saved before the metric was counted
+                continue
+            limit = expected[metric] * (1 + tolerance) + DATASTORE_SLACK
+            if actual[metric] > limit:
+                failures.append('%s %s %.2f/request is above baseline %.2f'
+                                % (endpoint, metric, actual[metric],
+                                   expected[metric]))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenario', help='scenario JSON file')
+    parser.add_argument('--sdk', default=os.environ.get('GAE_SDK'),
+                        help='path of the App Engine SDK (default $GAE_SDK)')
+    parser.add_argument('--baseline',
+                        help='fail if worse than report saved in file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fraction past baseline')
+    parser.add_argument('--save-baseline',
+                        help='save report to file as the new baseline')
+    args = parser.parse_args(argv)
+
+    scenario = dict(DEFAULT_SCENARIO)
+    with open(args.scenario) as scenario_file:
+        scenario.update(json.load(scenario_file))
+    load_sdk(args.sdk)
+    logging.getLogger().setLevel(logging.WARNING)
+    report = run(scenario)
+
+    print('%(scenario)s: %(requests)d requests from %(players)d players on '
+          '%(threads)d threads in %(seconds).2fs, %(requests_per_sec).0f '
+          'requests/sec' % report)
+    print('%(games)d games finished, %(abandoned)d abandoned, '
+          '%(tasks_queued)d tasks queued' % report)
+    print('error rate %.2f%%, conflict rate %.2f%%'
+          % (report['error_rate'] * 100, report['conflict_rate'] * 100))
+    print('%-18s %7s %8s %8s %8s %6s %6s %6s %6s %6s %6s'
+          % ('endpoint', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'gets',
+             'puts', 'dels', 'query', 'mc hit', 'errors'))
+    for endpoint, result in sorted(report['endpoints'].items()):
+        print('%-18s %7d %8.1f %8.1f %8.1f %6.2f %6.2f %6.2f %6.2f %6.2f %6d'
+              % (endpoint, result['calls'], result['p50_ms'],
+                 result['p95_ms'], result['p99_ms'],
+                 result['datastore_gets'], result['datastore_puts'],
+                 result['datastore_deletes'], result['datastore_queries'],
+                 result['memcache_hits'],
+                 result['errors'] + result['conflicts']))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        failures = regressions(report, baseline, args.tolerance)
+        for failure in failures:
+            print('FAIL: ' + failure)
+        if failures:
+            return 1
+        print('OK: within %d%% of baseline' % (args.tolerance * 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,30 +1,100 @@
 #!/usr/bin/env python
 
-"""main.py - This file contains handlers that are called by cronjobs."""
+"""main.py - This file contains handlers that are called by cronjobs
+and task queues."""
+import json
 import logging
 import webapp2
-from google.appengine.api import mail, app_identity
+from datetime import date, datetime, timedelta
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from api import CrazyEightsApi
-from models import User, Game
+from game_cache import GameCache
+from metrics import ENDPOINT_METRICS
+from user_cache import USER_CACHE
+from models import User, Game, Score, UserStats, UserStatsShard
+from models import ReminderRun, ReminderSent, ExportRun, ExportShard
+from models import ScoreRollup, ArchivedGame, UserMigration
+from models import first_daily_day
+from export import EXPORT_FORMATS, EXPORT_KINDS
+from export import delete_export, export_batch, iter_export
+from export import record_shards_done, resume_export, start_export
+
+# number of active games read by each send reminder batch task
+REMINDER_BATCH_SIZE = 100
+
+# number of users recounted by each rebuild user stats task
+REBUILD_BATCH_SIZE = 50
+# number of users given name and email markers by each migrate users task
+MIGRATE_BATCH_SIZE = 50
+# number of games given a state blob by each migrate game state task
+MIGRATE_GAME_BATCH_SIZE = 100
+# number of games or scores given participants by each backfill task
+BACKFILL_BATCH_SIZE = 100
+# models given participants by the backfill, in phase order
+BACKFILL_MODELS = (Game, Score)
+# bytes of export output returned by each download request
+EXPORT_DOWNLOAD_BYTES = 16 * 1024 * 1024
+# days an export run and its output are kept before they are deleted
+EXPORT_KEEP_DAYS = 14
+# days after a finished game was created that it is archived
+ARCHIVE_AFTER_DAYS = 30
+# number of finished games archived by each archive games task
+ARCHIVE_BATCH_SIZE = 100
+# number of entities renamed by each propagate user name task
+RENAME_BATCH_SIZE = 100
+# (model, user key property, user name property) of each denormalized name
+USER_NAME_REFERENCES = [(model, key_property, name_property)
+                        for model in (Game, Score, ArchivedGame)
+                        for key_property, name_property
+                        in model.USER_NAME_PROPERTIES]
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        games = Game.query(Game.game_over == False)
-        users = User.query()
+        """Start the reminder run of the day, which sends a reminder email
+        to each User with an active game one batch of games per task.
+        Called every monday using a cron job; a repeated call on the same
+        day resumes the existing run"""
+        run = ReminderRun.get_or_insert(date.today().isoformat())
+        if not run.done:
+            queue_reminder_batch(run)
+
 
-        user_keys = []
+class SendReminderBatch(webapp2.RequestHandler):
+    def post(self):
+        """Send reminder emails to the players of one batch of active games
+        that have not been reminded in this run, then checkpoint the query
+        cursor and queue the next batch"""
+        run = ReminderRun.get_by_id(self.request.get('run_id'))
+        if run is None or run.done:
+            return
+        batch = int(self.request.get('batch'))
+        if batch != run.batches:
+            # a retried task for a batch that has already been checkpointed
+            return
+        games, next_cursor, more = Game.query(Game.game_over == False) \
+            .fetch_page(REMINDER_BATCH_SIZE,
+                        projection=[Game.user_one, Game.user_two],
+                        start_cursor=Cursor(urlsafe=run.cursor)
+                        if run.cursor else None)
+
+        user_keys = set()
         for game in games:
-            if game.user_one not in user_keys:
-                user_keys.append(game.user_one)
-            if game.user_two not in user_keys:
-                user_keys.append(game.user_two)
+            user_keys.add(game.user_one)
+            user_keys.add(game.user_two)
+        user_keys = list(user_keys)
+        marker_keys = [ReminderSent.key_for(run.key, user_key)
+                       for user_key in user_keys]
+        reminded = ndb.get_multi(marker_keys)
+        user_keys = [user_key for user_key, marker
+                     in zip(user_keys, reminded) if marker is None]
 
-        for user in users:
-            if user.key in user_keys:
+        app_id = app_identity.get_application_id()
+        sent = []
+        for user_key, user in zip(user_keys, ndb.get_multi(user_keys)):
+            if user and user.email:
                 subject = 'This is a reminder!'
                 body = ('Hello {}, you still have an'
                         ' active Crazy Eights Game!').format(user.name)
@@ -34,8 +104,384 @@ class SendReminderEmail(webapp2.RequestHandler):
                                user.email,
                                subject,
                                body)
+            sent.append(ReminderSent(key=ReminderSent.key_for(run.key,
+                                                              user_key)))
+        ndb.put_multi(sent)
+
+        run.batches += 1
+        run.sent += len(sent)
+        run.cursor = next_cursor.urlsafe() if next_cursor else None
+        run.done = not more
+        run.put()
+        if not run.done:
+            queue_reminder_batch(run)
+
+
+class EndpointMetricsReport(webapp2.RequestHandler):
+    def get(self):
+        """Return JSON of the count, p50, p95, p99 and maximum of the
+        latency in milliseconds and of the datastore and memcache RPCs of
+        the calls of each endpoint in the last five minutes, as recorded
+        by the instance serving this request, with the entries, hits and
+        misses of its user cache under user_cache"""
+        report = ENDPOINT_METRICS.summary()
+        report['user_cache'] = USER_CACHE.stats()
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(report, indent=2, sort_keys=True))
+
+
+def queue_reminder_batch(run):
+    """Queue the task sending the next batch of a reminder run.  Tasks are
+    named after the run and batch so a batch is never queued twice"""
+    try:
+        taskqueue.add(url='/tasks/send_reminder_batch',
+                      name='reminder-{}-{}'.format(run.key.id(), run.batches),
+                      params={'run_id': run.key.id(), 'batch': run.batches})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info('Reminder batch %d of run %s already queued',
+                     run.batches, run.key.id())
+
+
+class CompactScoreRollups(webapp2.RequestHandler):
+    def get(self):
+        """Write the monthly ScoreRollup of each month that is over and has
+        daily rollups but no monthly rollup, then delete the daily rollups
+        older than ROLLUP_DAILY_DAYS of compacted months.  Called on the
+        first of each month using a cron job"""
+        this_month = date.today().replace(day=1)
+        daily_keys = ScoreRollup.query(
+            ScoreRollup.period == 'day',
+            ScoreRollup.start < this_month).fetch(keys_only=True)
+        # daily rollup key ids start 'day-YYYY-MM-DD-'
+        months = sorted(set(key.id()[4:11] for key in daily_keys))
+        months = [date(int(month[:4]), int(month[5:]), 1)
+                  for month in months]
+        monthly = ndb.get_multi([ScoreRollup.key_for('month', month)
+                                 for month in months])
+        for month, rollup in zip(months, monthly):
+            if rollup is None:
+                ScoreRollup.compact_month(month)
+                logging.info('Compacted score rollups of %s', month)
+        # whole months before the oldest day kept, all compacted above
+        oldest_month = first_daily_day(date.today()).isoformat()[:7]
+        ndb.delete_multi([key for key in daily_keys
+                          if key.id()[4:11] < oldest_month])
+
+
+class ArchiveGames(webapp2.RequestHandler):
+    def get(self):
+        """Start archiving the finished and cancelled games created more
+        than ARCHIVE_AFTER_DAYS days ago, one batch of games per task.
+        Called every day using a cron job"""
+        cutoff = date.today() - timedelta(ARCHIVE_AFTER_DAYS)
+        taskqueue.add(url='/tasks/archive_games',
+                      params={'cutoff': cutoff.isoformat()})
+
+
+class ArchiveGamesBatch(webapp2.RequestHandler):
+    def post(self):
+        """Move one batch of finished games created before the cutoff param
+        into ArchivedGame entities, then queue the next batch with the
+        query cursor.  Queued by the archive games cron"""
+        cutoff = self.request.get('cutoff')
+        cursor = self.request.get('cursor')
+        query = Game.query(Game.game_over == True,
+                           Game.date < datetime.strptime(cutoff,
+                                                         '%Y-%m-%d').date())
+        keys, next_cursor, more = query.fetch_page(
+            ARCHIVE_BATCH_SIZE, keys_only=True,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        archived = [key for key in keys if archive_game(key)]
+        GameCache().invalidate(*archived)
+        logging.info('Archived %d of %d finished games', len(archived),
+                     len(keys))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/archive_games',
+                          params={'cutoff': cutoff,
+                                  'cursor': next_cursor.urlsafe()})
+
+
+class ExpireExports(webapp2.RequestHandler):
+    def get(self):
+        """Queue the deletion of each export run started more than
+        EXPORT_KEEP_DAYS days ago.  Tasks are named after the run so a run
+        is deleted once.  Called every day using a cron job"""
+        cutoff = date.today() - timedelta(EXPORT_KEEP_DAYS)
+        for key in ExportRun.query(ExportRun.date < cutoff).iter(
+                keys_only=True):
+            try:
+                taskqueue.add(url='/tasks/delete_export',
+                              name='delete-export-{}'.format(key.id()),
+                              params={'run_id': key.id()})
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                logging.info('Deletion of export %s already queued',
+                             key.id())
+
+
+class DeleteExport(webapp2.RequestHandler):
+    def post(self):
+        """Delete an export run with its shards and output.  Queued by the
+        expire exports cron"""
+        run = ExportRun.get_by_id(int(self.request.get('run_id')))
+        if run is not None:
+            delete_export(run)
+
+
+class FoldUserStats(webapp2.RequestHandler):
+    def post(self):
+        """Sum the UserStatsShard entities of a user into its UserStats.
+        Queued by the transaction that ends a game of a sharded user"""
+        user_key = ndb.Key(urlsafe=self.request.get('user_key'))
+        UserStatsShard.fold(user_key)
+
+
+class RebuildUserStats(webapp2.RequestHandler):
+    def post(self):
+        """Recount UserStats of every User from the Score entities, one
+        batch of users per task, queueing the next batch with the query
+        cursor"""
+        cursor = self.request.get('cursor')
+        users, next_cursor, more = User.query().fetch_page(
+            REBUILD_BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        for user in users:
+            UserStats.rebuild(user)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/rebuild_user_stats',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class MigrateUsers(webapp2.RequestHandler):
+    def post(self):
+        """Write the UserName and UserEmail markers of users created before
+        markers, one batch of users per task, queueing the next batch with
+        the query cursor.  Names and emails already held by another user
+        are logged and left to their holder.  The last batch records the
+        migration done, after which lookups stop querying users.  Posted
+        once by an admin"""
+        cursor = self.request.get('cursor')
+        users, next_cursor, more = User.query().fetch_page(
+            MIGRATE_BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        written = 0
+        for user in users:
+            written += ndb.transaction(user.reserve, xg=True)
+        logging.info('Wrote %d markers for %d users', written, len(users))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_users',
+                          params={'cursor': next_cursor.urlsafe()})
+        else:
+            UserMigration.finish_markers()
+
+
+class MigrateGameState(webapp2.RequestHandler):
+    def post(self):
+        """Rewrite the games written before state blobs with their cards in
+        a state blob, one batch of games per task, queueing the next batch
+        with the query cursor.  Games are otherwise converted when they are
+        next written.  Posted once by an admin"""
+        cursor = self.request.get('cursor')
+        keys, next_cursor, more = Game.query().fetch_page(
+            MIGRATE_GAME_BATCH_SIZE, keys_only=True,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        migrated = [key for key in keys if migrate_game_state(key)]
+        GameCache().invalidate(*migrated)
+        logging.info('Migrated %d of %d games to state blobs', len(migrated),
+                     len(keys))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_game_state',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class BackfillParticipants(webapp2.RequestHandler):
+    def post(self):
+        """Write the participants and status of the games, then the
+        participants of the scores, written before those properties, one
+        batch per task, queueing the next batch with the query cursor.
+        Until it finishes older games and scores are missing from
+        get_user_games and get_user_scores.  Posted once by an admin"""
+        phase = int(self.request.get('phase', 0))
+        cursor = self.request.get('cursor')
+        model = BACKFILL_MODELS[phase]
+        keys, next_cursor, more = model.query().fetch_page(
+            BACKFILL_BATCH_SIZE, keys_only=True,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        written = [key for key in keys if backfill_participants(key)]
+        if model is Game:
+            GameCache().invalidate(*written)
+        logging.info('Backfilled participants of %d of %d %s entities',
+                     len(written), len(keys), model.__name__)
+        if more and next_cursor:
+            params = {'phase': phase, 'cursor': next_cursor.urlsafe()}
+        elif phase + 1 < len(BACKFILL_MODELS):
+            params = {'phase': phase + 1}
+        else:
+            return
+        taskqueue.add(url='/tasks/backfill_participants', params=params)
+
+
+class StartExport(webapp2.RequestHandler):
+    def post(self):
+        """Start a bulk export of the kind param (scores, games,
+        archived_games or moves) in the format param (ndjson or csv), split
+        into the shards param parallel task chains.  The cursor param
+        starts a single shard export from a cursor; the run_id param of an
+        earlier export requeues its unfinished shards instead.  Responds
+        with the run id"""
+        run_id = self.request.get('run_id')
+        if run_id:
+            run = ExportRun.get_by_id(int(run_id))
+            if run is None:
+                self.abort(404)
+            resume_export(run)
+        else:
+            kind = self.request.get('kind')
+            export_format = self.request.get('format', 'ndjson')
+            if kind not in EXPORT_KINDS or export_format not in EXPORT_FORMATS:
+                self.abort(400)
+            run = start_export(kind, export_format,
+                               int(self.request.get('shards', 1)),
+                               self.request.get('cursor') or None)
+        self.response.write(run.key.id())
+
+
+class ExportBatch(webapp2.RequestHandler):
+    def post(self):
+        """Export one batch of a shard of an export run and queue the next
+        batch.  Queued by StartExport and by itself"""
+        run = ExportRun.get_by_id(int(self.request.get('run_id')))
+        if run is None:
+            return
+        shard_key = ExportShard.key_for(run.key.id(),
+                                        int(self.request.get('shard')))
+        export_batch(run, shard_key, int(self.request.get('batch')))
+
+
+class ExportShardDone(webapp2.RequestHandler):
+    def post(self):
+        """Record the shards of an export run that have written every
+        batch.  Queued by the checkpoint of the last batch of each shard"""
+        run = ExportRun.get_by_id(int(self.request.get('run_id')))
+        if run is not None and not run.done:
+            record_shards_done(run)
+
+
+class DownloadExport(webapp2.RequestHandler):
+    def get(self):
+        """Return the output of a shard of an export run from the batch of
+        the start param, up to EXPORT_DOWNLOAD_BYTES.  If more batches
+        follow, the X-Next-Start header holds the start of the next
+        request; X-Export-Done tells if every batch has been written.
+        Concatenating every shard in order gives the export"""
+        run = ExportRun.get_by_id(int(self.request.get('run_id')))
+        if run is None:
+            self.abort(404)
+        self.response.content_type = EXPORT_FORMATS[run.format]
+        self.response.headers['X-Export-Done'] = str(run.done)
+        size = 0
+        for batch, data in iter_export(run, int(self.request.get('shard', 1)),
+                                       int(self.request.get('start', 0))):
+            if size and size + len(data) > EXPORT_DOWNLOAD_BYTES:
+                self.response.headers['X-Next-Start'] = str(batch)
+                return
+            self.response.write(data)
+            size += len(data)
+
+
+class PropagateUserName(webapp2.RequestHandler):
+    def post(self):
+        """Copy the current name of a user onto the games and scores that
+        store it, one batch per task, queueing the next batch with the query
+        cursor.  Queued by saveProfile when a user changes their name"""
+        user = ndb.Key(urlsafe=self.request.get('user_key')).get()
+        phase = int(self.request.get('phase', 0))
+        cursor = self.request.get('cursor')
+        model, key_property, name_property = USER_NAME_REFERENCES[phase]
+        query = model.query(getattr(model, key_property) == user.key)
+        keys, next_cursor, more = query.fetch_page(
+            RENAME_BATCH_SIZE, keys_only=True,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        for key in keys:
+            rename(key, name_property, user.name)
+        if model is Game:
+            GameCache().invalidate(*keys)
+
+        params = {'user_key': user.key.urlsafe()}
+        if more and next_cursor:
+            params.update(phase=phase, cursor=next_cursor.urlsafe())
+        elif phase + 1 < len(USER_NAME_REFERENCES):
+            params.update(phase=phase + 1)
+        else:
+            rename(UserStats.key_for(user.key), 'user_name', user.name)
+            return
+        taskqueue.add(url='/tasks/propagate_user_name', params=params)
+
+
+@ndb.transactional
+def rename(key, name_property, name):
+    """Set the name property of an entity to name, re-reading the entity
+    in a transaction so concurrent game moves are not overwritten"""
+    entity = key.get()
+    if entity and getattr(entity, name_property) != name:
+        setattr(entity, name_property, name)
+        entity.put()
+
+
+@ndb.transactional
+def migrate_game_state(key):
+    """Write a game without a state blob, which encodes its cards into one,
+    in a transaction so concurrent game moves are not overwritten.  Returns
+    True if the game was written"""
+    game = key.get()
+    if game is None or game.state is not None:
+        return False
+    game.put()
+    return True
+
+
+@ndb.transactional
+def backfill_participants(key):
+    """Write a game or score without participants, which sets them, in a
+    transaction so concurrent game moves are not overwritten.  Returns True
+    if the entity was written"""
+    entity = key.get()
+    if entity is None or entity.participants:
+        return False
+    entity.put()
+    return True
+
+
+@ndb.transactional(xg=True)
+def archive_game(key):
+    """Replace a finished game by its ArchivedGame, re-reading the game in
+    a transaction so a game that is not over is never archived.  Returns
+    True if the game was archived"""
+    game = key.get()
+    if game is None or not game.game_over:
+        return False
+    ArchivedGame.from_game(game).put()
+    key.delete()
+    return True
 
 
 app = webapp2.WSGIApplication([
-    ('/crons/send_reminder', SendReminderEmail)
+    ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminder_batch', SendReminderBatch),
+    ('/crons/compact_score_rollups', CompactScoreRollups),
+    ('/crons/archive_games', ArchiveGames),
+    ('/crons/expire_exports', ExpireExports),
+    ('/admin/metrics', EndpointMetricsReport),
+    ('/tasks/fold_user_stats', FoldUserStats),
+    ('/tasks/rebuild_user_stats', RebuildUserStats),
+    ('/tasks/archive_games', ArchiveGamesBatch),
+    ('/tasks/migrate_users', MigrateUsers),
+    ('/tasks/migrate_game_state', MigrateGameState),
+    ('/tasks/backfill_participants', BackfillParticipants),
+    ('/tasks/export', StartExport),
+    ('/tasks/export_batch', ExportBatch),
+    ('/tasks/export_shard_done', ExportShardDone),
+    ('/tasks/export_download', DownloadExport),
+    ('/tasks/delete_export', DeleteExport),
+    ('/tasks/propagate_user_name', PropagateUserName)
 ], debug=False)
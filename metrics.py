@@ -0,0 +1,225 @@
+"""metrics.py - Per-endpoint latency and RPC instrumentation.  The
+instrumented decorator, applied under each @endpoints.method of
+CrazyEightsApi, times each call and counts the datastore gets, puts,
+deletes and query batches and the memcache hits and misses it made,
+counted by hooks on the RPCs of the request thread.  Each call is logged
+as one structured log line and added to rolling histograms of the
+instance, from which the admin metrics handler in main.py reports
+p50/p95/p99 per endpoint.  The time long polls are held is recorded as
+wait_ms, apart from the latency of the other endpoints.  Histograms are per
+instance; the log lines hold every call across instances."""
+
+import functools
+import json
+import logging
+import math
+import threading
+import time
+from collections import Counter
+from google.appengine.api import apiproxy_stub_map
+
+# seconds of calls covered by the rolling histograms
+METRICS_WINDOW_SECONDS = 5 * 60
+# number of slots the window is split into, the oldest dropped as it rolls
+METRICS_WINDOW_SLOTS = 5
+# ratio between the upper bounds of neighbouring histogram buckets
+BUCKET_RATIO = 1.1
+# percentiles reported
+PERCENTILES = (50, 95, 99)
+# datastore calls counted as gets, puts, deletes and queries; a query
+# fetching more than one batch makes a Next call for each further batch
+DATASTORE_CALLS = {'Get': 'datastore_gets',
+                   'Put': 'datastore_puts',
+                   'Delete': 'datastore_deletes',
+                   'RunQuery': 'datastore_queries',
+                   'Next': 'datastore_queries'}
+# metrics recorded for each call, in log line order
+METRICS = ('latency_ms', 'datastore_gets', 'datastore_puts',
+           'datastore_deletes', 'datastore_queries', 'memcache_hits',
+           'memcache_misses')
+# metrics recorded for each call of a long poll, whose latency is mostly
+# the time it was held waiting
+LONG_POLL_METRICS = ('wait_ms',) + METRICS[1:]
+
+
+class RollingHistogram(object):
+    """Histogram of the values recorded in the last window seconds, held
+    in logarithmic buckets within BUCKET_RATIO of the value
+    Attributes:
+        window: seconds of values covered
+        slots: list of (slot start, Counter of bucket to count, list
+               holding sum of values), the newest last
+    """
+
+    def __init__(self, window=METRICS_WINDOW_SECONDS,
+                 slot_count=METRICS_WINDOW_SLOTS, clock=time.time):
+        self.window = window
+        self.slot_seconds = float(window) / slot_count
+        self.slots = []
+        self._clock = clock
+
+    @staticmethod
+    def bucket(value):
+        """returns bucket of value; bucket 0 holds zero, so RPC counts of
+           calls that made no RPC are reported exactly
+        """
+        if value <= 0:
+            return 0
+        return int(math.ceil(math.log(value, BUCKET_RATIO))) + 1
+
+    @staticmethod
+    def upper_bound(bucket):
+        """returns largest value held in bucket"""
+        if bucket == 0:
+            return 0.0
+        return BUCKET_RATIO ** (bucket - 1)
+
+    def _roll(self):
+        """drop slots older than the window and return the current slot"""
+        now = self._clock()
+        slot_start = now - now % self.slot_seconds
+        self.slots = [slot for slot in self.slots
+                      if slot[0] > now - self.window]
+        if not self.slots or self.slots[-1][0] != slot_start:
+            self.slots.append((slot_start, Counter(), [0]))
+        return self.slots[-1]
+
+    def add(self, value):
+        _, buckets, total = self._roll()
+        buckets[self.bucket(value)] += 1
+        total[0] += value
+
+    def summary(self):
+        """returns dict of the count, mean, maximum and percentiles of the
+           values in the window, each but the mean rounded up to its
+           bucket bound
+        """
+        self._roll()
+        buckets = Counter()
+        for _, slot, _ in self.slots:
+            buckets.update(slot)
+        count = sum(buckets.values())
+        summary = {'count': count}
+        if not count:
+            return summary
+        summary['mean'] = round(sum(total[0] for _, _, total
+                                    in self.slots) / float(count), 2)
+        ordered = sorted(buckets)
+        for percent in PERCENTILES:
+            threshold = count * percent / 100.0
+            seen = 0
+            for bucket in ordered:
+                seen += buckets[bucket]
+                if seen >= threshold:
+                    summary['p%d' % percent] = round(
+                        self.upper_bound(bucket), 1)
+                    break
+        summary['max'] = round(self.upper_bound(ordered[-1]), 1)
+        return summary
+
+
+class EndpointMetrics(object):
+    """Rolling histograms of each metric of each endpoint of an instance,
+    shared by its threads through the module level ENDPOINT_METRICS"""
+
+    def __init__(self, window=METRICS_WINDOW_SECONDS):
+        self.window = window
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._errors = {}
+
+    def record(self, endpoint, values, metrics=METRICS):
+        """add dict of values of metrics of one call of endpoint"""
+        with self._lock:
+            histograms = self._histograms.setdefault(
+                endpoint, dict((metric, RollingHistogram(self.window))
+                               for metric in metrics))
+            for metric in metrics:
+                histograms[metric].add(values[metric])
+
+    def record_error(self, endpoint, error):
+        """count a call of endpoint that raised exception class error"""
+        with self._lock:
+            self._errors.setdefault(endpoint, Counter())[error] += 1
+
+    def summary(self):
+        """returns dict of endpoint to dict of metric to summary, and of
+           'errors' to the count of each exception raised
+        """
+        with self._lock:
+            return dict((endpoint, dict(
+                [(metric, histogram.summary())
+                 for metric, histogram in histograms.items()] +
+                [('errors', dict(self._errors.get(endpoint, {})))]))
+                for endpoint, histograms in self._histograms.items())
+
+
+# histograms shared by the threads of this instance
+ENDPOINT_METRICS = EndpointMetrics()
+# RPC counts of the instrumented call running on each thread
+_call_counts = threading.local()
+
+
+def _count_rpc(service, call, request, response):
+    """post-call hook counting the datastore and memcache RPCs of the
+       instrumented call running on the thread
+    """
+    counts = getattr(_call_counts, 'counts', None)
+    if counts is None:
+        return
+    if service == 'datastore_v3':
+        metric = DATASTORE_CALLS.get(call)
+        if metric:
+            counts[metric] += 1
+    elif service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        counts['memcache_hits'] += hits
+        counts['memcache_misses'] += request.key_size() - hits
+
+
+def install_rpc_hooks():
+    """count RPCs through the current API proxy; called again by harnesses
+       that replace the proxy with service stubs
+    """
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'endpoint_metrics', _count_rpc)
+
+
+install_rpc_hooks()
+
+
+def instrumented(method=None, long_poll=False):
+    """decorator recording the latency and RPC counts of each call of an
+       endpoint method, applied under @endpoints.method.  With long_poll,
+       as @instrumented(long_poll=True), the time a call was held is
+       recorded as wait_ms instead of latency_ms, so long polls do not
+       skew the latency of the endpoints
+    """
+    if method is None:
+        return functools.partial(instrumented, long_poll=long_poll)
+    metrics = LONG_POLL_METRICS if long_poll else METRICS
+    elapsed = metrics[0]
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        counts = Counter()
+        _call_counts.counts = counts
+        started = time.time()
+        error = None
+        try:
+            return method(*args, **kwargs)
+        except Exception as exception:
+            error = exception.__class__.__name__
+            raise
+        finally:
+            _call_counts.counts = None
+            values = dict((metric, counts[metric]) for metric in metrics)
+            values[elapsed] = (time.time() - started) * 1000
+            ENDPOINT_METRICS.record(method.__name__, values, metrics)
+            if error:
+                ENDPOINT_METRICS.record_error(method.__name__, error)
+            logging.info('endpoint_metrics %s', json.dumps(
+                dict(values, endpoint=method.__name__, error=error,
+                     **{elapsed: round(values[elapsed], 1)}),
+                sort_keys=True))
+    return wrapper
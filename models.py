@@ -17,28 +17,46 @@ __license__ = "Apache 2.0"
 
 import random
 import logging
-from datetime import date
+from datetime import date, timedelta
 from protorpc import messages
-from collections import Counter
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
-# Holds values for standard deck of cards
-CARD_NUMBER_VALUES = ['A', '2', '3', '4', '5',
-                      '6', '7', '8', '9', '10', 'J', 'Q', 'K']
-# Hold suits for standard deck of cards
-CARD_SUITS = ['hearts', 'diamonds', 'clubs', 'spades']
-# variable to hold list of tuples for standard deck of cards
-DECKOFCARDS = []
+from engine import CrazyEights, computer_player, replay_moves
+from engine.cards import GameCards, cards_to_text, card_id
+from engine.state import decode_cards, encode_cards
+from engine.replay import DEAL, PLAY, DRAW, RESHUFFLE, DECK
+from engine.replay import decode_move, describe_move
+from engine.replay import pack_moves, unpack_moves
 
-# populate DECKOFCARDS with tuples of (suit, card number)
-for suit in CARD_SUITS:
-    for value in CARD_NUMBER_VALUES:
-        card = (suit, value)
-        DECKOFCARDS.append(card)
+# users whose statistics are counted in sharded counters
+SHARDED_USER_NAMES = ('Computer',)
+# number of UserStatsShard entities per sharded user; folding them reads
+# the shards, the UserStats and the User in one transaction, which can
+# span at most 25 entity groups
+USER_STATS_SHARDS = 20
+# number of daily ScoreRollup entities of a sharded user
+ROLLUP_SHARDS = 5
+# days daily score rollups are kept before only monthly rollups remain
+ROLLUP_DAILY_DAYS = 400
+# status of a game, stored with its participants for the user game queries
+GAME_ACTIVE = 'active'
+GAME_OVER = 'over'
+GAME_CANCELLED = 'cancelled'
+
+
+class DuplicateUserError(Exception):
+    """Raised when a user name or email is already held by another User,
+       holding the message shown to the player
+    """
 
 
 class User(ndb.Model):
-    """User profile listing name and email of user
+    """User profile listing name and email of user, keyed by an allocated
+    id that does not change when the user is renamed.  The name and email
+    of each user are reserved by UserName and UserEmail markers, written in
+    the same transaction as the user, so users are looked up by key and
+    names and emails are unique without queries
     Attributes:
         name: string property
         email: string property
@@ -46,384 +64,1193 @@ class User(ndb.Model):
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
 
+    @classmethod
+    def create(cls, name, email):
+        """Create and return a new User, reserving its name and email.
+           Raises DuplicateUserError if either is already reserved
+        """
+        user_id, _ = User.allocate_ids(1)
+        user = User(key=ndb.Key(User, user_id), name=name, email=email)
+
+        @ndb.transactional(xg=True)
+        def create():
+            user.reserve(check=True)
+            user.put()
+        create()
+        return user
+
+    @classmethod
+    def key_for_name(cls, name):
+        """returns key of the User holding name, or None"""
+        if not name:
+            return None
+        marker = UserName.get_by_id(name)
+        if marker:
+            return marker.user
+        user = cls._unreserved('name', name)
+        return user.key if user else None
+
+    @classmethod
+    def get_by_email(cls, email):
+        """returns the User holding email, or None"""
+        if not email:
+            return None
+        marker = UserEmail.get_by_id(email)
+        if marker:
+            return marker.user.get()
+        return cls._unreserved('email', email)
+
+    @classmethod
+    def _unreserved(cls, field, value):
+        """returns the User whose property field holds value that was
+           created before markers and not yet migrated, reserving its
+           markers, or None.  The query may still return a user renamed
+           since, so the user is read again in the transaction and only
+           returned and reserved if it still holds value.  Once every user
+           has been migrated nothing is queried
+        """
+        if UserMigration.markers_done():
+            return None
+        user = User.query(getattr(User, field) == value).get()
+        if user is None:
+            return None
+
+        @ndb.transactional(xg=True)
+        def reserve():
+            stored = user.key.get()
+            if stored is None or getattr(stored, field) != value:
+                return None
+            stored.reserve()
+            return stored
+        return reserve()
+
+    def reserve(self, check=False):
+        """put the UserName and UserEmail markers of the user, in the
+           caller's transaction.  With check, raises DuplicateUserError if
+           a marker is held by another user; otherwise such markers are
+           left to their holder.  Returns the number of markers written
+        """
+        markers = [(UserEmail, self.email, 'e-mail'),
+                   (UserName, self.name, 'name')]
+        markers = [marker for marker in markers if marker[1]]
+        held = ndb.get_multi([ndb.Key(model, value)
+                              for model, value, _ in markers])
+        written = []
+        for (model, value, label), marker in zip(markers, held):
+            if marker is None:
+                written.append(model(id=value, user=self.key))
+            elif marker.user != self.key:
+                if check:
+                    raise DuplicateUserError(
+                        'A User with that {} already exists!'.format(label))
+                logging.warning('User %s %s %r is held by user %s',
+                                self.key.id(), label, value, marker.user.id())
+        ndb.put_multi(written)
+        return len(written)
+
+    def rename(self, name):
+        """Change the name of the user, moving its UserName marker.  The
+           marker of the old name is only deleted if the user holds it.
+           Raises ValueError if name is empty and DuplicateUserError if
+           the name is held by another user
+        """
+        if not name:
+            raise ValueError('User name must not be empty')
+        old_name = self.name
+
+        @ndb.transactional(xg=True)
+        def rename():
+            marker, old_marker = ndb.get_multi([ndb.Key(UserName, name),
+                                                ndb.Key(UserName, old_name)])
+            if marker and marker.user != self.key:
+                raise DuplicateUserError(
+                    'A User with that name already exists!')
+            if old_marker and old_marker.user == self.key:
+                old_marker.key.delete()
+            UserName(id=name, user=self.key).put()
+            self.name = name
+            self.put()
+        try:
+            rename()
+        except Exception:
+            self.name = old_name
+            raise
+
+
+class UserName(ndb.Model):
+    """Marker reserving a user name, keyed by the name
+    Attributes:
+        user: key property referencing the User holding the name
+    """
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+
+
+class UserEmail(ndb.Model):
+    """Marker reserving a user email, keyed by the email
+    Attributes:
+        user: key property referencing the User holding the email
+    """
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+
+
+class UserMigration(ndb.Model):
+    """UserMigration object keyed 'markers', recording that every user
+       created before UserName and UserEmail markers has been given them
+       by the migrate users task, so lookups of unknown names and emails
+       no longer query users
+        Attributes:
+            done: boolean property indicating if the migration finished
+    """
+    done = ndb.BooleanProperty(default=False, indexed=False)
+
+    # set on an instance once the migration is seen done, which it stays
+    _done = False
+
+    @classmethod
+    def markers_done(cls):
+        """returns True if every user has its markers"""
+        if not UserMigration._done:
+            migration = cls.get_by_id('markers')
+            UserMigration._done = bool(migration and migration.done)
+        return UserMigration._done
+
+    @classmethod
+    def finish_markers(cls):
+        """record that every user has its markers"""
+        cls(id='markers', done=True).put()
+
 
 class Game(ndb.Model):
     """Game object that lists data necessary for game
     Attributes:
+        state: blob property holding the hands and piles of the game in
+               the versioned binary format of engine.state, decoded once
+               per request when the cards are first used
         player_one_hand: text property holding comma separated
-                          cardnumbers (0-51) of hand
+                          cardnumbers (0-51) of hand, kept only for games
+                          not yet written with a state blob
         player_two_hand: text property holding comma separated
-                          cardnumbers (0-51) of hand
+                          cardnumbers (0-51) of hand, kept only for games
+                          not yet written with a state blob
         discard_pile: text property holding comma separated
-                      cardnumbers(0-51) of discarded cards
+                      cardnumbers(0-51) of discarded cards, kept only for
+                      games not yet written with a state blob
         undrawn_cards: text property holding comma separated
-                       cardnumbers(0-51) of discarded cards
+                       cardnumbers(0-51) of undrawn cards, kept only for
+                       games created before deck seeds and state blobs
+        deck_seed: integer property holding the seed ordering the deck of
+                   the deal and of each reshuffle, kept only for games
+                   not yet written with a state blob
+        reshuffles: integer property holding number of reshuffles of the
+                    discard pile, kept only for games not yet written with
+                    a state blob
         current_suit: text property holding lower case current suit of game
         game_over: boolean property indicating if game is over
         user_one: key property referencing User class
         user_two: key property referencing User class
+        user_one_name: string property holding name of user one, stored
+                       when game created and updated when user renamed
+        user_two_name: string property holding name of user two, stored
+                       when game created and updated when user renamed
         user_one_turn: boolean property indicating if user one turn
         cancelled: boolean property indicating if game is cancelled
         move: repeated field holding string tracking game history in format
-              user, action, card suit, card number
+              user, action, card suit, card number, kept only for games
+              created before moves were logged in MoveLog entities
+        move_count: integer property holding number of move records
+                    written to the MoveLog entities of the game
         date: date property holding date created
-        computer_card: string property used for computer games, the string
-                       number of the card selected by the computer to play
-        computer_crazy_suit: string property used for computer games, the
-                             suit the computer has selected when playing an 8
+        computer_card: unused string property, set only on games created
+                       before state blobs
+        computer_crazy_suit: unused string property, set only on games
+                             created before state blobs
         game_message: string message used for messages from computer play
+        difficulty: string property holding the computer difficulty level,
+                    a key of engine.DIFFICULTIES; None plays the default
+        version: integer property incremented each time the game is
+                 written, used to detect concurrent changes to the game
+        participants: repeated key property holding user one and user
+                      two, set when the game is written
+        status: string property holding GAME_ACTIVE, GAME_OVER or
+                GAME_CANCELLED, set from game_over and cancelled when the
+                game is written; with participants, lets the games of a
+                user be read with one cursorable query
     """
-    player_one_hand = ndb.TextProperty(required=True)
-    player_two_hand = ndb.TextProperty(required=True)
-    discard_pile = ndb.TextProperty(required=True)
-    undrawn_cards = ndb.TextProperty(required=True)
-    current_suit = ndb.StringProperty(required=True)
+    state = ndb.BlobProperty()
+    player_one_hand = ndb.TextProperty()
+    player_two_hand = ndb.TextProperty()
+    discard_pile = ndb.TextProperty()
+    undrawn_cards = ndb.TextProperty()
+    deck_seed = ndb.IntegerProperty(indexed=False)
+    reshuffles = ndb.IntegerProperty(indexed=False)
+    current_suit = ndb.StringProperty(required=True, indexed=False)
     game_over = ndb.BooleanProperty(required=True, default=False)
     user_one = ndb.KeyProperty(required=True, kind='User')
     user_two = ndb.KeyProperty(required=True, kind='User')
+    user_one_name = ndb.StringProperty(indexed=False)
+    user_two_name = ndb.StringProperty(indexed=False)
     user_one_turn = ndb.BooleanProperty(required=True)
     cancelled = ndb.BooleanProperty(required=True)
     move = ndb.StringProperty(repeated=True)
+    move_count = ndb.IntegerProperty(default=0, indexed=False)
     date = ndb.DateProperty(required=True)
-    computer_card = ndb.StringProperty()
-    computer_crazy_suit = ndb.StringProperty()
-    game_message = ndb.StringProperty()
+    computer_card = ndb.StringProperty(indexed=False)
+    computer_crazy_suit = ndb.StringProperty(indexed=False)
+    game_message = ndb.StringProperty(indexed=False)
+    difficulty = ndb.StringProperty(indexed=False)
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    participants = ndb.KeyProperty(kind='User', repeated=True)
+    status = ndb.StringProperty()
+
+    # (user key property, user name property) pairs stored on the game
+    USER_NAME_PROPERTIES = (('user_one', 'user_one_name'),
+                            ('user_two', 'user_two_name'))
+    # properties holding the cards of games written before state blobs
+    LEGACY_CARD_PROPERTIES = ('player_one_hand', 'player_two_hand',
+                              'discard_pile', 'undrawn_cards', 'deck_seed',
+                              'reshuffles')
 
     @classmethod
-    def new_game(cls, user_one, user_two):
-        """Create a new game and save"""
-        cards = range(0, 52)
-        cards = map(str, cards)
-        random.shuffle(cards)
-        game = Game(user_one=user_one,
+    def new_game(cls, user_one, user_two, user_one_name, user_two_name,
+                 difficulty=None):
+        """Create a new game and save it with the deal as the first
+           records of its move log
+        """
+        engine = CrazyEights.deal()
+        # allocate the key first so the move log can be its child
+        game_id, _ = Game.allocate_ids(1)
+        game = Game(key=ndb.Key(Game, game_id),
+                    user_one=user_one,
                     user_two=user_two,
-                    player_one_hand=','.join(cards[0:7]),
-                    player_two_hand=','.join(cards[7:14]),
-                    discard_pile=cards[14],
-                    current_suit=DECKOFCARDS[int(cards[14])][0],
-                    undrawn_cards=','.join(cards[15:]),
+                    user_one_name=user_one_name,
+                    user_two_name=user_two_name,
+                    current_suit=engine.current_suit,
                     # user_one_turn = bool(random.getrandbits(1)),
-                    user_one_turn=True,
+                    user_one_turn=engine.user_one_turn,
                     cancelled=False,
                     game_over=False,
                     date=date.today(),
-                    computer_card='99',
-                    computer_crazy_suit='none')
-        game.put()
+                    difficulty=difficulty)
+        game._engine = engine
+        ndb.put_multi([game.pending_move_log(), game])
         return game
 
-    def to_text_list(cls, card_string):
-        """convert string of card number(0-51) from computer play
-           into a list object representing card value
-        """
-        # split string into integer list
-        card_value = DECKOFCARDS[int(card_string)]
-        # add text cards to list
-        logging.info(card_value)
-        # convert to list and return
-        return list(card_value)
-
-    def to_card_type(cls, card_string):
-        """convert string of card numbers(0-51) into card values
-           from DECKOFCARDS and join in string to return in game form
-        """
-        # split string into integer list
-        if card_string:
-            card_list = card_string.split(',')
-            card_list = map(int, card_list)
-        # add text cards to list
-            card_values = []
-            for card_number in card_list:
-                card = DECKOFCARDS[card_number]
-                card_string = '(' + card[0] + ',' + card[1] + ')'
-                card_values.append(card_string)
-                card_values_string = '*'.join(card_values)
-        else:
-            # returns blank line if no cards
-            card_values_string = card_string
-        return card_values_string
-
-    def to_cards(cls, card_string):
-        """convert string of card numbers(0-51) into card values
-           from DECKOFCARDS add to list of card values to return
-        """
-        # split string into integer list
-        card_list = card_string.split(',')
-        card_list = map(int, card_list)
-        # add text cards to list
-        card_values = []
-        for card_number in card_list:
-            card = DECKOFCARDS[card_number]
-            card_string = '(' + card[0] + ',' + card[1] + ')'
-            card_values.append(card_string)
-        return card_values
-
-    def to_string(cls, card):
-        """convert string of card number into string of card value"""
-        card_number = DECKOFCARDS.index(card)
-        return str(card_number)
-
-    def card_in_hand(self, card_number, card_suit):
-        """function to determine if card played is in player's hand"""
-        card_in_question = (card_suit, card_number)
-        # convert to card number and check if in hand
-        card_in_question_number = str(DECKOFCARDS.index(card_in_question))
-        if self.user_one_turn:
-            cards_held_list = self.player_one_hand.split(',')
-        else:
-            cards_held_list = self.player_two_hand.split(',')
-        if card_in_question_number in cards_held_list:
-            return True
+    @property
+    def engine(self):
+        """CrazyEights rules engine holding the game in memory, built from
+           the stored properties on first use.  Its hands and piles are
+           written back when the game is put
+        """
+        engine = getattr(self, '_engine', None)
+        if engine is None:
+            if self.state is not None:
+                cards = decode_cards(self.state)
+            elif self.deck_seed is None:
+                cards = GameCards.from_strings(self.player_one_hand,
+                                               self.player_two_hand,
+                                               self.discard_pile,
+                                               self.undrawn_cards)
+            else:
+                cards = GameCards.from_seed(self.player_one_hand,
+                                            self.player_two_hand,
+                                            self.discard_pile,
+                                            self.deck_seed,
+                                            self.reshuffles or 0)
+            engine = CrazyEights(cards, self.current_suit,
+                                 self.user_one_turn, self.game_over)
+            self._engine = engine
+        return engine
+
+    @property
+    def cards(self):
+        """in-memory hands and piles of the game"""
+        return self.engine.cards
+
+    def _sync(self):
+        """copy suit and turn changed by the engine to the game"""
+        self.current_suit = self.engine.current_suit
+        self.user_one_turn = self.engine.user_one_turn
+
+    def _pre_put_hook(self):
+        """encode in-memory card state into the state blob, set the
+           participants and status and advance the game version.  Games
+           written before state blobs are converted the first time they are
+           written, and their card strings dropped
+        """
+        self.version += 1
+        self.participants = participant_keys(self.user_one, self.user_two)
+        if self.cancelled:
+            self.status = GAME_CANCELLED
+        elif self.game_over:
+            self.status = GAME_OVER
         else:
+            self.status = GAME_ACTIVE
+        if getattr(self, '_engine', None) is not None or self.state is None:
+            self.state = encode_cards(self.cards)
+            for name in self.LEGACY_CARD_PROPERTIES:
+                setattr(self, name, None)
+
+    def pending_move_log(self):
+        """returns MoveLog holding the records of the moves made since the
+           game was loaded and advances move_count past them, or None if
+           no moves were made.  Written in the same transaction as the game.
+           Games created before move logs append the moves to move instead
+        """
+        engine = getattr(self, '_engine', None)
+        if engine is None or not engine.moves:
+            return None
+        new_moves, engine.moves = engine.moves, []
+        if not self.move_count and decode_move(new_moves[0])[0] != DEAL:
+            for record in new_moves:
+                game_move = describe_move(record, self.player_name(True),
+                                          self.player_name(False))
+                if game_move is not None:
+                    self.move.append(game_move)
+            return None
+        log = MoveLog(key=MoveLog.key_for(self.key, self.move_count),
+                      first=self.move_count,
+                      last=self.move_count + len(new_moves) - 1,
+                      moves=pack_moves(new_moves))
+        self.move_count += len(new_moves)
+        return log
+
+    def move_records(self):
+        """returns every record of the move log of the game, reading its
+           MoveLog entities in order
+        """
+        records = []
+        for log in MoveLog.query(ancestor=self.key).order(MoveLog.key):
+            records.extend(log.records())
+        engine = getattr(self, '_engine', None)
+        if engine is not None:
+            records.extend(engine.moves)
+        return records
+
+    def replay(self, upto=None):
+        """returns ReplayState of the game after the first upto records of
+           its move log, or after every record if upto is None
+        """
+        return replay_moves(self.move_records(), upto)
+
+    def audit(self):
+        """determine if replaying the move log of the game rebuilds its
+           stored hands, piles, suit and turn
+        """
+        state = self.replay()
+        if state.cards is None:
             return False
+        return (state.cards.to_strings() == self.cards.to_strings() and
+                state.current_suit == self.current_suit and
+                state.user_one_turn == self.user_one_turn)
 
-    def discard_card(self, user_one_turn, play_card_number, play_card_suit):
-        """function to discard card from player's hand and change turn"""
-        # determine discarded card number
-        discarded_card = (play_card_suit, play_card_number)
-        discarded_card_number = DECKOFCARDS.index(discarded_card)
-        # add card to discarded pile
-        discarded_pile_list = self.discard_pile.split(',')
-        discarded_pile_list.insert(0, str(discarded_card_number))
-        self.discard_pile = ','.join(discarded_pile_list)
-
-        # update player hand and game history and cycle turn
-        if user_one_turn:
-            player_hand_list = self.player_one_hand.split(',')
-            player_hand_list.remove(str(discarded_card_number))
-            self.player_one_hand = ','.join(player_hand_list)
-            self.user_one_turn = False
-            user_name = self.user_one.get().name
-        else:
-            player_hand_list = self.player_two_hand.split(',')
-            player_hand_list.remove(str(discarded_card_number))
-            self.player_two_hand = ','.join(player_hand_list)
-            self.user_one_turn = True
-            user_name = self.user_two.get().name
-        game_move = [user_name, 'play', play_card_suit, play_card_number]
-        self.move.append(','.join(game_move))
-        self.put()
-
-    def card_callback():
-        """dummy callbackfunction for when callback not needed in two
-           person play
-        """
-        # This line is intentionally assigned to zero
-        callback_variable = 0
-
-    def draw_card(self, user_one_turn, callback=card_callback):
-        """function to draw card from undrawn cards and add to hand
-           and reshuffle if no more cards to draw
-        """
-        # return string number of top undrawn card
-        undrawn_card_list = self.undrawn_cards.split(',')
-        # set reshuffle to true if drawing last card
-        reshuffle = False
-        if len(undrawn_card_list) == 1:
-            reshuffle = True
-        drawn_card = undrawn_card_list.pop(0)
-        # add card to player hand
-        if user_one_turn is True:
-            player_hand_list = self.player_one_hand.split(',')
-            #player_hand_list.append(drawn_card)
-            player_hand_list.insert(0,drawn_card)
-            self.player_one_hand = ','.join(player_hand_list)
-            user_name = self.user_one.get().name
-        else:
-            player_hand_list = self.player_two_hand.split(',')
-            #player_hand_list.append(drawn_card)
-            player_hand_list.insert(0,drawn_card)
-            self.player_two_hand = ','.join(player_hand_list)
-            user_name = self.user_two.get().name
-        # reshuffle cards
-        if reshuffle is True:
-            discard_pile_list = self.discard_pile.split(',')
-            last_discard_card = discard_pile_list.pop(0)
-            random.shuffle(discard_pile_list)
-            self.undrawn_cards = ','.join(discard_pile_list)
-            self.discard_pile = last_discard_card
-        else:
-            self.undrawn_cards = ','.join(undrawn_card_list)
-        game_move = [user_name, 'draw', DECKOFCARDS[int(drawn_card)][0],
-                     DECKOFCARDS[int(drawn_card)][1]]
-        self.move.append(','.join(game_move))
-        self.put()
-        callback()
-
-    def computer_play_card(self, callback=card_callback):
-        """game logic for computer to select card to play"""
-        # determine card number
-        current_number = DECKOFCARDS[int(self.discard_pile.split(',')[0])][1]
-        # convert card numbers to cards for game logic
-        computer_hand_list = self.player_two_hand.split(',')
-        cards_in_hand = []
-        for card_id in computer_hand_list:
-            card = DECKOFCARDS[int(card_id)]
-            cards_in_hand.append(card)
-        # count number of cards of each suit
-        suits_held = Counter([x for (x, y) in cards_in_hand])
-        suits = suits_held.most_common()
-        # determine if have matching number suit
-        cards_matching_number = []
-        for player_card in cards_in_hand:
-            if player_card[1] == current_number:
-                cards_matching_number.append(player_card)
-        # ordinal suits
-        first_suit = suits[0][0]
-        second_suit = first_suit
-        third_suit = first_suit
-        fourth_suit = first_suit
-        selected_card = ('none', 'none')
-        if len(suits) > 1:
-            second_suit = suits[1][0]
-        if len(suits) > 2:
-            third_suit = suits[2][0]
-        if len(suits) > 3:
-            fourth_suit = suits[3][0]
-        # play by suit from most common suit down, excluding 8
-        if first_suit == self.current_suit:
-            for card in cards_in_hand:
-                if card[0] == first_suit and card[1] != '8':
-                    selected_card = card
-        elif first_suit in [x[0] for x in cards_matching_number]:
-            for card in cards_matching_number:
-                if card[1] == current_number and card[0] == first_suit:
-                    selected_card = card
-        elif second_suit == self.current_suit:
-            for card in cards_in_hand:
-                if card[0] == second_suit and card[1] != '8':
-                    selected_card = card
-        elif second_suit in [x[0] for x in cards_matching_number]:
-            for card in cards_matching_number:
-                if card[1] == current_number and card[0] == second_suit:
-                    selected_card = card
-        elif third_suit == self.current_suit:
-            for card in cards_in_hand:
-                if card[0] == third_suit and card[1] != '8':
-                    selected_card = card
-        elif third_suit in [x[0] for x in cards_matching_number]:
-            for card in cards_matching_number:
-                if card[1] == current_number and card[0] == third_suit:
-                    selected_card = card
-        elif fourth_suit == self.current_suit:
-            for card in cards_in_hand:
-                if card[0] == fourth_suit and card[1] != '8':
-                    selected_card = card
-        elif fourth_suit in [x[0] for x in cards_matching_number]:
-            for card in cards_matching_number:
-                if card[1] == current_number and card[0] == fourth_suit:
-                    selected_card = card
-        # if no other cards, play eight if available
-        elif '8' in [x[1] for x in cards_in_hand]:
-            for card in cards_in_hand:
-                if card[1] == '8':
-                    selected_card = card
-        # no card to pay
-        else:
-            selected_card = ('none', 'none')
-        # set model attribute based on selected card
-        if selected_card[0] == 'none':
-            self.computer_crazy_suit = 'none'
-            self.computer_card = '99'
-        elif selected_card[1] == '8':
-            self.computer_crazy_suit = first_suit
-            self.computer_card = self.to_string(selected_card)
-        else:
-            self.computer_crazy_suit = selected_card[0]
-            self.computer_card = self.to_string(selected_card)
-        callback()
+    def player_name(self, user_one):
+        """returns name of user one or user two, reading it from the User
+           only for games stored before names were kept on the game
+        """
+        if user_one:
+            if self.user_one_name is None:
+                self.user_one_name = self.user_one.get().name
+            return self.user_one_name
+        if self.user_two_name is None:
+            self.user_two_name = self.user_two.get().name
+        return self.user_two_name
 
-    def computer_take_turn(self):
-        """function that draws for computer until card can be played
-           then discards card and ends game if necessary
-        """
-        while self.computer_card == '99':
-            self.draw_card(False, self.computer_play_card)
-        # discard card if one selected
-        if self.computer_card != '99':
-            self.current_suit = self.computer_crazy_suit
-            computer_card_type = self.to_text_list(self.computer_card)
-            # end game if playing last card
-            if len(self.player_two_hand.split(',')) < 2:
-                self.discard_card(False, computer_card_type[1],
-                                  computer_card_type[0])
-                self.end_game(False)
-                self.game_message = 'Game Over!  Computer wins!'
+    def play_card(self, card_number, card_suit, crazy_suit=None):
+        """plays card for the player whose turn it is and ends the game if
+           it was their last card.  Raises IllegalMove if the card cannot be
+           played
+        """
+        user_one_turn = self.user_one_turn
+        self.engine.play(card_id(card_suit, card_number), crazy_suit)
+        self._sync()
+        if self.engine.game_over:
+            self.end_game(user_one_turn)
 
-            else:
-                self.discard_card(False, computer_card_type[1],
-                                  computer_card_type[0])
-                self.computer_card = '99'
+    def draw_card(self):
+        """draws card for the player whose turn it is.  Returns the drawn
+           card number, or None if every card is held by the players.
+           Raises IllegalMove if the game is over
+        """
+        drawn_card = self.engine.draw()
+        self._sync()
+        return drawn_card
+
+    def computer_take_turn(self):
+        """plays the turn of the computer, drawing until a card can be
+           played and ending the game if necessary.  The turn is applied to
+           the game in memory; the game is written once, by the caller
+        """
+        player = computer_player(self.difficulty)
+        self.engine.take_computer_turn(player)
+        self._sync()
+        if self.engine.game_over:
+            self.game_message = 'Game Over!  Computer wins!'
+            self.end_game(False)
 
     def to_form(self, form_message=''):
         """Returns a GameForm representation of the Game"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_one_name = self.user_one.get().name
-        form.user_two_name = self.user_two.get().name
-        form.player_one_hand = self.to_card_type(self.player_one_hand)
-        form.player_two_hand = self.to_card_type(self.player_two_hand)
-        form.discard_pile = self.to_card_type(self.discard_pile)
+        form.user_one_name = self.player_name(True)
+        form.user_two_name = self.player_name(False)
+        cards = self.cards
+        form.player_one_hand = cards_to_text(cards.hands[0])
+        form.player_two_hand = cards_to_text(cards.hands[1])
+        form.discard_pile = cards_to_text(cards.discard_pile)
         form.current_suit = self.current_suit
-        form.undrawn_cards = self.to_card_type(self.undrawn_cards)
+        form.undrawn_cards = cards_to_text(cards.undrawn_cards)
         form.user_one_turn = self.user_one_turn
         form.game_over = self.game_over
         form.cancelled = self.cancelled
         form.date = str(self.date)
+        form.difficulty = self.difficulty
+        form.version = self.version
         if self.game_message:
             form.message = self.game_message
         else:
             form.message = form_message
         return form
 
-    def to_history_form(self):
-        """returns a history form representation of the game history"""
+    def to_compact_form(self, form_message='', since_move=None):
+        """Returns a compact GameForm representation of the Game, holding
+           card numbers and pile sizes instead of card text.  If since_move
+           is the move_count of an earlier form of a logged game, returns a
+           delta form holding only the move log records made since then and
+           the fields they changed
+        """
+        form = GameForm()
+        form.urlsafe_key = self.key.urlsafe()
+        form.user_one_turn = self.user_one_turn
+        form.game_over = self.game_over
+        form.cancelled = self.cancelled
+        form.version = self.version
+        form.message = self.game_message or form_message
+        if self.move_count:
+            engine = getattr(self, '_engine', None)
+            form.move_count = self.move_count + len(engine.moves
+                                                    if engine else ())
+            if since_move is not None and 0 < since_move <= form.move_count:
+                form.moves = [record for _, record
+                              in self._records_since(since_move)]
+                form.changed = changed_fields(form.moves)
+                self._set_compact_fields(form, form.changed)
+                return form
+        form.user_one_name = self.player_name(True)
+        form.user_two_name = self.player_name(False)
+        form.date = str(self.date)
+        form.difficulty = self.difficulty
+        self._set_compact_fields(form, COMPACT_FIELDS)
+        return form
+
+    def _set_compact_fields(self, form, fields):
+        """set the named compact card fields of form from the game"""
+        if not fields:
+            return
+        cards = self.cards
+        if 'player_one_cards' in fields:
+            form.player_one_cards = list(cards.hands[0])
+        if 'player_two_cards' in fields:
+            form.player_two_cards = list(cards.hands[1])
+        if 'top_card' in fields:
+            form.top_card = cards.discard_pile.top()
+        if 'discard_count' in fields:
+            form.discard_count = len(cards.discard_pile)
+        if 'undrawn_count' in fields:
+            form.undrawn_count = len(cards.undrawn_cards)
+        if 'current_suit' in fields:
+            form.current_suit = self.current_suit
+
+    def to_history_form(self, start=0, limit=None):
+        """returns a history form representation of the game history,
+           holding limit moves from move index start.  Games with a move
+           log read only the MoveLog entities holding the page
+        """
         form = GameHistoryForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_one_name = self.user_one.get().name
-        form.user_two_name = self.user_two.get().name
+        form.user_one_name = self.player_name(True)
+        form.user_two_name = self.player_name(False)
         form.date = str(self.date)
-        form.move = self.move
+        if self.move_count:
+            form.move, form.next_page_token = self._logged_history(start,
+                                                                   limit)
+            return form
+        if limit is None:
+            limit = len(self.move)
+        form.move = self.move[start:start + limit]
+        if start + limit < len(self.move):
+            form.next_page_token = str(start + limit)
         return form
 
+    def _logged_history(self, start, limit):
+        """returns (moves, next_page_token) of up to limit history strings
+           from move log record index start; records not shown in game
+           history, such as the deal, are skipped
+        """
+        moves = []
+        user_one_name = self.player_name(True)
+        user_two_name = self.player_name(False)
+        for index, record in self._records_since(start):
+            game_move = describe_move(record, user_one_name, user_two_name)
+            if game_move is None:
+                continue
+            if limit is not None and len(moves) == limit:
+                return moves, str(index)
+            moves.append(game_move)
+        return moves, None
+
+    def _records_since(self, start):
+        """yields (index, record) of the move log records of the game from
+           record index start, reading only the MoveLog entities holding
+           them.  Nothing is read if start is past the last written record
+        """
+        if start < self.move_count:
+            query = MoveLog.query(ancestor=self.key).filter(
+                MoveLog.last >= start).order(MoveLog.last)
+            for log in query:
+                for index, record in enumerate(log.records(), log.first):
+                    if index >= start:
+                        yield index, record
+        engine = getattr(self, '_engine', None)
+        if engine is not None:
+            for index, record in enumerate(engine.moves, self.move_count):
+                if index >= start:
+                    yield index, record
+
     def cancel_game(self):
         """cancels current game"""
         self.cancelled = True
         self.game_over = True
-        self.put()
 
     def end_game(self, user_one_turn):
-        """ends game when over"""
+        """ends game when over, creating its Score, which is written with
+           the game and the players' statistics when the game is committed
+        """
         self.game_over = True
-        self.put()
         if user_one_turn:
             score = Score(winning_user=self.user_one,
-                          losing_user=self.user_two, date=date.today())
+                          winning_user_name=self.player_name(True),
+                          losing_user=self.user_two,
+                          losing_user_name=self.player_name(False),
+                          date=date.today())
         else:
             score = Score(winning_user=self.user_two,
-                          losing_user=self.user_one, date=date.today())
-        # Add the game to the score 'board'
-        score.put()
+                          winning_user_name=self.player_name(False),
+                          losing_user=self.user_one,
+                          losing_user_name=self.player_name(True),
+                          date=date.today())
+        self._pending_score = score
+
+    def pending_score(self):
+        """returns Score created by end_game that is not yet written, or
+           None
+        """
+        return getattr(self, '_pending_score', None)
+
+
+# compact GameForm fields holding the cards of a game
+COMPACT_FIELDS = ('player_one_cards', 'player_two_cards', 'top_card',
+                  'discard_count', 'undrawn_count', 'current_suit')
+
+
+def changed_fields(records):
+    """returns the compact GameForm fields changed by move log records,
+       in COMPACT_FIELDS order.  Turn and game over are always sent
+    """
+    changed = set()
+    for record in records:
+        action, user_one_turn, _, _ = decode_move(record)
+        hand = 'player_one_cards' if user_one_turn else 'player_two_cards'
+        if action == PLAY:
+            changed.update((hand, 'top_card', 'discard_count',
+                            'current_suit'))
+        elif action == DRAW:
+            changed.update((hand, 'undrawn_count'))
+        elif action in (RESHUFFLE, DECK):
+            changed.update(('discard_count', 'undrawn_count'))
+        elif action == DEAL:
+            changed.update(COMPACT_FIELDS)
+    return [field for field in COMPACT_FIELDS if field in changed]
+
+
+class MoveLog(ndb.Model):
+    """MoveLog object holding a run of records appended to the move log of
+       a Game by one write of the game.  Child of the Game, keyed by the
+       index of its first record plus one
+        Attributes:
+            first: index in the move log of the first record
+            last: index in the move log of the last record, used to find
+                  the MoveLog entities holding a page of game history
+            moves: records packed as little-endian 16-bit integers, see
+                   replay.py for the record format
+    """
+    first = ndb.IntegerProperty(required=True, indexed=False)
+    last = ndb.IntegerProperty(required=True)
+    moves = ndb.BlobProperty(required=True)
+
+    @classmethod
+    def key_for(cls, game_key, first):
+        """returns key of MoveLog of game starting at record index first"""
+        return ndb.Key(cls, first + 1, parent=game_key)
+
+    def records(self):
+        """returns list of records held"""
+        return unpack_moves(self.moves)
+
+
+class ArchivedGame(ndb.Model):
+    """ArchivedGame object holding the players and result of a finished or
+       cancelled Game moved out of the Game kind by the archive games cron,
+       keyed by the id of the Game.  The cards are dropped; the history
+       stays in the MoveLog entities under the key of the Game
+        Attributes:
+            game: key of the archived Game, the ancestor of its MoveLog
+                  entities
+            user_one: key property referencing User class
+            user_two: key property referencing User class
+            user_one_name: name of user one, updated when user renamed
+            user_two_name: name of user two, updated when user renamed
+            winner: key property referencing the winning User, None if the
+                    game was cancelled
+            cancelled: boolean property indicating if game was cancelled
+            date: date the game was created
+            move_count: number of records in the move log of the game
+            move: game history strings of games created before moves were
+                  logged in MoveLog entities
+            archived: date the game was archived
+    """
+    game = ndb.KeyProperty(required=True, kind='Game', indexed=False)
+    user_one = ndb.KeyProperty(required=True, kind='User')
+    user_two = ndb.KeyProperty(required=True, kind='User')
+    user_one_name = ndb.StringProperty(indexed=False)
+    user_two_name = ndb.StringProperty(indexed=False)
+    winner = ndb.KeyProperty(kind='User', indexed=False)
+    cancelled = ndb.BooleanProperty(required=True, indexed=False)
+    date = ndb.DateProperty(required=True, indexed=False)
+    move_count = ndb.IntegerProperty(default=0, indexed=False)
+    move = ndb.StringProperty(repeated=True, indexed=False)
+    archived = ndb.DateProperty(required=True, indexed=False)
+
+    # (user key property, user name property) pairs stored on the game
+    USER_NAME_PROPERTIES = Game.USER_NAME_PROPERTIES
+
+    @classmethod
+    def key_for(cls, game_key):
+        """returns key of the ArchivedGame of the Game game_key points to"""
+        return ndb.Key(cls, game_key.id())
+
+    @classmethod
+    def get_for_game(cls, urlsafe):
+        """returns ArchivedGame of the Game the urlsafe key points to, or
+           None if the game is not archived
+        """
+        return cls.key_for(ndb.Key(urlsafe=urlsafe)).get()
+
+    @classmethod
+    def from_game(cls, game):
+        """returns ArchivedGame of a finished or cancelled game"""
+        winner = None
+        if not game.cancelled:
+            hands = game.cards.hands
+            if not hands[0]:
+                winner = game.user_one
+            elif not hands[1]:
+                winner = game.user_two
+        return cls(key=cls.key_for(game.key),
+                   game=game.key,
+                   user_one=game.user_one,
+                   user_two=game.user_two,
+                   user_one_name=game.player_name(True),
+                   user_two_name=game.player_name(False),
+                   winner=winner,
+                   cancelled=game.cancelled,
+                   date=game.date,
+                   move_count=game.move_count,
+                   move=game.move,
+                   archived=date.today())
+
+    def to_history_form(self, start=0, limit=None):
+        """returns a history form of the archived game, read from the move
+           log of the game like the history of an active game
+        """
+        game = Game(key=self.game, user_one_name=self.user_one_name,
+                    user_two_name=self.user_two_name, date=self.date,
+                    move_count=self.move_count, move=self.move)
+        return game.to_history_form(start, limit)
 
 
 class Score(ndb.Model):
     """Score object that tracks winners and losers.
         Attributes:
             winning_user: winning user key
+            winning_user_name: name of winning user, stored when game
+                               ends and updated when user renamed
             losing_user: losing user key
+            losing_user_name: name of losing user, stored when game
+                              ends and updated when user renamed
             date: date Game completed
+            participants: winning and losing user keys, set when the score
+                          is written, so the scores of a user are read
+                          with one cursorable query
     """
     winning_user = ndb.KeyProperty(required=True, kind='User')
+    winning_user_name = ndb.StringProperty(indexed=False)
     losing_user = ndb.KeyProperty(required=True, kind='User')
+    losing_user_name = ndb.StringProperty(indexed=False)
     date = ndb.DateProperty(required=True)
+    participants = ndb.KeyProperty(kind='User', repeated=True)
+
+    # (user key property, user name property) pairs stored on the score
+    USER_NAME_PROPERTIES = (('winning_user', 'winning_user_name'),
+                            ('losing_user', 'losing_user_name'))
+
+    def _pre_put_hook(self):
+        """set the participants from the winning and losing users"""
+        self.participants = participant_keys(self.winning_user,
+                                             self.losing_user)
 
     def to_form(self):
         """returns form representation of Score object"""
-        return ScoreForm(winning_user_name=self.winning_user.get().name,
-                         losing_user_name=self.losing_user.get().name,
+        if self.winning_user_name is None:
+            self.winning_user_name = self.winning_user.get().name
+        if self.losing_user_name is None:
+            self.losing_user_name = self.losing_user.get().name
+        return ScoreForm(winning_user_name=self.winning_user_name,
+                         losing_user_name=self.losing_user_name,
                          date=str(self.date))
 
 
+class UserStats(ndb.Model):
+    """UserStats object holding running win and loss totals of a User,
+       keyed by the User key id and updated when each game ends
+        Attributes:
+            user: key property referencing User class
+            user_name: user name when statistics last updated
+            wins: number of games won
+            losses: number of games lost
+            games: number of games played
+            winning_percentage: games won/games played, used to rank users
+    """
+    user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty()
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    losses = ndb.IntegerProperty(default=0, indexed=False)
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    winning_percentage = ndb.FloatProperty(default=0.0)
+
+    @classmethod
+    def key_for(cls, user_key):
+        """returns UserStats key of user"""
+        return ndb.Key(cls, user_key.id())
+
+    @classmethod
+    def record_game(cls, winning_user, winning_user_name,
+                    losing_user, losing_user_name):
+        """adds a win and a loss for a finished game.  Must be called inside
+           the transaction writing the game Score.  Users named in
+           SHARDED_USER_NAMES are counted in UserStatsShard entities and
+           folded into their UserStats by a transactional task.
+        """
+        results = [(winning_user, winning_user_name, True),
+                   (losing_user, losing_user_name, False)]
+        stats_keys = []
+        for user_key, user_name, won in results:
+            if user_name in SHARDED_USER_NAMES:
+                UserStatsShard.record_result(user_key, won)
+            elif cls.key_for(user_key) not in stats_keys:
+                stats_keys.append(cls.key_for(user_key))
+        if not stats_keys:
+            return
+        updated = {}
+        for stats_key, stats in zip(stats_keys, ndb.get_multi(stats_keys)):
+            updated[stats_key] = stats
+        for user_key, user_name, won in results:
+            if user_name in SHARDED_USER_NAMES:
+                continue
+            stats_key = cls.key_for(user_key)
+            stats = updated[stats_key]
+            if stats is None:
+                stats = cls(key=stats_key, user=user_key)
+                updated[stats_key] = stats
+            stats.user_name = user_name
+            stats.add_result(won)
+        ndb.put_multi(updated.values())
+
+    @classmethod
+    def rebuild(cls, user):
+        """recounts statistics of user from its Score entities"""
+        wins = Score.query(Score.winning_user == user.key).count()
+        losses = Score.query(Score.losing_user == user.key).count()
+        if user.name in SHARDED_USER_NAMES:
+            shard_keys = UserStatsShard.shard_keys(user.key)
+            ndb.delete_multi(shard_keys[1:])
+            UserStatsShard(key=shard_keys[0], user=user.key,
+                           wins=wins, losses=losses).put()
+            UserStatsShard.fold(user.key)
+        elif wins or losses:
+            cls(key=cls.key_for(user.key), user=user.key,
+                user_name=user.name, wins=wins, losses=losses).put()
+
+    def add_result(self, won):
+        """adds a win or a loss to the totals"""
+        if won:
+            self.wins += 1
+        else:
+            self.losses += 1
+
+    def _pre_put_hook(self):
+        """keeps games and winning percentage in step with the totals"""
+        self.games = self.wins + self.losses
+        if self.games:
+            self.winning_percentage = float(self.wins)/float(self.games)
+        else:
+            self.winning_percentage = 0.0
+
+    def to_form(self):
+        """returns UserRankingForm representation of statistics"""
+        return UserRankingForm(user_name=self.user_name,
+                               wins=self.wins,
+                               losses=self.losses,
+                               games=self.games,
+                               winning_percentage=self.winning_percentage)
+
+
+class UserStatsShard(ndb.Model):
+    """UserStatsShard object holding part of the win and loss totals of a
+       heavily played user, such as Computer, so that concurrent game ends
+       do not contend on a single UserStats entity
+        Attributes:
+            user: key property referencing User class
+            wins: number of games won counted in this shard
+            losses: number of games lost counted in this shard
+    """
+    user = ndb.KeyProperty(required=True, kind='User')
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    losses = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def shard_keys(cls, user_key):
+        """returns keys of every shard of user"""
+        return [ndb.Key(cls, '%s-%d' % (user_key.id(), index))
+                for index in range(USER_STATS_SHARDS)]
+
+    @classmethod
+    def record_result(cls, user_key, won):
+        """adds a win or a loss to a random shard of user and queues the
+           shards to be folded into UserStats when the transaction commits
+        """
+        shard_key = random.choice(cls.shard_keys(user_key))
+        shard = shard_key.get()
+        if shard is None:
+            shard = cls(key=shard_key, user=user_key)
+        if won:
+            shard.wins += 1
+        else:
+            shard.losses += 1
+        shard.put()
+        taskqueue.add(url='/tasks/fold_user_stats',
+                      params={'user_key': user_key.urlsafe()},
+                      transactional=True)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def fold(cls, user_key):
+        """sets UserStats of user to the sum of its shards, in one cross
+           group transaction over the shards, the UserStats and the User,
+           so a concurrent or retried fold cannot write a stale sum
+        """
+        stats = UserStats.key_for(user_key).get()
+        if stats is None:
+            stats = UserStats(key=UserStats.key_for(user_key), user=user_key)
+        shards = [shard for shard in ndb.get_multi(cls.shard_keys(user_key))
+                  if shard is not None]
+        stats.wins = sum(shard.wins for shard in shards)
+        stats.losses = sum(shard.losses for shard in shards)
+        stats.user_name = user_key.get().name
+        stats.put()
+
+
+class ScoreRollup(ndb.Model):
+    """ScoreRollup object holding wins and losses of users over one day or
+       one month, used to rank users over a window of dates.  Each daily
+       rollup holds one user, keyed by the day and the user, so game ends
+       of different users never write the same entity; the days of
+       SHARDED_USER_NAMES are split into ROLLUP_SHARDS shards.  Monthly
+       rollups hold every user who finished a game in the month and are
+       written from the days by a cron once the month is over
+        Attributes:
+            period: 'day' or 'month'
+            start: date property holding first day of the period
+            results: dict of user key id to [user name, wins, losses]
+    """
+    period = ndb.StringProperty(required=True)
+    start = ndb.DateProperty(required=True)
+    results = ndb.JsonProperty(compressed=True)
+
+    @classmethod
+    def key_for(cls, period, start, shard=0):
+        """returns key of shard of rollup of period starting on start"""
+        return ndb.Key(cls, '%s-%s-%d' % (period, start.isoformat(), shard))
+
+    @classmethod
+    def key_for_user(cls, day, user_key, user_name):
+        """returns key of the daily rollup of user on day, a random shard
+           of it if the user is sharded
+        """
+        shard = (random.randrange(ROLLUP_SHARDS)
+                 if user_name in SHARDED_USER_NAMES else 0)
+        return ndb.Key(cls, 'day-%s-%s-%d' % (day.isoformat(),
+                                              user_key.id(), shard))
+
+    @classmethod
+    def record_score(cls, score):
+        """adds the win and loss of score to the daily rollups of the
+           winner and the loser.  Must be called inside the transaction
+           writing the Score
+        """
+        results = [(score.winning_user, score.winning_user_name, 1, 0),
+                   (score.losing_user, score.losing_user_name, 0, 1)]
+        keys = [cls.key_for_user(score.date, user_key, user_name)
+                for user_key, user_name, _, _ in results]
+        rollups = {}
+        for key, rollup in zip(keys, ndb.get_multi(keys)):
+            rollups[key] = rollups.get(key) or rollup or cls(
+                key=key, period='day', start=score.date, results={})
+        for key, (user_key, user_name, wins, losses) in zip(keys, results):
+            rollups[key].add(user_key.id(), user_name, wins, losses)
+        ndb.put_multi(rollups.values())
+
+    @classmethod
+    def window(cls, first_day, last_day):
+        """returns a ScoreRollup merging the results of every day from
+           first_day to last_day.  Months inside the window that have been
+           compacted are read as one monthly rollup, and only the other
+           days are read as daily rollups.  Raises ValueError if the window
+           starts or ends inside a month whose daily rollups are deleted
+        """
+        kept = first_daily_day(date.today())
+        if ((first_day.day != 1 and first_day < kept) or
+                (last_day + timedelta(1) != add_month(last_day) and
+                 last_day.replace(day=1) < kept)):
+            raise ValueError('Partial month before %s' % kept)
+        months = []
+        month = first_day.replace(day=1)
+        while month <= last_day:
+            next_month = add_month(month)
+            if month >= first_day and next_month - timedelta(1) <= last_day:
+                months.append(month)
+            month = next_month
+        monthly = [rollup for rollup in ndb.get_multi(
+            [cls.key_for('month', month) for month in months]) if rollup]
+        # runs of days not covered by a monthly rollup
+        covered = sorted(rollup.start for rollup in monthly)
+        runs = []
+        run_start = first_day
+        for month in covered:
+            if run_start < month:
+                runs.append((run_start, month - timedelta(1)))
+            run_start = add_month(month)
+        if run_start <= last_day:
+            runs.append((run_start, last_day))
+        queries = [cls.query(cls.period == 'day', cls.start >= run_first,
+                             cls.start <= run_last).fetch_async()
+                   for run_first, run_last in runs]
+        window = cls(period='window', start=first_day, results={})
+        for rollup in monthly:
+            window.merge(rollup)
+        for query in queries:
+            for rollup in query.get_result():
+                window.merge(rollup)
+        return window
+
+    @classmethod
+    def compact_month(cls, month):
+        """writes the monthly rollup of month, the first day of a month
+           that is over, merging its daily rollups
+        """
+        rollup = cls(key=cls.key_for('month', month), period='month',
+                     start=month, results={})
+        for daily in cls.query(cls.period == 'day', cls.start >= month,
+                               cls.start < add_month(month)):
+            rollup.merge(daily)
+        rollup.put()
+
+    def add(self, user_id, user_name, wins, losses):
+        """adds wins and losses of a user to the rollup"""
+        # JSON object keys are strings
+        result = self.results.setdefault(str(user_id), [user_name, 0, 0])
+        if user_name:
+            result[0] = user_name
+        result[1] += wins
+        result[2] += losses
+
+    def merge(self, rollup):
+        """adds every result of another rollup to this one"""
+        for user_id, (user_name, wins, losses) in rollup.results.items():
+            self.add(user_id, user_name, wins, losses)
+
+    def to_forms(self, limit):
+        """returns UserRankingForms of the limit best users, ranked by
+           winning percentage then by games played
+        """
+        ranked = sorted(self.results.values(),
+                        key=lambda result: (float(result[1]) /
+                                            (result[1] + result[2]),
+                                            result[1] + result[2]),
+                        reverse=True)
+        return UserRankingForms(items=[
+            UserRankingForm(user_name=user_name, wins=wins, losses=losses,
+                            games=wins + losses,
+                            winning_percentage=(float(wins) /
+                                                (wins + losses)))
+            for user_name, wins, losses in ranked[:limit]])
+
+
+class ReminderRun(ndb.Model):
+    """ReminderRun object checkpointing the progress of one run of the
+       reminder email cron, keyed by the date of the run
+        Attributes:
+            cursor: urlsafe query cursor of the next batch of active games
+            batches: number of batches completed
+            sent: number of users reminded
+            done: boolean property indicating if every batch is complete
+    """
+    cursor = ndb.StringProperty(indexed=False)
+    batches = ndb.IntegerProperty(default=0, indexed=False)
+    sent = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+
+
+class ReminderSent(ndb.Model):
+    """ReminderSent marker recording that a user has been reminded in a
+       ReminderRun, child of the run and keyed by the urlsafe User key
+    """
+
+    @classmethod
+    def key_for(cls, run_key, user_key):
+        """returns key of marker of user in run"""
+        return ndb.Key(cls, user_key.urlsafe(), parent=run_key)
+
+
+class ExportRun(ndb.Model):
+    """ExportRun object holding the settings and progress of one bulk
+       export of a kind, split into ExportShards.  Shards and chunks are
+       root entities, so the shards of a run are checkpointed in parallel
+       without contending on the run
+        Attributes:
+            kind: exported kind, a key of export.EXPORT_KINDS
+            format: output format, 'ndjson' or 'csv'
+            shards: number of shards the keyspace was split into
+            shards_done: number of shards that have written every batch,
+                         recorded by a task queued by each finished shard
+            done: boolean property indicating if every shard is complete
+            date: date property holding date started
+    """
+    kind = ndb.StringProperty(required=True, indexed=False)
+    format = ndb.StringProperty(required=True, indexed=False)
+    shards = ndb.IntegerProperty(required=True, indexed=False)
+    shards_done = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    date = ndb.DateProperty(required=True)
+
+    def shard_keys(self):
+        """returns keys of the ExportShards of the run, in shard order"""
+        return [ExportShard.key_for(self.key.id(), number)
+                for number in range(1, self.shards + 1)]
+
+
+class ExportShard(ndb.Model):
+    """ExportShard object checkpointing the export of one key range of an
+       ExportRun, keyed by the run id and the shard number, counted from
+       one
+        Attributes:
+            run_id: id of the ExportRun
+            number: shard number, counted from one
+            lower: key property holding first key of the range, or None
+                   to start at the first entity
+            upper: key property holding key the range stops before, or
+                   None to run to the last entity
+            cursor: urlsafe query cursor of the next batch
+            batches: number of batches written, each one ExportChunk
+            rows: number of rows written
+            done: boolean property indicating if every batch is written
+    """
+    run_id = ndb.IntegerProperty(required=True, indexed=False)
+    number = ndb.IntegerProperty(required=True, indexed=False)
+    lower = ndb.KeyProperty(indexed=False)
+    upper = ndb.KeyProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    batches = ndb.IntegerProperty(default=0, indexed=False)
+    rows = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+
+    @classmethod
+    def key_for(cls, run_id, number):
+        """returns key of shard number of the ExportRun of run_id"""
+        return ndb.Key(cls, '%d-%d' % (run_id, number))
+
+
+class ExportChunk(ndb.Model):
+    """ExportChunk object holding the output of one batch of an
+       ExportShard, keyed by the shard key id and the batch number
+        Attributes:
+            data: newline delimited JSON or CSV text of the batch rows
+    """
+    data = ndb.BlobProperty(required=True, compressed=True)
+
+    @classmethod
+    def key_for(cls, shard_key, batch):
+        """returns key of the chunk of batch of the shard shard_key points
+           to
+        """
+        return ndb.Key(cls, '%s-%d' % (shard_key.id(), batch))
+
+
+def add_month(day):
+    """returns first day of the month after the month of day"""
+    if day.month == 12:
+        return date(day.year + 1, 1, 1)
+    return date(day.year, day.month + 1, 1)
+
+
+def first_daily_day(today):
+    """returns first day from which daily score rollups are kept on
+       today; the days of earlier months are only in monthly rollups
+    """
+    return (today - timedelta(ROLLUP_DAILY_DAYS)).replace(day=1)
+
+
+def participant_keys(*user_keys):
+    """returns list of the distinct user keys in order, stored as the
+       participants of a game or score so a user playing themself is
+       matched once by participant queries
+    """
+    keys = []
+    for user_key in user_keys:
+        if user_key not in keys:
+            keys.append(user_key)
+    return keys
+
+
+def prefetch_user_names(entities):
+    """fills in user names missing from a page of Game or Score entities
+       stored before names were kept on them, resolving every referenced
+       User with one batched get instead of one get per entity
+    """
+    missing = []
+    for entity in entities:
+        for key_property, name_property in entity.USER_NAME_PROPERTIES:
+            if getattr(entity, name_property) is None:
+                missing.append((entity, name_property,
+                                getattr(entity, key_property)))
+    if missing:
+        user_keys = list(set(user_key for _, _, user_key in missing))
+        users = dict(zip(user_keys, ndb.get_multi(user_keys)))
+        for entity, name_property, user_key in missing:
+            if users[user_key]:
+                setattr(entity, name_property, users[user_key].name)
+    return entities
+
+
 class UserForm(messages.Message):
     """UserForm for username and email information"""
     user_name = messages.StringField(1, required=True)
@@ -431,20 +1258,36 @@ class UserForm(messages.Message):
 
 
 class GameForm(messages.Message):
-    """GameForm for outbound game state information"""
+    """GameForm for outbound game state information.  Full forms hold the
+    card text fields; compact forms hold card numbers (0-51) and pile sizes
+    in fields 15-20 instead, and a delta form only the new move log records
+    and the fields listed in changed"""
     urlsafe_key = messages.StringField(1, required=True)
-    user_one_name = messages.StringField(2, required=True)
-    user_two_name = messages.StringField(3, required=True)
-    player_one_hand = messages.StringField(4, required=True)
-    player_two_hand = messages.StringField(5, required=True)
-    discard_pile = messages.StringField(6, required=True)
-    current_suit = messages.StringField(7, required=True)
-    undrawn_cards = messages.StringField(8, required=True)
+    user_one_name = messages.StringField(2)
+    user_two_name = messages.StringField(3)
+    player_one_hand = messages.StringField(4)
+    player_two_hand = messages.StringField(5)
+    discard_pile = messages.StringField(6)
+    current_suit = messages.StringField(7)
+    undrawn_cards = messages.StringField(8)
     user_one_turn = messages.BooleanField(9, required=True)
     game_over = messages.BooleanField(10, required=True)
     cancelled = messages.BooleanField(11, required=True)
-    date = messages.StringField(12, required=True)
+    date = messages.StringField(12)
     message = messages.StringField(13)
+    difficulty = messages.StringField(14)
+    player_one_cards = messages.IntegerField(15, repeated=True,
+                                             variant=messages.Variant.INT32)
+    player_two_cards = messages.IntegerField(16, repeated=True,
+                                             variant=messages.Variant.INT32)
+    top_card = messages.IntegerField(17, variant=messages.Variant.INT32)
+    discard_count = messages.IntegerField(18, variant=messages.Variant.INT32)
+    undrawn_count = messages.IntegerField(19, variant=messages.Variant.INT32)
+    move_count = messages.IntegerField(20, variant=messages.Variant.INT32)
+    moves = messages.IntegerField(21, repeated=True,
+                                  variant=messages.Variant.INT32)
+    changed = messages.StringField(22, repeated=True)
+    version = messages.IntegerField(23, variant=messages.Variant.INT32)
 
 
 class GameHistoryForm(messages.Message):
@@ -454,12 +1297,14 @@ class GameHistoryForm(messages.Message):
     user_two_name = messages.StringField(3, required=True)
     date = messages.StringField(4, required=True)
     move = messages.StringField(5, repeated=True)
+    next_page_token = messages.StringField(6)
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     user_one_name = messages.StringField(1, required=True)
     user_two_name = messages.StringField(2, required=True)
+    difficulty = messages.StringField(3)
 
 
 class PlayCardForm(messages.Message):
@@ -488,16 +1333,19 @@ class UserRankingForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 
 class UserRankingForms(messages.Message):
     """Return multiple UserRankingForms"""
     items = messages.MessageField(UserRankingForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 
 class GameForms(messages.Message):
     """Return multiple GameForms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
@@ -17,6 +17,32 @@ var crazyeightsApp = crazyeightsApp || {};
  */
 crazyeightsApp.controllers = angular.module('conferenceControllers', ['ui.bootstrap']);
 
+/**
+ * Number of items requested per page from the paged crazy eights API methods.
+ *
+ * @type {number}
+ */
+var PAGE_SIZE = 50;
+
+/**
+ * Suits and number values of the cards in card number (0-51) order, used to
+ * read the compact game forms.
+ *
+ * @type {Array}
+ */
+var CARD_SUITS = ['hearts', 'diamonds', 'clubs', 'spades'];
+var CARD_NUMBER_VALUES = ['A', '2', '3', '4', '5', '6', '7', '8', '9', '10',
+    'J', 'Q', 'K'];
+
+/**
+ * Card fields of a compact game form, sent in a delta form only if listed
+ * in its changed field.
+ *
+ * @type {Array}
+ */
+var COMPACT_FIELDS = ['player_one_cards', 'player_two_cards', 'top_card',
+    'discard_count', 'undrawn_count', 'current_suit'];
+
 /**
  * @ngdoc controller
  * @name MyProfileCtrl
@@ -260,13 +286,10 @@ crazyeightsApp.controllers.controller('PlayGameCtrl', function($scope, $log, $ro
 
     $scope.resetHands = function() {
 
-        $scope.game.length = 0;
-        $scope.player_one_hand.length = 0;
+        $scope.player_one_hand = [];
         $scope.player_one_hand_cards.length = 0;
-        $scope.player_two_hand.length = 0;
+        $scope.player_two_hand = [];
         $scope.player_two_hand_cards.length = 0;
-        $scope.discard_pile.length = 0;
-        $scope.discard_pile_top_card.length = 0;
     };
 
     /**
@@ -306,6 +329,112 @@ crazyeightsApp.controllers.controller('PlayGameCtrl', function($scope, $log, $ro
 
     };
 
+    /**
+     * Converts card number (0-51) of a compact game form into image ref with
+     * card number and suit.
+     */
+
+    $scope.getCardFromNumber = function(card_id) {
+        var suit = CARD_SUITS[Math.floor(card_id / 13)];
+        var card_number = CARD_NUMBER_VALUES[card_id % 13];
+        return {
+            img: card_number.concat("_", suit, ".png"),
+            card_number: card_number,
+            card_suit: suit
+        };
+    };
+
+    /**
+     * Shows a compact game form.  A full form replaces the game; a delta form,
+     * which has no user names, updates only the turn, the message and the card
+     * fields listed in changed.  Empty card lists are left out of the response,
+     * so a changed field that is missing is empty.
+     */
+
+    $scope.showGame = function(result) {
+        if (result.user_one_name !== undefined) {
+            $scope.game = result;
+        } else {
+            var changed = result.changed || [];
+            COMPACT_FIELDS.forEach(function(field) {
+                if (changed.indexOf(field) >= 0) {
+                    $scope.game[field] = result[field] === undefined ? [] : result[field];
+                }
+            });
+            $scope.game.user_one_turn = result.user_one_turn;
+            $scope.game.game_over = result.game_over;
+            $scope.game.cancelled = result.cancelled;
+            $scope.game.message = result.message;
+            $scope.game.move_count = result.move_count;
+            $scope.game.version = result.version;
+        }
+        $scope.resetHands();
+        $scope.player_one_hand = $scope.game.player_one_cards || [];
+        $scope.player_one_hand.forEach(function(card) {
+            $scope.player_one_hand_cards.push($scope.getCardFromNumber(card));
+        });
+        $scope.player_two_hand = $scope.game.player_two_cards || [];
+        $scope.player_two_hand.forEach(function(card) {
+            $scope.player_two_hand_cards.push($scope.getCardFromNumber(card));
+        });
+        $scope.discard_pile_top_card = $scope.getCardFromNumber($scope.game.top_card);
+        $scope.show_suit = $scope.discard_pile_top_card.card_number == '8';
+        $scope.game_over = $scope.game.game_over;
+        $scope.checkUserTurn();
+        if ($scope.is_user_one)
+        {
+            $scope.other_card_count = $scope.player_two_hand.length;
+        } else {
+            $scope.other_card_count = $scope.player_one_hand.length;
+        }
+        if (!$scope.game_over && !$scope.game.cancelled && !$scope.is_player_turn) {
+            $scope.waitForTurn();
+        }
+    };
+
+    /**
+     * Holds the status if a wait_for_turn request is pending, and if the page
+     * was left so no further requests are made.
+     */
+    $scope.waiting = false;
+    $scope.left_page = false;
+    $scope.$on('$destroy', function() {
+        $scope.left_page = true;
+    });
+
+    /**
+     * Invokes the wait_for_turn crazy eights API, which returns once the game
+     * version changes, and shows the game.  Called again by showGame until it
+     * is the player's turn, so an idle game makes about one request per move.
+     */
+
+    $scope.waitForTurn = function() {
+        if ($scope.waiting || $scope.left_page) {
+            return;
+        }
+        $scope.waiting = true;
+        gapi.client.crazyeights.wait_for_turn({
+            urlsafe_game_key: $routeParams.urlsafe_key,
+            version: $scope.game.version,
+            compact: true,
+            since_move: $scope.game.move_count
+        }).
+        execute(function(resp) {
+            $scope.$apply(function() {
+                $scope.waiting = false;
+                if (resp.error) {
+                    // The request has failed.
+                    var errorMessage = resp.error.message || '';
+                    $scope.messages = 'Failed to obtain the game : ' + errorMessage;
+                    $scope.alertStatus = 'warning';
+                    $log.error($scope.messages);
+                } else if (!$scope.left_page) {
+                    $scope.showGame(resp.result);
+                }
+            });
+        });
+    };
+
     /**
      * Invokes the play_card crazy eights API
      */
@@ -317,7 +446,9 @@ crazyeightsApp.controllers.controller('PlayGameCtrl', function($scope, $log, $ro
             'card_number': card_number,
             'card_suit': card_suit,
             'crazy_suit': crazy_suit,
-            urlsafe_game_key: $routeParams.urlsafe_key
+            urlsafe_game_key: $routeParams.urlsafe_key,
+            compact: true,
+            since_move: $scope.game.move_count
         }).
         execute(function(resp) {
             $scope.$apply(function() {
@@ -334,31 +465,7 @@ crazyeightsApp.controllers.controller('PlayGameCtrl', function($scope, $log, $ro
                     }
                 } else {
                     // The request has succeeded.
-                    $scope.game = resp.result;
-                    $scope.resetHands();
-                    $scope.player_one_hand = resp.result.player_one_hand.split('*');
-                    $scope.player_one_hand.forEach(function(card) {
-                        $scope.player_one_hand_cards.push($scope.getCardFromString(card));
-                    });
-                    $scope.player_two_hand = resp.result.player_two_hand.split('*');
-                    $scope.player_two_hand.forEach(function(card) {
-                        $scope.player_two_hand_cards.push($scope.getCardFromString(card));
-                    });
-                    $scope.discard_pile = resp.result.discard_pile.split('*');
-                    $scope.discard_pile_top_card = $scope.getCardFromString($scope.discard_pile[0]);
-                    if ($scope.discard_pile_top_card.card_number == '8') {
-                        $scope.show_suit = true;
-                    } else {
-                        $scope.show_suit = false;
-                    }
-                    $scope.game_over = resp.result.game_over;
-                    $scope.checkUserTurn();
-                    if ($scope.is_user_one)
-                    {
-                        $scope.other_card_count = $scope.player_two_hand.length;
-                    } else {
-                        $scope.other_card_count = $scope.player_one_hand.length;
-                    }
+                    $scope.showGame(resp.result);
                     $scope.loading = false;
 
                 }
@@ -404,7 +511,9 @@ crazyeightsApp.controllers.controller('PlayGameCtrl', function($scope, $log, $ro
             $scope.loading = true;
             gapi.client.crazyeights.draw_card({
                 'draw_card': true,
-                urlsafe_game_key: $routeParams.urlsafe_key
+                urlsafe_game_key: $routeParams.urlsafe_key,
+                compact: true,
+                since_move: $scope.game.move_count
             }).
             execute(function(resp) {
                 $scope.$apply(function() {
@@ -421,25 +530,7 @@ crazyeightsApp.controllers.controller('PlayGameCtrl', function($scope, $log, $ro
                         }
                     } else {
                         // The request has succeeded.
-                        $scope.game = resp.result;
-                        $scope.resetHands();
-                        $scope.player_one_hand = resp.result.player_one_hand.split('*');
-                        $scope.player_one_hand.forEach(function(card) {
-                            $scope.player_one_hand_cards.push($scope.getCardFromString(card));
-                        });
-                        $scope.player_two_hand = resp.result.player_two_hand.split('*');
-                        $scope.player_two_hand.forEach(function(card) {
-                            $scope.player_two_hand_cards.push($scope.getCardFromString(card));
-                        });
-                        $scope.discard_pile = resp.result.discard_pile.split('*');
-                        $scope.discard_pile_top_card = $scope.getCardFromString($scope.discard_pile[0]);
-                        $scope.checkUserTurn();
-                        if ($scope.is_user_one)
-                        {
-                        $scope.other_card_count = $scope.player_two_hand.length;
-                        } else {
-                        $scope.other_card_count = $scope.player_one_hand.length;
-                        }
+                        $scope.showGame(resp.result);
                         $scope.loading = false;
 
                     }
@@ -457,7 +548,9 @@ crazyeightsApp.controllers.controller('PlayGameCtrl', function($scope, $log, $ro
             $scope.loading = true;
             $scope.current_user = current_user_name.name;
             gapi.client.crazyeights.get_game({
-                urlsafe_game_key: $routeParams.urlsafe_key
+                urlsafe_game_key: $routeParams.urlsafe_key,
+                compact: true,
+                since_move: $scope.game.move_count
             }).
             execute(function(resp) {
                 $scope.$apply(function() {
@@ -474,28 +567,10 @@ crazyeightsApp.controllers.controller('PlayGameCtrl', function($scope, $log, $ro
                         }
                     } else {
                         // The request has succeeded.
-                        $scope.game = resp.result;
-                        $scope.game_over = resp.result.game_over;
-                        $scope.player_one_hand = resp.result.player_one_hand.split('*');
-                        $scope.player_one_hand.forEach(function(card) {
-                            $scope.player_one_hand_cards.push($scope.getCardFromString(card));
-                        });
-                        $scope.player_two_hand = resp.result.player_two_hand.split('*');
-                        $scope.player_two_hand.forEach(function(card) {
-                            $scope.player_two_hand_cards.push($scope.getCardFromString(card));
-                        });
-                        $scope.discard_pile = resp.result.discard_pile.split('*');
-                        $scope.discard_pile_top_card = $scope.getCardFromString($scope.discard_pile[0]);
                         if (resp.result.user_one_name == current_user_name.name || resp.result.user_two_name == "Computer") {
                             $scope.is_user_one = true;
                         }
-                        $scope.checkUserTurn();
-                        if ($scope.is_user_one)
-                        {
-                        $scope.other_card_count = $scope.player_two_hand.length;
-                        } else {
-                        $scope.other_card_count = $scope.player_one_hand.length;
-                        }
+                        $scope.showGame(resp.result);
                         $scope.loading = false;
 
                     }
@@ -664,11 +739,16 @@ crazyeightsApp.controllers.controller('GameHistoryCtrl', function($scope, $log,
 
 
     $scope.init = function() {
-        var retrieveGameHistoryCallback = function() {
+        var retrieveGameHistoryCallback = function(page_token) {
             $scope.loading = true;
             $scope.current_user = current_user_name.name;
+            if (!page_token) {
+                $scope.game_moves = [];
+            }
             gapi.client.crazyeights.get_game_history({
-                urlsafe_game_key: $routeParams.urlsafe_key
+                urlsafe_game_key: $routeParams.urlsafe_key,
+                limit: PAGE_SIZE,
+                page_token: page_token
             }).
             execute(function(resp) {
                 $scope.$apply(function() {
@@ -686,12 +766,16 @@ crazyeightsApp.controllers.controller('GameHistoryCtrl', function($scope, $log,
                     } else {
                         // The request has succeeded.
                         $scope.game_history = resp.result;
-                        $scope.game_moves = [];
                         angular.forEach(resp.move, function(move) {
 
                             $scope.game_moves.push($scope.getMoveFromList(move.split(',')));
 
                         });
+                        // request the following page of moves, if any
+                        if (resp.next_page_token) {
+                            retrieveGameHistoryCallback(resp.next_page_token);
+                            return;
+                        }
 
                         $scope.loading = false;
 
@@ -702,7 +786,9 @@ crazyeightsApp.controllers.controller('GameHistoryCtrl', function($scope, $log,
         };
         if (!oauth2Provider.signedIn) {
             var modalInstance = oauth2Provider.showLoginModal();
-            modalInstance.result.then(retrieveGameHistoryCallback);
+            modalInstance.result.then(function() {
+                retrieveGameHistoryCallback();
+            });
         } else {
             retrieveGameHistoryCallback();
         }
@@ -735,84 +821,53 @@ crazyeightsApp.controllers.controller('ScoreCtrl',
 
 
         /**
-         * invokes the get_scores method of the crazy eights API
+         * Invokes a paged method of the crazy eights API, appending the items
+         * of each page to target and requesting the following page with the
+         * returned next_page_token until no pages remain.
          */
-        $scope.init = function() {
-            var retrieveScoresCallback = function() {
-                $scope.scores = [];
-                $scope.user_scores = [];
-                $scope.loading = true;
-                gapi.client.crazyeights.get_scores().
-                execute(function(resp) {
-                    $scope.$apply(function() {
-                        $scope.loading = false;
-                        if (resp.error) {
-                            // Failed to get a user profile.
-                        } else {
-                            // Succeeded to get the user profile.
-                            $scope.scores = [];
-                            angular.forEach(resp.items, function(score) {
-                                $scope.scores.push(score);
-                            });
+        $scope.loadPages = function(method, params, target) {
+            method(params).
+            execute(function(resp) {
+                $scope.$apply(function() {
+                    $scope.loading = false;
+                    if (resp.error) {
+                        // The request has failed.
+                        var errorMessage = resp.error.message || '';
+                        $scope.messages = 'Failed to get the scores : ' +
+                            ' ' + errorMessage;
+                        $scope.alertStatus = 'warning';
+                        $log.error($scope.messages);
+                    } else {
+                        // The request has succeeded.
+                        $scope.alertStatus = 'success';
+                        angular.forEach(resp.items, function(item) {
+                            target.push(item);
+                        });
+                        if (resp.next_page_token) {
+                            params.page_token = resp.next_page_token;
+                            $scope.loadPages(method, params, target);
                         }
-                    });
+                    }
                 });
-         /**
-         * invokes the get_user_scores method of the crazy eights API
-         */
-
-                gapi.client.crazyeights.get_user_scores({
-                        user_name: 'Larry'
-                    })
-                    .execute(function(resp) {
-                        $scope.$apply(function() {
-                            $scope.loading = false;
-                            if (resp.error) {
-                                // The request has failed.
-                                var errorMessage = resp.error.message || '';
-                                $scope.messages = 'Failed to get the games : ' +
-                                    ' ' + errorMessage;
-                                $scope.alertStatus = 'warning';
-                                $log.error($scope.messages);
-                            } else {
-                                // The request has succeeded.
-                                $scope.alertStatus = 'success';
-                                $scope.user_scores = [];
-                                angular.forEach(resp.items, function(score) {
-                                    $scope.user_scores.push(score);
-                                });
-                            }
-                        });
-                    });
+            });
+        };
 
         /**
-         * invokes the get_rankings method of the crazy eights API
+         * invokes the get_scores, get_user_scores and get_rankings methods
+         * of the crazy eights API
          */
-
-                gapi.client.crazyeights.get_all_rankings({
-                        'get_rankings': true
-                    })
-                    .execute(function(resp) {
-                        $scope.$apply(function() {
-                            $scope.loading = false;
-                            if (resp.error) {
-                                // The request has failed.
-                                var errorMessage = resp.error.message || '';
-                                $scope.messages = 'Failed to get the games : ' +
-                                    ' ' + errorMessage;
-                                $scope.alertStatus = 'warning';
-                                $log.error($scope.messages);
-                            } else {
-                                // The request has succeeded.
-                                $scope.alertStatus = 'success';
-                                $scope.rankings = [];
-                                angular.forEach(resp.items, function(ranking) {
-                                    $scope.rankings.push(ranking);
-                                });
-
-                            }
-                        });
-                    });
+        $scope.init = function() {
+            var retrieveScoresCallback = function() {
+                $scope.scores = [];
+                $scope.user_scores = [];
+                $scope.rankings = [];
+                $scope.loading = true;
+                $scope.loadPages(gapi.client.crazyeights.get_scores,
+                    {limit: PAGE_SIZE}, $scope.scores);
+                $scope.loadPages(gapi.client.crazyeights.get_user_scores,
+                    {user_name: 'Larry', limit: PAGE_SIZE}, $scope.user_scores);
+                $scope.loadPages(gapi.client.crazyeights.get_all_rankings,
+                    {limit: PAGE_SIZE}, $scope.rankings);
             };
             if (!oauth2Provider.signedIn) {
                 var modalInstance = oauth2Provider.showLoginModal();
@@ -0,0 +1,158 @@
+"""tests/test_game_cache.py - Tests of GameCache, backed by LocalMemcache,
+against the datastore stub of the App Engine SDK testbed.  Skipped unless
+the SDK is on the path or its directory is set in $GAE_SDK.  Run from the
+repository root with Python 2.7:
+
+    GAE_SDK=~/appengine python -m unittest discover tests"""
+
+__copyright__ = """
+    Copyright 2016 Christine Stoner
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+if os.environ.get('GAE_SDK'):
+    sys.path.insert(0, os.environ['GAE_SDK'])
+
+try:
+    import dev_appserver
+except ImportError:
+    dev_appserver = None
+else:
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed as testbed_module
+    from game_cache import GameCache, LocalMemcache
+    from models import Game, User
+    from unit_of_work import run_game_mutation
+
+
+class GameCacheTest(unittest.TestCase):
+    """GameCache reads, writes and invalidation"""
+
+    def setUp(self):
+        if dev_appserver is None:
+            raise unittest.SkipTest('App Engine SDK not found, set $GAE_SDK')
+        self.testbed = testbed_module.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='crazyeights-test', overwrite=True)
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        ndb.get_context().clear_cache()
+        user_one = User.create('one', 'one@example.com')
+        user_two = User.create('two', 'two@example.com')
+        self.game = Game.new_game(user_one.key, user_two.key, 'one', 'two')
+        self.urlsafe = self.game.key.urlsafe()
+        self.client = LocalMemcache()
+        self.cache = GameCache(self.client)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def stored_game(self):
+        """return the game as stored in the datastore"""
+        return self.game.key.get(use_cache=False, use_memcache=False)
+
+    def write_outside_cache(self, game):
+        """write game to the datastore without updating the cache"""
+        game.game_message = 'Written at version %d' % game.version
+        game.put()
+        return game
+
+    def test_read_through(self):
+        self.assertIsNone(self.client.get(self.cache.cache_key(self.urlsafe)))
+        game = self.cache.get_game(self.urlsafe)
+        self.assertEqual(game.version, self.game.version)
+        self.assertEqual(self.cache.version(self.urlsafe), game.version)
+        self.assertIsNotNone(
+            self.client.get(self.cache.cache_key(self.urlsafe)))
+        # later reads are served from the cache, not the datastore
+        self.write_outside_cache(self.stored_game())
+        self.assertEqual(self.cache.get_game(self.urlsafe).version,
+                         self.game.version)
+        self.assertEqual(self.cache.get_form(self.urlsafe).version,
+                         self.game.version)
+
+    def test_read_missing_game(self):
+        urlsafe = ndb.Key(Game, self.game.key.id() + 1).urlsafe()
+        self.assertIsNone(self.cache.get_game(urlsafe))
+        self.assertIsNone(self.cache.get_form(urlsafe))
+        self.assertIsNone(self.cache.version(urlsafe))
+
+    def test_older_version_does_not_overwrite_newer(self):
+        older = self.stored_game()
+        newer = self.write_outside_cache(self.stored_game())
+        self.assertGreater(newer.version, older.version)
+        self.cache.put(newer)
+        self.cache.put(older)
+        self.assertEqual(self.cache.get_game(self.urlsafe).version,
+                         newer.version)
+        self.assertEqual(self.cache.version(self.urlsafe), newer.version)
+
+    def test_newer_version_overwrites_older(self):
+        older = self.stored_game()
+        self.cache.put(older)
+        newer = self.write_outside_cache(self.stored_game())
+        self.cache.put(newer)
+        self.assertEqual(self.cache.get_game(self.urlsafe).game_message,
+                         newer.game_message)
+        self.assertEqual(self.cache.version(self.urlsafe), newer.version)
+
+    def test_invalidate(self):
+        self.cache.get_game(self.urlsafe)
+        stored = self.write_outside_cache(self.stored_game())
+        self.cache.invalidate(self.game.key)
+        self.assertEqual(self.cache.get_game(self.urlsafe).version,
+                         stored.version)
+
+    def test_conflicting_writers_drop_entry(self):
+        client = LocalMemcache()
+        # every compare-and-set loses to another writer
+        client.cas = lambda key, value, time=0: False
+        cache = GameCache(client)
+        cache.get_game(self.urlsafe)
+        cache.put(self.write_outside_cache(self.stored_game()))
+        self.assertIsNone(client.get(cache.cache_key(self.urlsafe)))
+        self.assertIsNone(client.get(cache.version_key(self.urlsafe)))
+
+    def test_commit_replaces_cached_game(self):
+        cached = self.cache.get_game(self.urlsafe)
+
+        def draw(game, unit):
+            drawn_card = game.draw_card()
+            unit.save()
+            return drawn_card
+
+        drawn_card = run_game_mutation(self.urlsafe, draw, cache=self.cache)
+        stored = self.stored_game()
+        self.assertGreater(stored.version, cached.version)
+        game = self.cache.get_game(self.urlsafe)
+        self.assertEqual(game.version, stored.version)
+        self.assertIn(drawn_card, game.cards.hand(stored.user_one_turn))
+        self.assertEqual(self.cache.version(self.urlsafe), stored.version)
+
+    def test_unchanged_mutation_keeps_cached_game(self):
+        self.cache.get_game(self.urlsafe)
+        stored = self.write_outside_cache(self.stored_game())
+        run_game_mutation(self.urlsafe, lambda game, unit: None,
+                          cache=self.cache)
+        self.assertLess(self.cache.version(self.urlsafe), stored.version)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+"""tests/test_replay.py - Tests of the move log records of engine/replay.py
+and of replaying them back to the state of the live game.  Run from the
+repository root:
+
+    python -m unittest discover tests"""
+
+__copyright__ = """
+    Copyright 2016 Christine Stoner
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from engine import CrazyEights, ReplayError, computer_player, replay_moves
+from engine.cards import CARD_SUITS, DECK_SIZE
+from engine.replay import DRAW, PASS, PLAY
+from engine.replay import decode_move, encode_move, pack_moves, unpack_moves
+
+# turns after which a test game that no player can finish is abandoned
+MAX_TURNS = 1000
+
+
+def live_state(game):
+    """return comparable tuple of the cards, suit and turn of a game"""
+    cards = game.cards
+    return (cards.hands[0].mask, cards.hands[1].mask,
+            list(cards.discard_pile), list(cards.undrawn_cards),
+            game.current_suit, game.user_one_turn, game.game_over)
+
+
+def replayed_state(state):
+    """return comparable tuple of the cards, suit and turn of a
+       ReplayState
+    """
+    cards = state.cards
+    return (cards.hands[0].mask, cards.hands[1].mask,
+            list(cards.discard_pile), list(cards.undrawn_cards),
+            state.current_suit, state.user_one_turn, state.game_over())
+
+
+def play_game(rng, player=None):
+    """deal and play a game, user two playing player, returning the game
+       and (move count, live state) after the deal and each turn
+    """
+    game = CrazyEights.deal(rng)
+    states = [(len(game.moves), live_state(game))]
+    for _ in range(MAX_TURNS):
+        if game.game_over:
+            break
+        game.take_computer_turn(None if game.user_one_turn else player)
+        states.append((len(game.moves), live_state(game)))
+    return game, states
+
+
+class MoveRecordTest(unittest.TestCase):
+    """Encoding of single move records"""
+
+    def test_round_trip(self):
+        for action in (PLAY, DRAW, PASS):
+            for user_one_turn in (True, False):
+                for card_number in range(DECK_SIZE):
+                    for suit in CARD_SUITS:
+                        record = encode_move(action, user_one_turn,
+                                             card_number, suit)
+                        self.assertEqual(decode_move(record),
+                                         (action, user_one_turn,
+                                          card_number, suit))
+
+    def test_pack_round_trip(self):
+        game, _ = play_game(random.Random(1))
+        self.assertEqual(unpack_moves(pack_moves(game.moves)), game.moves)
+
+
+class ReplayMovesTest(unittest.TestCase):
+    """Replays of move logs match the live games that recorded them"""
+
+    def test_replay_matches_live_game(self):
+        rng = random.Random(2)
+        for difficulty in ('easy', 'hard'):
+            for _ in range(50):
+                game, states = play_game(rng, computer_player(difficulty))
+                self.assertEqual(replayed_state(replay_moves(game.moves)),
+                                 states[-1][1])
+
+    def test_replay_upto_each_turn(self):
+        rng = random.Random(3)
+        for _ in range(10):
+            game, states = play_game(rng)
+            for moves, state in states:
+                replayed = replay_moves(game.moves, moves)
+                self.assertEqual(replayed.moves, moves)
+                self.assertEqual(replayed_state(replayed), state)
+
+    def test_replay_after_reshuffle(self):
+        rng = random.Random(4)
+        for _ in range(200):
+            game, states = play_game(rng)
+            if game.cards.reshuffles:
+                break
+        else:
+            self.fail('No game reshuffled')
+        self.assertEqual(replayed_state(replay_moves(game.moves)),
+                         states[-1][1])
+
+    def test_move_before_deal(self):
+        game, _ = play_game(random.Random(5))
+        self.assertRaises(ReplayError, replay_moves,
+                          game.moves[DECK_SIZE:])
+
+    def test_draw_not_on_top(self):
+        game, _ = play_game(random.Random(6))
+        moves = list(game.moves)
+        for index, record in enumerate(moves):
+            action, user_one_turn, card_number, suit = decode_move(record)
+            if action == DRAW:
+                moves[index] = encode_move(DRAW, user_one_turn,
+                                           (card_number + 1) % DECK_SIZE,
+                                           suit)
+                break
+        else:
+            self.fail('No card drawn')
+        self.assertRaises(ReplayError, replay_moves, moves)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+"""tests/test_state.py - Tests of the stored card state of engine/state.py
+and of rebuilding the undrawn cards of seeded games from their deck seed.
+Run from the repository root:
+
+    python -m unittest discover tests"""
+
+__copyright__ = """
+    Copyright 2016 Christine Stoner
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__license__ = "Apache 2.0"
+
+import os
+import random
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from engine import CrazyEights
+from engine.cards import DECK_SIZE, GameCards, deck_order
+from engine.state import STATE_VERSION, StateError
+from engine.state import decode_cards, encode_cards
+
+# turns after which a test game that no player can finish is abandoned
+MAX_TURNS = 1000
+
+
+def card_state(cards):
+    """return comparable tuple of the hands, piles, seed and reshuffles of
+       GameCards
+    """
+    return (cards.hands[0].mask, cards.hands[1].mask,
+            list(cards.discard_pile), list(cards.undrawn_cards),
+            cards.seed, cards.reshuffles)
+
+
+def unseeded_game(rng):
+    """return CrazyEights game dealt from a deck shuffled by rng, without a
+       deck seed, as games stored their undrawn cards before seeding
+    """
+    deck = list(range(DECK_SIZE))
+    rng.shuffle(deck)
+    return CrazyEights(GameCards.deal(deck), 'h', rng=rng)
+
+
+def played_states(game):
+    """play game to its end with the greedy heuristic, yielding its
+       GameCards after each turn
+    """
+    for _ in range(MAX_TURNS):
+        if game.game_over:
+            break
+        game.take_computer_turn()
+        yield game.cards
+
+
+class EncodeCardsTest(unittest.TestCase):
+    """Round trips of GameCards through the current blob format"""
+
+    def assertRoundTrip(self, cards):
+        blob = encode_cards(cards)
+        self.assertEqual(bytearray(blob[:1])[0], STATE_VERSION)
+        self.assertEqual(card_state(decode_cards(blob)), card_state(cards))
+
+    def test_seeded_round_trip(self):
+        rng = random.Random(3)
+        for _ in range(20):
+            game = CrazyEights.deal(rng)
+            self.assertRoundTrip(game.cards)
+            for cards in played_states(game):
+                self.assertRoundTrip(cards)
+
+    def test_seeded_blob_omits_undrawn_cards(self):
+        game = CrazyEights.deal(random.Random(4))
+        unseeded = GameCards(game.cards.hands, game.cards.discard_pile,
+                             game.cards.undrawn_cards)
+        self.assertLess(len(encode_cards(game.cards)),
+                        len(encode_cards(unseeded)))
+
+    def test_unseeded_round_trip(self):
+        rng = random.Random(5)
+        for _ in range(20):
+            game = unseeded_game(rng)
+            self.assertRoundTrip(game.cards)
+            for cards in played_states(game):
+                self.assertRoundTrip(cards)
+
+    def test_empty_blob(self):
+        self.assertRaises(StateError, decode_cards, b'')
+
+    def test_unknown_version(self):
+        blob = encode_cards(CrazyEights.deal(random.Random(6)).cards)
+        self.assertRaises(StateError, decode_cards,
+                          struct.pack('<B', STATE_VERSION + 1) + blob[1:])
+
+    def test_truncated_blob(self):
+        blob = encode_cards(CrazyEights.deal(random.Random(7)).cards)
+        self.assertRaises(StateError, decode_cards, blob[:5])
+
+
+class LegacyCardsTest(unittest.TestCase):
+    """Round trips of GameCards through the comma separated strings stored
+    before the blob format, with and without a deck seed
+    """
+
+    def test_strings_round_trip(self):
+        rng = random.Random(8)
+        for _ in range(20):
+            game = unseeded_game(rng)
+            for cards in played_states(game):
+                self.assertEqual(
+                    card_state(GameCards.from_strings(*cards.to_strings())),
+                    card_state(cards))
+
+    def test_seeded_strings_round_trip(self):
+        rng = random.Random(9)
+        for _ in range(20):
+            game = CrazyEights.deal(rng)
+            for cards in played_states(game):
+                hand_one, hand_two, discard_pile, _ = cards.to_strings()
+                self.assertEqual(
+                    card_state(GameCards.from_seed(hand_one, hand_two,
+                                                   discard_pile, cards.seed,
+                                                   cards.reshuffles)),
+                    card_state(cards))
+
+    def test_strings_to_blob(self):
+        game = unseeded_game(random.Random(10))
+        for cards in played_states(game):
+            legacy = GameCards.from_strings(*cards.to_strings())
+            self.assertEqual(card_state(decode_cards(encode_cards(legacy))),
+                             card_state(cards))
+
+
+class SeededReshuffleTest(unittest.TestCase):
+    """Reshuffles of seeded games depend only on the seed and the cards"""
+
+    def reshuffled_game(self, first_seed, rng):
+        """return game of the first deck seed from first_seed that
+           reshuffles, played until its first reshuffle
+        """
+        for seed in range(first_seed, first_seed + 100):
+            game = CrazyEights.deal(rng, seed)
+            for cards in played_states(game):
+                if cards.reshuffles:
+                    return game
+        self.fail('No game of seeds from %d reshuffled' % first_seed)
+
+    def test_reshuffle_ignores_rng(self):
+        for first_seed in range(0, 500, 100):
+            first = self.reshuffled_game(first_seed, random.Random(1))
+            second = self.reshuffled_game(first_seed, random.Random(2))
+            self.assertEqual(card_state(first.cards),
+                             card_state(second.cards))
+
+    def test_reshuffle_follows_deck_order(self):
+        game = self.reshuffled_game(11, random.Random(12))
+        cards = game.cards
+        order = [card_id for card_id
+                 in deck_order(cards.seed, cards.reshuffles)
+                 if card_id in list(cards.undrawn_cards)]
+        self.assertEqual(list(cards.undrawn_cards), order)
+
+    def test_from_seed_after_reshuffle(self):
+        cards = self.reshuffled_game(13, random.Random(14)).cards
+        hand_one, hand_two, discard_pile, _ = cards.to_strings()
+        rebuilt = GameCards.from_seed(hand_one, hand_two, discard_pile,
+                                      cards.seed, cards.reshuffles)
+        self.assertEqual(card_state(rebuilt), card_state(cards))
+        cards.discard_pile.push(cards.undrawn_cards.pop())
+        rebuilt.discard_pile.push(rebuilt.undrawn_cards.pop())
+        rebuilt.reshuffle(random.Random(15))
+        cards.reshuffle(random.Random(16))
+        self.assertEqual(card_state(rebuilt), card_state(cards))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""unit_of_work.py - Runs each API mutation of a Game as a unit of work.
+The game is loaded, changed in memory by the mutation, and committed with
+every entity the change creates in one transactional batch write.  Commits
+check the version of the game the mutation read, so a request that races
+another request on the same game, or whose transaction keeps colliding
+with other writes to the entities it touches, is rerun against a fresh
+copy."""
+
+import logging
+import endpoints
+from google.appengine.api.datastore_errors import TransactionFailedError
+from google.appengine.ext import ndb
+
+from game_cache import GameCache
+from models import Game, GameForm, ScoreRollup, UserStats
+from utils import get_by_urlsafe
+
+# number of times a mutation is run before a conflict is reported
+MAX_ATTEMPTS = 3
+
+
+class ConcurrentModificationError(Exception):
+    """Raised when a game was written after a unit of work loaded it"""
+
+
+class GameUnitOfWork(object):
+    """Changes to a Game made by one API request, written by commit
+    Attributes:
+        game: Game being changed
+        version: version of the game when it was loaded
+        entities: other entities to be written with the game
+        dirty: True once the game has been changed and must be written
+    """
+
+    def __init__(self, game):
+        self.game = game
+        self.version = game.version
+        self.entities = []
+        self.dirty = False
+
+    def save(self, *entities):
+        """marks the game changed and queues entities to write with it"""
+        self.dirty = True
+        self.entities.extend(entities)
+
+    def commit(self):
+        """writes the game, the moves it logged, the queued entities and,
+           if the game ended, its Score, the players' statistics and the
+           score rollup of the day in one transaction.  Raises
+           ConcurrentModificationError if the game was written since it
+           was loaded
+        """
+        game = self.game
+        score = game.pending_score()
+        move_log = game.pending_move_log()
+        entities = [game] + self.entities
+        if move_log:
+            entities.append(move_log)
+        if score:
+            entities.append(score)
+
+        @ndb.transactional(xg=True)
+        def write():
+            stored = game.key.get(use_cache=False, use_memcache=False)
+            if stored.version != self.version:
+                raise ConcurrentModificationError()
+            ndb.put_multi(entities)
+            if score:
+                UserStats.record_game(score.winning_user,
+                                      score.winning_user_name,
+                                      score.losing_user,
+                                      score.losing_user_name)
+                ScoreRollup.record_score(score)
+        write()
+
+
+def run_game_mutation(urlsafe_game_key, mutation, cache=None):
+    """Runs mutation(game, unit) against the Game the urlsafe key points to
+        and commits its unit of work, rerunning the mutation against a
+        fresh copy of the game if another request wrote the game first or
+        the commit transaction failed on contention.
+        The committed game is written through to the game cache, and a
+        GameForm response is given the committed version
+    Args:
+        urlsafe_game_key: A urlsafe key string of a Game
+        mutation: Function changing the game in memory, calling unit.save()
+            if the game must be written, and returning the response
+        cache: GameCache to write the committed game to, by default one
+            using the memcache service
+    Returns:
+        The value returned by mutation.
+    Raises:
+        NotFoundException: if the game does not exist
+        ConflictException: if every attempt raced another request"""
+    for attempt in range(MAX_ATTEMPTS):
+        game = get_by_urlsafe(urlsafe_game_key, Game, use_cache=False)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        unit = GameUnitOfWork(game)
+        response = mutation(game, unit)
+        if not unit.dirty:
+            return response
+        try:
+            unit.commit()
+            (cache or GameCache()).put(game)
+            if isinstance(response, GameForm):
+                # the form was rendered before the commit advanced the
+                # version
+                response.version = game.version
+            return response
+        except ConcurrentModificationError:
+            logging.info('Game %s changed by another request, attempt %d',
+                         urlsafe_game_key, attempt + 1)
+        except TransactionFailedError:
+            logging.info('Commit of game %s collided, attempt %d',
+                         urlsafe_game_key, attempt + 1)
+    raise endpoints.ConflictException(
+            'Game was changed by another request, please try again!')
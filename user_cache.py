@@ -0,0 +1,167 @@
+"""user_cache.py - Per-instance cache of hot User entities and of the
+name and email to user key mappings.  Entries live in a bounded LRU with a
+time to live, shared by every thread of the instance.  Writes to users bump
+a generation counter in memcache; each instance checks the counter at most
+once every GENERATION_CHECK_SECONDS and empties its cache when it has
+changed, so a rename is seen by every instance within that time.  Missing
+users are not cached, so a name or email that is not found is read again on
+the next lookup."""
+
+import threading
+import time
+from collections import OrderedDict
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+from models import User
+
+# memcache key of the generation counter bumped by writes to users
+USER_CACHE_GENERATION_KEY = 'user_cache_generation'
+# largest number of entries held by the cache of an instance
+USER_CACHE_SIZE = 1000
+# seconds an entry is served before it is read again
+USER_CACHE_SECONDS = 5 * 60
+# seconds between checks of the generation counter
+GENERATION_CHECK_SECONDS = 1
+
+
+class LRUCache(object):
+    """Thread-safe least recently used cache whose entries expire
+    Attributes:
+        max_size: largest number of entries held
+        ttl: seconds an entry is returned after it was put
+        hits: number of gets that found an unexpired entry
+        misses: number of gets that did not
+    """
+
+    def __init__(self, max_size, ttl, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """returns value put under key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] <= self._clock():
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """put value under key, evicting the least recently used entry if
+           the cache is full
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            if len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+            self._entries[key] = (value, self._clock() + self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class UserCache(object):
+    """Cache of users by key, name and email, shared by the threads of an
+    instance through the module level USER_CACHE
+    Attributes:
+        entries: LRUCache holding serialized users under ('key', user id)
+                 and user keys under ('name', name) and ('email', email)
+        client: memcache.Client holding the generation counter, or a
+                stand-in such as game_cache.LocalMemcache
+    """
+
+    def __init__(self, client=None, max_size=USER_CACHE_SIZE,
+                 ttl=USER_CACHE_SECONDS, clock=time.time):
+        self.entries = LRUCache(max_size, ttl, clock)
+        self.client = client or memcache.Client()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._generation = None
+        self._checked = None
+
+    def _check_generation(self):
+        """empty the cache if another instance has written a user since the
+           generation counter was last read
+        """
+        now = self._clock()
+        with self._lock:
+            if (self._checked is not None and
+                    now - self._checked < GENERATION_CHECK_SECONDS):
+                return
+            self._checked = now
+        generation = self.client.get(USER_CACHE_GENERATION_KEY)
+        with self._lock:
+            if generation != self._generation:
+                self._generation = generation
+                self.entries.clear()
+
+    def get_user(self, user_key):
+        """returns the User user_key points to, or None"""
+        self._check_generation()
+        encoded = self.entries.get(('key', user_key.id()))
+        if encoded is not None:
+            return ndb.model_from_protobuf(entity_pb.EntityProto(encoded))
+        user = user_key.get()
+        if user:
+            self._put_user(user)
+        return user
+
+    def key_for_name(self, name):
+        """returns key of the User holding name, or None"""
+        self._check_generation()
+        user_key = self.entries.get(('name', name))
+        if user_key is None:
+            user_key = User.key_for_name(name)
+            if user_key:
+                self.entries.put(('name', name), user_key)
+        return user_key
+
+    def get_by_email(self, email):
+        """returns the User holding email, or None"""
+        self._check_generation()
+        user_key = self.entries.get(('email', email))
+        if user_key is not None:
+            return self.get_user(user_key)
+        user = User.get_by_email(email)
+        if user:
+            self._put_user(user)
+        return user
+
+    def _put_user(self, user):
+        """cache user and its name and email mappings"""
+        self.entries.put(('key', user.key.id()),
+                         ndb.model_to_protobuf(user).Encode())
+        self.entries.put(('name', user.name), user.key)
+        if user.email:
+            self.entries.put(('email', user.email), user.key)
+
+    def invalidate(self):
+        """empty the cache of every instance after a user was written"""
+        generation = self.client.incr(USER_CACHE_GENERATION_KEY,
+                                      initial_value=0)
+        with self._lock:
+            self._generation = generation
+            self.entries.clear()
+
+    def stats(self):
+        """returns dict of the entries, hits and misses of the cache"""
+        return {'entries': len(self.entries),
+                'hits': self.entries.hits,
+                'misses': self.entries.misses}
+
+
+# cache shared by the threads of this instance
+USER_CACHE = UserCache()
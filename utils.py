@@ -1,11 +1,18 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+# number of results returned by list endpoints when no limit is requested
+DEFAULT_PAGE_SIZE = 50
+# largest number of results list endpoints return in one page
+MAX_PAGE_SIZE = 200
 
-def get_by_urlsafe(urlsafe, model):
+
+def get_by_urlsafe(urlsafe, model, **ctx_options):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
         that the type of entity returned is of the correct kind. Raises an
         error if the key String is malformed or the entity is of the incorrect
@@ -13,6 +20,7 @@ def get_by_urlsafe(urlsafe, model):
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
+        ctx_options: ndb context options for the get, such as use_cache
     Returns:
         The entity that the urlsafe Key string points to or None if no entity
         exists.
@@ -28,9 +36,60 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
+    entity = key.get(**ctx_options)
     if not entity:
         return None
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
+
+
+def get_page_size(limit):
+    """Returns the number of results to fetch for a requested page limit,
+        defaulting to DEFAULT_PAGE_SIZE and capped at MAX_PAGE_SIZE."""
+    if not limit or limit < 1:
+        return DEFAULT_PAGE_SIZE
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def get_cursor(page_token):
+    """Returns the datastore query Cursor a page token points to, or None to
+        start from the first result. Raises an error if the token is
+        malformed
+    Args:
+        page_token: A urlsafe cursor string returned as next_page_token
+    Returns:
+        The Cursor, or None if no page token was provided.
+    Raises:
+        BadRequestException:"""
+    if not page_token:
+        return None
+    try:
+        return Cursor(urlsafe=page_token)
+    except datastore_errors.BadValueError:
+        raise endpoints.BadRequestException('Invalid page token')
+
+
+def get_page_token(next_cursor, more):
+    """Returns the next_page_token for a fetched page, or None if it was
+        the last page."""
+    if more and next_cursor:
+        return next_cursor.urlsafe()
+    return None
+
+
+def get_offset(page_token):
+    """Returns the list index a page token of a list property points to, or
+        0 to start from the first item. Raises an error if the token is
+        malformed
+    Args:
+        page_token: A decimal index string returned as next_page_token
+    Returns:
+        The index of the first item of the page.
+    Raises:
+        BadRequestException:"""
+    if not page_token:
+        return 0
+    if not page_token.isdigit():
+        raise endpoints.BadRequestException('Invalid page token')
+    return int(page_token)